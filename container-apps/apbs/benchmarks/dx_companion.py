@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Benchmark parsing OpenDX grids and writing their binary companions.
+
+A synthetic grid in the format APBS writes is parsed line by line in
+Python and with job_control.read_dx, and the sizes of the .dx file and
+its .npy companion are compared. The results are printed as JSON.
+"""
+
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import json
+import sys
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from job_control import read_dx, write_dx_companion  # noqa: E402
+
+
+def write_grid(path: Path, size: int):
+    """Write a size**3 grid of random values as an APBS-style .dx file."""
+    values = np.random.default_rng(0).normal(size=size**3)
+    with open(path, "w") as fout:
+        fout.write("# Data from APBS\n#\n# POTENTIAL (kT/e)\n#\n")
+        fout.write(f"object 1 class gridpositions counts {size} {size} {size}\n")
+        fout.write("origin -2.000000e+01 -2.000000e+01 -2.000000e+01\n")
+        fout.write("delta 5.000000e-01 0.000000e+00 0.000000e+00\n")
+        fout.write("delta 0.000000e+00 5.000000e-01 0.000000e+00\n")
+        fout.write("delta 0.000000e+00 0.000000e+00 5.000000e-01\n")
+        fout.write(f"object 2 class gridconnections counts {size} {size} {size}\n")
+        fout.write(
+            "object 3 class array type double rank 0 " f"items {size**3} data follows\n"
+        )
+        full = values.size - values.size % 3
+        np.savetxt(fout, values[:full].reshape(-1, 3), fmt="%e")
+        if full != values.size:
+            np.savetxt(fout, values[full:].reshape(1, -1), fmt="%e")
+        fout.write('attribute "dep" string "positions"\n')
+        fout.write(
+            'object "regular positions regular connections" class field\n'
+            'component "positions" value 1\n'
+            'component "connections" value 2\n'
+            'component "data" value 3\n'
+        )
+
+
+def read_dx_lines(path: Path) -> list:
+    """Parse the data block one line and one float() at a time."""
+    values = []
+    in_data = False
+    with open(path) as fin:
+        for line in fin:
+            if in_data:
+                if line.startswith("attribute"):
+                    break
+                values.extend(float(value) for value in line.split())
+            elif line.rstrip().endswith("data follows"):
+                in_data = True
+    return values
+
+
+def best_of(repeat: int, func, *args) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func(*args)
+        timings.append(perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--size", type=int, default=129, help="Grid points per axis")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per method")
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / "pot.dx"
+        write_grid(path, args.size)
+        dx_bytes = path.stat().st_size
+        megabytes = dx_bytes / 1024**2
+
+        lines_seconds = best_of(args.repeat, read_dx_lines, path)
+        numpy_seconds = best_of(args.repeat, read_dx, path)
+        companion_seconds = best_of(args.repeat, write_dx_companion, path)
+        npy_path, header_path = write_dx_companion(path)
+        binary_bytes = npy_path.stat().st_size + header_path.stat().st_size
+
+    print(
+        json.dumps(
+            {
+                "grid": [args.size] * 3,
+                "dx_bytes": dx_bytes,
+                "binary_bytes": binary_bytes,
+                "size_reduction": round(1 - binary_bytes / dx_bytes, 4),
+                "line_parse_mb_per_s": round(megabytes / lines_seconds, 2),
+                "numpy_parse_mb_per_s": round(megabytes / numpy_seconds, 2),
+                "companion_mb_per_s": round(megabytes / companion_seconds, 2),
+                "speedup": round(lines_seconds / numpy_seconds, 2),
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
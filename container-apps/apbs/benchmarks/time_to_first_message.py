@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""Benchmark how long a cold worker takes to reach its first message.
+
+Each run starts a fresh worker process against the local backends with a
+single dry job on the queue, and reads the start-up gauges the worker
+exports (process start to main(), to clients ready, and to the first
+dequeued message) from its APBS_METRICS_TEXTFILE. The wall time of the
+whole process is measured as well. Results are printed, and written with
+--output, as JSON so they can be compared across releases.
+"""
+
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from pathlib import Path
+from statistics import median
+from subprocess import run, PIPE, DEVNULL
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import asyncio
+import base64
+import json
+import os
+import sys
+
+APBS_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(APBS_DIR))
+import job_control as jc  # noqa: E402
+
+GAUGES = ("main_seconds", "clients_seconds", "first_message_seconds")
+
+
+async def enqueue(storage_path: Path, queue_path: str):
+    outputs = jc.LocalStorage("outputs", storage_path)
+    await outputs.put_contents(
+        "bench/job0/dry-status.json",
+        json.dumps({"dry": {"status": "pending"}}),
+        overwrite=True,
+    )
+    queue = jc.LocalQueueClient(queue_path)
+    job = {
+        "job_date": "bench",
+        "job_id": "job0",
+        "job_type": "dry",
+        "input_files": [],
+        "command_line_args": "",
+    }
+    await queue.send_message(base64.b64encode(json.dumps(job).encode()).decode())
+    await queue.close()
+
+
+def read_gauges(textfile: Path) -> dict:
+    gauges = {}
+    for line in textfile.read_text().splitlines():
+        name, _, value = line.partition(" ")
+        if name.startswith("apbs_") and name[len("apbs_") :] in GAUGES:
+            gauges[name[len("apbs_") :]] = float(value)
+    return gauges
+
+
+def run_once(entrypoint: str) -> dict:
+    with TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        queue_path = str(root / "queue.sqlite")
+        asyncio.run(enqueue(root / "blobs", queue_path))
+        textfile = root / "worker.prom"
+        env = dict(
+            os.environ,
+            APBS_BACKEND="local",
+            APBS_LOCAL_STORAGE_PATH=str(root / "blobs"),
+            APBS_LOCAL_QUEUE_PATH=queue_path,
+            APBS_METRICS_TEXTFILE=str(textfile),
+            JOB_PATH=str(root / "jobs"),
+            IDLE_BUDGET="0",
+            PYTHONPATH=str(APBS_DIR),
+        )
+        if entrypoint == "module":
+            command = [sys.executable, "-m", "job_control"]
+        else:
+            command = [sys.executable, str(APBS_DIR / "job_control.py")]
+        start = perf_counter()
+        run(command, env=env, cwd=root, stdout=DEVNULL, stderr=PIPE, check=True)
+        result = read_gauges(textfile)
+        result["process_wall_seconds"] = perf_counter() - start
+        return result
+
+
+def version() -> str:
+    described = run(
+        ["git", "describe", "--always", "--dirty"],
+        cwd=APBS_DIR,
+        stdout=PIPE,
+        stderr=DEVNULL,
+        text=True,
+    )
+    return described.stdout.strip() or "unknown"
+
+
+def main():
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--entrypoint",
+        choices=["module", "script"],
+        default="module",
+        help="Start the worker with python -m job_control or as a script",
+    )
+    parser.add_argument("--output", type=Path, help="Where to write the JSON")
+    args = parser.parse_args()
+
+    runs = [run_once(args.entrypoint) for _ in range(args.runs)]
+    summary = {}
+    for key in GAUGES + ("process_wall_seconds",):
+        values = [result[key] for result in runs if key in result]
+        if values:
+            summary[key] = {
+                "median": round(median(values), 4),
+                "min": round(min(values), 4),
+                "max": round(max(values), 4),
+            }
+    report = json.dumps(
+        {
+            "version": version(),
+            "python": sys.version.split()[0],
+            "entrypoint": args.entrypoint,
+            "runs": args.runs,
+            "summary": summary,
+        },
+        indent=2,
+    )
+    if args.output:
+        args.output.write_text(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
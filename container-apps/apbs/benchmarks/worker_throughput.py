@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""Benchmark the worker's own overhead with local backends and a stub binary.
+
+Each configuration runs in a fresh process. Messages are put on a SQLite
+queue, inputs in a directory blob store, and a stub "apbs" on the PATH
+sleeps and writes an output file of the requested size. Every storage and
+queue call can be delayed to simulate network latency. The job timings
+come from the worker's own APBS_METRICS_JSONL export.
+
+Results are printed, and written with --output, as JSON: jobs per second,
+p50/p95/p99 of each stage, and the controller's CPU time and peak RSS.
+"""
+
+from argparse import SUPPRESS, ArgumentDefaultsHelpFormatter, ArgumentParser
+from itertools import product
+from logging import WARNING
+from pathlib import Path
+from resource import getrusage, RUSAGE_SELF
+from subprocess import run, PIPE
+from tempfile import TemporaryDirectory
+from time import time
+import asyncio
+import base64
+import json
+import os
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import job_control as jc  # noqa: E402
+
+STUB = """#!{python}
+import sys, time
+seconds, size = float(sys.argv[1]), int(sys.argv[2])
+print("stub", seconds, size)
+time.sleep(seconds)
+with open("pot.dx", "wb") as fout:
+    fout.write(b"0" * size)
+"""
+
+
+class LatencyStorage(jc.LocalStorage):
+    """A LocalStorage that waits before every call, like a remote store."""
+
+    latency = 0.0
+
+    async def download_file(self, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+        return await super().download_file(*args, **kwargs)
+
+    async def upload_file(self, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+        return await super().upload_file(*args, **kwargs)
+
+    async def get_contents_and_etag(self, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+        return await super().get_contents_and_etag(*args, **kwargs)
+
+    async def put_contents(self, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+        return await super().put_contents(*args, **kwargs)
+
+
+class LatencyQueueClient(jc.LocalQueueClient):
+    """A LocalQueueClient that waits before every call."""
+
+    latency = 0.0
+
+    async def _run(self, func, *args):
+        await asyncio.sleep(self.latency)
+        return await super()._run(func, *args)
+
+
+def percentile(values, fraction):
+    """The nearest-rank percentile of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(int(round(fraction * len(ordered))) - 1, 0)
+    return round(ordered[min(index, len(ordered) - 1)], 4)
+
+
+async def enqueue(config, storage_path, queue_path):
+    inputs = jc.LocalStorage("inputs", storage_path)
+    outputs = jc.LocalStorage("outputs", storage_path)
+    queue = jc.LocalQueueClient(queue_path)
+    payload = os.urandom(config["input_bytes"])
+    for index in range(config["messages"]):
+        tag = f"bench/job{index}"
+        await outputs.put_contents(
+            f"{tag}/apbs-status.json",
+            json.dumps({"apbs": {"status": "pending"}}),
+            overwrite=True,
+        )
+        await inputs.put_contents(f"{tag}/input.in", payload, overwrite=True)
+        job = {
+            "job_date": "bench",
+            "job_id": f"job{index}",
+            "job_type": "apbs",
+            "input_files": [f"{tag}/input.in"],
+            "command_line_args": f"{config['job_seconds']} {config['output_bytes']}",
+        }
+        await queue.send_message(base64.b64encode(json.dumps(job).encode()).decode())
+    await queue.close()
+
+
+def run_one(config):
+    """Run a single configuration in this process and return its results."""
+    with TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        bindir = root / "bin"
+        bindir.mkdir()
+        stub = bindir / "apbs"
+        stub.write_text(STUB.format(python=sys.executable))
+        stub.chmod(0o755)
+        storage_path = root / "blobs"
+        queue_path = str(root / "queue.sqlite")
+        jsonl = root / "jobs.jsonl"
+        os.environ.update(
+            {
+                "PATH": f"{bindir}:{os.environ['PATH']}",
+                "APBS_BACKEND": "local",
+                "APBS_LOCAL_STORAGE_PATH": str(storage_path),
+                "APBS_LOCAL_QUEUE_PATH": queue_path,
+                "APBS_MAX_CONCURRENT_JOBS": str(config["concurrency"]),
+                "APBS_METRICS_JSONL": str(jsonl),
+                "APBS_LOG_CONSOLE": "0",
+                "JOB_PATH": str(root / "jobs"),
+                "IDLE_BUDGET": "0",
+            }
+        )
+        jc._LOGGER.setLevel(WARNING)
+        LatencyStorage.latency = LatencyQueueClient.latency = config["latency"]
+        jc.open_storage = lambda name: LatencyStorage(name, storage_path)
+        jc.Queue._client_from_env = staticmethod(
+            lambda queue_name=None: LatencyQueueClient(queue_path)
+        )
+        asyncio.run(enqueue(config, storage_path, queue_path))
+
+        before = getrusage(RUSAGE_SELF)
+        start = time()
+        if config["mode"] == "main":
+            asyncio.run(jc.main())
+        else:
+            asyncio.run(run_jobs(config["concurrency"]))
+        elapsed = time() - start
+        after = getrusage(RUSAGE_SELF)
+
+        jobs = [json.loads(line) for line in jsonl.read_text().splitlines()]
+    stages = {}
+    for job in jobs:
+        for stage, seconds in job["stages_in_seconds"].items():
+            stages.setdefault(stage, []).append(seconds)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return {
+        "config": config,
+        "jobs": len(jobs),
+        "failed": sum(job["exit_code"] != 0 for job in jobs),
+        "elapsed_seconds": round(elapsed, 3),
+        "jobs_per_second": round(len(jobs) / elapsed, 3) if elapsed else None,
+        "stages": {
+            stage: {
+                "p50": percentile(values, 0.50),
+                "p95": percentile(values, 0.95),
+                "p99": percentile(values, 0.99),
+            }
+            for stage, values in sorted(stages.items())
+        },
+        "controller_cpu_seconds": round(cpu, 3),
+        "controller_cpu_seconds_per_job": round(cpu / len(jobs), 4) if jobs else None,
+        "controller_max_rss_bytes": after.ru_maxrss * 1024,
+    }
+
+
+async def run_jobs(concurrency):
+    """Call process_message directly, without the polling loop of main()."""
+    queue = jc.Queue.from_environment()
+    inputs = jc.open_storage("inputs")
+    outputs = jc.open_storage("outputs")
+    settings = jc.Settings.from_environment()
+    telemetry = jc.Telemetry.from_settings(settings)
+    stop_event = asyncio.Event()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(message):
+        async with semaphore:
+            await jc.process_message(
+                message,
+                queue,
+                outputs,
+                inputs,
+                settings,
+                stop_event,
+                telemetry=telemetry,
+            )
+
+    messages = []
+    while True:
+        message = await queue._get_single_message()
+        if message is None:
+            break
+        messages.append(message)
+    await asyncio.gather(*(process(message) for message in messages))
+    await asyncio.gather(queue.close(), inputs.close(), outputs.close())
+
+
+def main():
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--mode", choices=["main", "run_job"], default="main")
+    parser.add_argument("--messages", type=int, nargs="+", default=[50])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--input-size", nargs="+", default=["100Ki"])
+    parser.add_argument("--output-size", nargs="+", default=["1Mi"])
+    parser.add_argument(
+        "--latency", type=float, nargs="+", default=[0.0], help="Seconds per call"
+    )
+    parser.add_argument("--job-seconds", type=float, default=0.05)
+    parser.add_argument("--output", type=Path, help="Where to write the JSON")
+    parser.add_argument("--run-one", help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(json.loads(args.run_one))))
+        return
+
+    results = []
+    for messages, concurrency, input_size, output_size, latency in product(
+        args.messages, args.concurrency, args.input_size, args.output_size, args.latency
+    ):
+        config = {
+            "mode": args.mode,
+            "messages": messages,
+            "concurrency": concurrency,
+            "input_bytes": jc.parse_size(input_size),
+            "output_bytes": jc.parse_size(output_size),
+            "latency": latency,
+            "job_seconds": args.job_seconds,
+        }
+        completed = run(
+            [sys.executable, __file__, "--run-one", json.dumps(config)],
+            stdout=PIPE,
+            check=True,
+        )
+        result = json.loads(completed.stdout.decode().strip().splitlines()[-1])
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+
+    report = json.dumps({"results": results}, indent=2)
+    if args.output:
+        args.output.write_text(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,283 @@
 #!/usr/bin/env python3
 """Software to run apbs and pdb2pqr jobs."""
 
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timezone
 from enum import Enum
 from json import dumps, loads, JSONDecodeError
-from logging import basicConfig, getLogger, DEBUG, INFO, StreamHandler
-from os import chdir, getenv, getpid, listdir, makedirs
+from logging import (
+    basicConfig,
+    getLogger,
+    DEBUG,
+    INFO,
+    FileHandler,
+    Formatter,
+    Handler,
+    StreamHandler,
+)
+from os import getenv, getpid, listdir, makedirs
 from pathlib import Path
 from resource import getrusage, RUSAGE_CHILDREN
-from shutil import rmtree
+from shutil import copyfile, copyfileobj, rmtree
 import signal
 from subprocess import run, CalledProcessError, PIPE
 from time import sleep, time
-from typing import Any, Dict, List, Optional
-from urllib import request
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 from sys import stderr
 import sys
 import os
 import json
+import math
 import pathlib
 import base64
 import asyncio
 import contextlib
+from copy import deepcopy
+import fcntl
+import functools
+import hashlib
+import importlib.metadata
+import mimetypes
+import random
+import sqlite3
+import tarfile
+import tempfile
+import threading
+import uuid
+import zlib
+
+
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+)
+
+# The Azure SDK clients, aiohttp and numpy take most of the start-up time,
+# so they are imported where they are first used (see preload_modules).
+if TYPE_CHECKING:
+    import aiohttp
+    import numpy as np
+    from azure.core.pipeline.transport import AioHttpTransport
+    from azure.identity.aio import DefaultAzureCredential
+    from azure.storage.blob import ContentSettings
+    from azure.storage.blob.aio import BlobServiceClient
+    from azure.storage.queue import QueueMessage
+    from azure.storage.queue.aio import QueueClient
+
+from dataclasses import dataclass, field
+
+_SIZE_SUFFIXES = {
+    "": 1,
+    "k": 1000,
+    "m": 1000**2,
+    "g": 1000**3,
+    "t": 1000**4,
+    "ki": 1024,
+    "mi": 1024**2,
+    "gi": 1024**3,
+    "ti": 1024**4,
+}
+
+
+def parse_size(value: str) -> int:
+    """Convert a Kubernetes-style quantity (e.g. "8Gi", "512M") to bytes.
+
+    Args:
+        value (str): The quantity to convert.
+    Returns:
+        int: The number of bytes.
+    """
+    value = value.strip()
+    number = value.rstrip("KMGTkmgti")
+    suffix = value[len(number) :].lower()
+    if suffix not in _SIZE_SUFFIXES:
+        raise ValueError(f"Invalid size, {value}")
+    return int(float(number) * _SIZE_SUFFIXES[suffix])
+
+
+def getenv_bool(name: str, default: bool = False) -> bool:
+    """Read a true/false flag from the environment."""
+    value = getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _read_cgroup_file(*paths: str) -> Optional[str]:
+    """Return the contents of the first cgroup file that can be read."""
+    for path in paths:
+        try:
+            with open(path) as fin:
+                return fin.read().strip()
+        except OSError:
+            continue
+    return None
 
 
-from azure.storage.queue import QueueClient, QueueMessage
-from azure.storage.blob import BlobServiceClient
-from azure.core.exceptions import ResourceNotFoundError
-from azure.identity import DefaultAzureCredential
+def get_cpu_limit() -> float:
+    """Get the number of CPUs available to the container.
+
+    The cgroup quota is used when it is set (cgroup v2 first, then v1),
+    otherwise the number of CPUs on the host.
+    """
+    cpu_max = _read_cgroup_file("/sys/fs/cgroup/cpu.max")
+    if cpu_max:
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max" and period:
+            return int(quota) / int(period)
+    quota = _read_cgroup_file("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = _read_cgroup_file("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return float(os.cpu_count() or 1)
+
+
+def get_memory_limit() -> int:
+    """Get the number of bytes of memory available to the container.
+
+    The cgroup limit is used when it is set (cgroup v2 first, then v1),
+    otherwise the physical memory of the host.
+    """
+    host_memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    limit = _read_cgroup_file(
+        "/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"
+    )
+    if limit and limit != "max":
+        return min(int(limit), host_memory)
+    return host_memory
 
-from dataclasses import dataclass
+
+def get_max_concurrent_jobs() -> int:
+    """Get the number of jobs a single replica should run at once.
+
+    APBS_MAX_CONCURRENT_JOBS defaults to 1, since jobs that share a
+    replica also share its memory limit. When it is set to "auto", the
+    value is derived from the container's CPU and memory limits divided by
+    the resources reserved for each job (APBS_JOB_CPU and APBS_JOB_MEMORY).
+    """
+    configured = getenv("APBS_MAX_CONCURRENT_JOBS", "1")
+    if configured.lower() != "auto":
+        return max(1, int(configured))
+    job_cpu = float(getenv("APBS_JOB_CPU", "1"))
+    job_memory = parse_size(getenv("APBS_JOB_MEMORY", "2Gi"))
+    by_cpu = int(get_cpu_limit() // job_cpu)
+    by_memory = get_memory_limit() // job_memory
+    return max(1, min(by_cpu, by_memory))
 
 
 @dataclass
 class Settings:
     job_path: os.PathLike = "/var/tmp/"
     log_level: int = INFO
+    max_concurrent_jobs: int = 1
+    download_concurrency: int = 4
+    upload_concurrency: int = 4
+    pipeline_uploads: bool = False
+    pipeline_interval: float = 5.0
+    input_cache_bytes: int = 0
+    result_cache: bool = False
+    compress_outputs: bool = False
+    compress_min_bytes: int = 1024**2
+    compress_suffixes: Tuple[str, ...] = (".dx", ".pqr", ".pdb", ".txt", ".log")
+    bundle_subdirectories: bool = False
+    dx_companions: bool = False
+    dx_concurrency: int = 1
+    log_flush_bytes: int = 64 * 1024
+    log_flush_interval: float = 1.0
+    log_max_bytes: int = 0
+    log_console: bool = True
+    log_console_rate: int = 0
+    resource_sample_interval: float = 1.0
+    metrics_textfile: Optional[str] = None
+    metrics_jsonl: Optional[str] = None
+    pdb2pqr_pool: bool = False
+    pdb2pqr_jobs_per_process: int = 20
+    memory_admission: bool = False
+    memory_capacity: int = 0
+    memory_per_grid_point: float = 200.0
+    memory_per_atom: int = 1024
+    memory_base: int = 64 * 1024**2
+    status_flush_delay: float = 10.0
+    job_timeout: float = 0.0
+    kill_grace: float = 30.0
+    runtime_per_grid_point: float = 2e-5
+    runtime_per_atom: float = 2e-3
+
+    @staticmethod
+    def _kwargs_from_env():
+        return {
+            "job_path": getenv("JOB_PATH", "/var/tmp/"),
+            "max_concurrent_jobs": get_max_concurrent_jobs(),
+            "download_concurrency": int(getenv("APBS_DOWNLOAD_CONCURRENCY", "4")),
+            "upload_concurrency": int(getenv("APBS_UPLOAD_CONCURRENCY", "4")),
+            "pipeline_uploads": getenv_bool("APBS_PIPELINE_UPLOADS"),
+            "pipeline_interval": float(getenv("APBS_PIPELINE_INTERVAL", "5")),
+            "input_cache_bytes": parse_size(getenv("APBS_INPUT_CACHE_SIZE", "0")),
+            "result_cache": getenv_bool("APBS_RESULT_CACHE"),
+            "compress_outputs": getenv_bool("APBS_COMPRESS_OUTPUTS"),
+            "compress_min_bytes": parse_size(getenv("APBS_COMPRESS_MIN_SIZE", "1Mi")),
+            "compress_suffixes": tuple(
+                suffix.strip().lower()
+                for suffix in getenv(
+                    "APBS_COMPRESS_SUFFIXES", ".dx,.pqr,.pdb,.txt,.log"
+                ).split(",")
+                if suffix.strip()
+            ),
+            "bundle_subdirectories": getenv_bool("APBS_BUNDLE_SUBDIRECTORIES"),
+            "dx_companions": getenv_bool("APBS_DX_COMPANIONS"),
+            "dx_concurrency": int(getenv("APBS_DX_CONCURRENCY", "1")),
+            "log_flush_bytes": parse_size(getenv("APBS_LOG_FLUSH_SIZE", "64Ki")),
+            "log_flush_interval": float(getenv("APBS_LOG_FLUSH_INTERVAL", "1")),
+            "log_max_bytes": parse_size(getenv("APBS_LOG_MAX_SIZE", "256Mi")),
+            "log_console": getenv_bool("APBS_LOG_CONSOLE", True),
+            "log_console_rate": parse_size(getenv("APBS_LOG_CONSOLE_RATE", "0")),
+            "resource_sample_interval": float(
+                getenv("APBS_RESOURCE_SAMPLE_INTERVAL", "1")
+            ),
+            "metrics_textfile": getenv("APBS_METRICS_TEXTFILE") or None,
+            "metrics_jsonl": getenv("APBS_METRICS_JSONL") or None,
+            "pdb2pqr_pool": getenv_bool("APBS_PDB2PQR_POOL"),
+            "pdb2pqr_jobs_per_process": int(
+                getenv("APBS_PDB2PQR_JOBS_PER_PROCESS", "20")
+            ),
+            "memory_admission": getenv_bool("APBS_MEMORY_ADMISSION"),
+            "memory_capacity": parse_size(getenv("APBS_MEMORY_CAPACITY", "0"))
+            or max(
+                get_memory_limit() - parse_size(getenv("APBS_WORKER_MEMORY", "512Mi")),
+                0,
+            ),
+            "memory_per_grid_point": float(getenv("APBS_MEMORY_PER_GRID_POINT", "200")),
+            "memory_per_atom": parse_size(getenv("APBS_MEMORY_PER_ATOM", "1Ki")),
+            "memory_base": parse_size(getenv("APBS_MEMORY_BASE", "64Mi")),
+            "status_flush_delay": float(getenv("APBS_STATUS_FLUSH_DELAY", "10")),
+            "job_timeout": float(getenv("APBS_JOB_TIMEOUT", "0")),
+            "kill_grace": float(getenv("APBS_JOB_KILL_GRACE", "30")),
+            "runtime_per_grid_point": float(
+                getenv("APBS_RUNTIME_PER_GRID_POINT", "2e-5")
+            ),
+            "runtime_per_atom": float(getenv("APBS_RUNTIME_PER_ATOM", "2e-3")),
+        }
+
+    @classmethod
+    def from_environment(cls):
+        return cls(**cls._kwargs_from_env())
 
 
 # Global Environment Variables
@@ -78,29 +319,224 @@ class JOBSTATUS(Enum):
     RUNNING = 2
     UNKNOWN = 3
     FAILED = 4
+    TIMEOUT = 5
+
+
+class SharedConnections:
+    """One credential and one pool of HTTP connections for every client.
+
+    Every Container App job execution is a cold start, so the blob clients,
+    the queue client and plain HTTP(S) downloads share a single
+    DefaultAzureCredential, which fetches a token once and caches it until
+    it nears expiry, and a single connector whose connections are kept
+    alive between requests. The Azure SDK gets its own session on that
+    connector because it must not decompress responses or keep cookies.
+    Everything is created on first use and released by close().
+    """
+
+    def __init__(self, pool_size: int = 100, keepalive: float = 30.0):
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self._credential: Optional[DefaultAzureCredential] = None
+        self._connector: Optional[aiohttp.TCPConnector] = None
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+
+    @staticmethod
+    def _kwargs_from_env():
+        return {
+            "pool_size": int(getenv("APBS_HTTP_POOL_SIZE", "100")),
+            "keepalive": float(getenv("APBS_HTTP_KEEPALIVE", "30")),
+        }
+
+    @classmethod
+    def from_environment(cls):
+        return cls(**cls._kwargs_from_env())
+
+    @property
+    def credential(self) -> DefaultAzureCredential:
+        if self._credential is None:
+            from azure.identity.aio import DefaultAzureCredential
+
+            self._credential = DefaultAzureCredential()
+        return self._credential
+
+    def session(self, purpose: str = "http") -> aiohttp.ClientSession:
+        """Get the session for plain HTTP(S) ("http") or the Azure SDK ("azure")."""
+        import aiohttp
+
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(
+                limit=self.pool_size, keepalive_timeout=self.keepalive
+            )
+        session = self._sessions.get(purpose)
+        if session is None or session.closed:
+            kwargs = {"connector": self._connector, "connector_owner": False}
+            if purpose == "azure":
+                kwargs.update(
+                    cookie_jar=aiohttp.DummyCookieJar(),
+                    auto_decompress=False,
+                    trust_env=True,
+                )
+            session = self._sessions[purpose] = aiohttp.ClientSession(**kwargs)
+        return session
+
+    def transport(self) -> AioHttpTransport:
+        """A transport for an Azure SDK client that uses the shared session."""
+        from azure.core.pipeline.transport import AioHttpTransport
+
+        return AioHttpTransport(session=self.session("azure"), session_owner=False)
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+        if self._connector is not None:
+            await self._connector.close()
+            self._connector = None
+        if self._credential is not None:
+            await self._credential.close()
+            self._credential = None
+
+
+_SHARED_CONNECTIONS: Optional[SharedConnections] = None
+
 
+def shared_connections() -> SharedConnections:
+    """Get the connections shared by every client in this process."""
+    global _SHARED_CONNECTIONS
+    if _SHARED_CONNECTIONS is None:
+        _SHARED_CONNECTIONS = SharedConnections.from_environment()
+    return _SHARED_CONNECTIONS
 
-class Storage:
-    """Wrapper around Azure Blob Storage."""
 
-    def __init__(self, container_name: str, blob_service_client: BlobServiceClient):
+def process_start_time() -> Optional[float]:
+    """The time this process started, in seconds since the epoch, from /proc."""
+    stat = _read_cgroup_file("/proc/self/stat")
+    uptime = _read_cgroup_file("/proc/uptime")
+    if not stat or not uptime:
+        return None
+    started = int(stat.rpartition(")")[2].split()[19]) / os.sysconf("SC_CLK_TCK")
+    return time() - (float(uptime.split()[0]) - started)
+
+
+class BlobStore(ABC):
+    """The blob operations the worker needs from a storage container.
+
+    Storage talks to Azure Blob Storage and LocalStorage to a directory;
+    open_storage() picks one from APBS_BACKEND. Missing blobs raise
+    ResourceNotFoundError and failed conditional writes raise
+    ResourceModifiedError, whatever the backend.
+    """
+
+    container_name: str
+
+    @abstractmethod
+    async def close(self):
+        """Release the connections held by the store."""
+
+    @abstractmethod
+    async def download_file(self, key: str, filename: os.PathLike) -> int:
+        """Write a blob to a local file and return the number of bytes."""
+
+    @abstractmethod
+    async def upload_file(
+        self,
+        filepath: os.PathLike,
+        prefix: os.PathLike,
+        name: os.PathLike,
+        overwrite: bool = False,
+        content_settings: Optional[ContentSettings] = None,
+    ):
+        """Store a local file as the blob {prefix}/{name}."""
+
+    @abstractmethod
+    async def exists(self, key: str) -> bool:
+        """Check whether a blob exists."""
+
+    @abstractmethod
+    async def copy_blob(self, source_key: str, key: str):
+        """Copy a blob within the container."""
+
+    @abstractmethod
+    async def get_etag(self, key: str) -> str:
+        """Get the ETag of a blob."""
+
+    @abstractmethod
+    async def get_contents(self, key: str) -> bytes:
+        """Get the contents of a blob."""
+
+    @abstractmethod
+    async def get_contents_and_etag(self, key: str) -> Tuple[bytes, str]:
+        """Get the contents of a blob along with the ETag of that version."""
+
+    @abstractmethod
+    async def put_contents(
+        self,
+        key: str,
+        data: bytes,
+        overwrite: bool = False,
+        etag: Optional[str] = None,
+    ):
+        """Write data to a blob, only if it still has etag when one is given."""
+
+
+def open_storage(container_name: str) -> BlobStore:
+    """Create the store for a container with the backend named by APBS_BACKEND.
+
+    Args:
+        container_name (str): The container, e.g. "inputs" or "outputs".
+    Returns:
+        BlobStore: Storage for "azure" (the default), LocalStorage for "local".
+    """
+    backend = getenv("APBS_BACKEND", "azure").lower()
+    if backend == "azure":
+        return Storage.from_environment(container_name)
+    if backend == "local":
+        return LocalStorage.from_environment(container_name)
+    raise ValueError(f"Unknown APBS_BACKEND, {backend}")
+
+
+class Storage(BlobStore):
+    """Wrapper around Azure Blob Storage.
+
+    Every call goes through the asyncio client, so blob I/O does not block
+    the event loop. Call close() when the storage is no longer needed.
+    """
+
+    def __init__(
+        self,
+        container_name: str,
+        blob_service_client: BlobServiceClient,
+        max_concurrency: int = 4,
+    ):
         # self.container_client = container_client
         # self.container_name = container_client.container_name
+        self.max_concurrency = max_concurrency
         self.blob_service_client = blob_service_client
         self.container_client = blob_service_client.get_container_client(container_name)
         self.container_name = container_name
 
     @staticmethod
     def _kwargs_from_env(container_name: str):
-        credential = DefaultAzureCredential()
+        from azure.storage.blob.aio import BlobServiceClient
+
+        connections = shared_connections()
         storage_account_url = getenv("APBS_STORAGE_ACCOUNT_URL")
         if not storage_account_url:
             raise ValueError("APBS_STORAGE_ACCOUNT_URL is not set")
+        chunk_size = parse_size(getenv("APBS_BLOB_CHUNK_SIZE", "4Mi"))
         return {
             "container_name": container_name,
             "blob_service_client": BlobServiceClient(
-                storage_account_url, credential=credential
+                storage_account_url,
+                credential=connections.credential,
+                transport=connections.transport(),
+                max_single_get_size=chunk_size,
+                max_chunk_get_size=chunk_size,
+                max_single_put_size=chunk_size,
+                max_block_size=chunk_size,
             ),
+            "max_concurrency": int(getenv("APBS_BLOB_MAX_CONCURRENCY", "4")),
         }
         # connection_string = getenv("APBS_QUEUE_CONNECTION_STRING")
         # if not connection_string:
@@ -114,19 +550,46 @@ class Storage:
     def update_from_environment(self):
         self.__dict__.update(self._kwargs_from_env(self.container_name))
 
-    def download_file(self, key: str, filename: os.PathLike):
+    async def close(self):
+        """Close the client; the shared credential is closed with the connections."""
+        await self.blob_service_client.close()
+
+    async def download_file(self, key: str, filename: os.PathLike):
+        """Stream a blob into a local file.
+
+        The blob is fetched in chunks of APBS_BLOB_CHUNK_SIZE with up to
+        max_concurrency ranges in flight, and each chunk is written to the
+        file as it arrives. Memory use is therefore bounded by the chunk
+        size times max_concurrency rather than by the size of the blob.
+
+        Args:
+            key (str): The key of the blob to download.
+            filename (os.PathLike): The path to write the blob to.
+        Return:
+            int: The number of bytes written.
+        """
+        blob = self.container_client.get_blob_client(key)
+        try:
+            downloader = await blob.download_blob(max_concurrency=self.max_concurrency)
+        except ResourceNotFoundError:
+            print(f"Can't find blob '{key}' in container '{self.container_name}'")
+            raise
         with open(filename, "wb") as data:
-            data.write(self.get_contents(key))
+            return await downloader.readinto(data)
 
-    def upload_file(
+    async def upload_file(
         self,
         filepath: os.PathLike,
         prefix: os.PathLike,
         name: os.PathLike,
         overwrite: bool = False,
+        content_settings: Optional[ContentSettings] = None,
     ):
         """Upload a file to the storage container.
 
+        Files larger than APBS_BLOB_CHUNK_SIZE are uploaded as blocks,
+        with up to max_concurrency blocks in flight.
+
         Args
         ----
         filename: os.PathLike
@@ -135,13 +598,40 @@ class Storage:
             The prefix to add to the filename.
         overwrite: bool
             Whether to overwrite the file if it already exists.
+        content_settings: ContentSettings
+            Properties such as the MD5 checksum to store with the blob.
         """
         blob = self.container_client.get_blob_client(f"{prefix}/{name}")
         _LOGGER.info(f"Uploading {filepath} to {prefix}/{name}")
         with open(filepath, "rb") as data:
-            return blob.upload_blob(data, overwrite=overwrite)
+            return await blob.upload_blob(
+                data,
+                overwrite=overwrite,
+                content_settings=content_settings,
+                max_concurrency=self.max_concurrency,
+            )
 
-    def get_contents(self, key: str):
+    async def exists(self, key: str) -> bool:
+        """Check whether a blob exists in the container."""
+        return await self.container_client.get_blob_client(key).exists()
+
+    async def copy_blob(self, source_key: str, key: str):
+        """Copy a blob within the container without downloading it.
+
+        The service reads the source by URL, which works because the
+        container it is used with (outputs) allows public reads.
+        """
+        source = self.container_client.get_blob_client(source_key)
+        blob = self.container_client.get_blob_client(key)
+        return await blob.upload_blob_from_url(source.url, overwrite=True)
+
+    async def get_etag(self, key: str) -> str:
+        """Get the ETag of a blob in the container."""
+        blob = self.container_client.get_blob_client(key)
+        properties = await blob.get_blob_properties()
+        return properties.etag
+
+    async def get_contents(self, key: str):
         """Get the contents of a blob in the container.
 
         Args
@@ -162,66 +652,546 @@ class Storage:
         """
         blob = self.container_client.get_blob_client(key)
         try:
-            return blob.download_blob().readall()
+            downloader = await blob.download_blob()
+            return await downloader.readall()
         except ResourceNotFoundError as error:
             print(f"Can't find blob '{key}' in container '{self.container_name}'")
             raise
 
-    def put_contents(self, key: str, data: bytes, overwrite: bool = False):
+    async def get_contents_and_etag(self, key: str) -> Tuple[bytes, str]:
+        """Get the contents of a blob along with the ETag of that version."""
+        blob = self.container_client.get_blob_client(key)
+        downloader = await blob.download_blob()
+        return await downloader.readall(), downloader.properties.etag
+
+    async def put_contents(
+        self,
+        key: str,
+        data: bytes,
+        overwrite: bool = False,
+        etag: Optional[str] = None,
+    ):
+        """Upload data to a blob.
+
+        When etag is given, the upload only succeeds if the blob still has
+        that ETag, otherwise ResourceModifiedError is raised.
+        """
+        from azure.core import MatchConditions
+
         blob = self.container_client.get_blob_client(key)
-        return blob.upload_blob(data, overwrite=overwrite)
+        if etag is None:
+            return await blob.upload_blob(data, overwrite=overwrite)
+        return await blob.upload_blob(
+            data,
+            overwrite=overwrite,
+            etag=etag,
+            match_condition=MatchConditions.IfNotModified,
+        )
+
+
+class LocalStorage(BlobStore):
+    """Blob storage in a local directory, one subdirectory per container.
+
+    Blobs are written to a temporary file that is renamed into place, so
+    readers never see a partial blob. The ETag of a blob is derived from
+    its inode, size and modification time, and conditional writes hold an
+    exclusive lock on the container while they compare it, which also
+    works across processes. Content settings such as Content-Encoding are
+    not recorded.
+    """
+
+    def __init__(self, container_name: str, root: os.PathLike):
+        self.container_name = container_name
+        self.root = (Path(root) / container_name).resolve()
+        makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def _kwargs_from_env(container_name: str):
+        return {
+            "container_name": container_name,
+            "root": getenv("APBS_LOCAL_STORAGE_PATH", "/var/tmp/apbs-storage"),
+        }
+
+    @classmethod
+    def from_environment(cls, container_name: str):
+        return cls(**cls._kwargs_from_env(container_name))
+
+    def _path(self, key: str) -> Path:
+        path = (self.root / key).resolve()
+        if not path.is_relative_to(self.root):
+            raise ValueError(f"Blob key escapes the container, {key}")
+        return path
+
+    def _missing(self, key: str) -> ResourceNotFoundError:
+        return ResourceNotFoundError(
+            f"Can't find blob '{key}' in container '{self.container_name}'"
+        )
+
+    @staticmethod
+    def _etag(stat: os.stat_result) -> str:
+        return f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(self.root / ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _write(self, key: str, write: Callable, overwrite: bool, etag=None):
+        """Atomically replace a blob with what write() puts in a file."""
+        path = self._path(key)
+        makedirs(path.parent, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(prefix=".", dir=path.parent)
+        try:
+            with os.fdopen(handle, "wb") as fout:
+                write(fout)
+            with self._locked():
+                if path.exists() and not overwrite:
+                    raise ResourceExistsError(f"The blob '{key}' already exists")
+                if etag is not None:
+                    if not path.exists():
+                        raise self._missing(key)
+                    if self._etag(path.stat()) != etag:
+                        raise ResourceModifiedError(f"The blob '{key}' has changed")
+                os.replace(temporary, path)
+                return {"etag": self._etag(path.stat())}
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temporary)
+
+    def _read(self, key: str) -> Tuple[bytes, str]:
+        try:
+            with open(self._path(key), "rb") as fin:
+                return fin.read(), self._etag(os.fstat(fin.fileno()))
+        except FileNotFoundError:
+            raise self._missing(key) from None
+
+    async def close(self):
+        pass
+
+    async def download_file(self, key: str, filename: os.PathLike) -> int:
+        path = self._path(key)
+        if not path.is_file():
+            raise self._missing(key)
+        await asyncio.to_thread(copyfile, path, filename)
+        return Path(filename).stat().st_size
+
+    async def upload_file(
+        self,
+        filepath: os.PathLike,
+        prefix: os.PathLike,
+        name: os.PathLike,
+        overwrite: bool = False,
+        content_settings: Optional[ContentSettings] = None,
+    ):
+        def write(fout):
+            with open(filepath, "rb") as fin:
+                copyfileobj(fin, fout, 1024 * 1024)
+
+        return await asyncio.to_thread(
+            self._write, f"{prefix}/{name}", write, overwrite
+        )
+
+    async def exists(self, key: str) -> bool:
+        return self._path(key).is_file()
+
+    async def copy_blob(self, source_key: str, key: str):
+        def write(fout):
+            with open(self._path(source_key), "rb") as fin:
+                copyfileobj(fin, fout, 1024 * 1024)
+
+        if not self._path(source_key).is_file():
+            raise self._missing(source_key)
+        return await asyncio.to_thread(self._write, key, write, True)
+
+    async def get_etag(self, key: str) -> str:
+        try:
+            return self._etag(self._path(key).stat())
+        except FileNotFoundError:
+            raise self._missing(key) from None
+
+    async def get_contents(self, key: str) -> bytes:
+        data, _ = await asyncio.to_thread(self._read, key)
+        return data
+
+    async def get_contents_and_etag(self, key: str) -> Tuple[bytes, str]:
+        return await asyncio.to_thread(self._read, key)
+
+    async def put_contents(
+        self,
+        key: str,
+        data: bytes,
+        overwrite: bool = False,
+        etag: Optional[str] = None,
+    ):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        return await asyncio.to_thread(
+            self._write, key, lambda fout: fout.write(data), overwrite, etag
+        )
+
+
+@dataclass
+class Backoff:
+    """Jittered exponential backoff used while polling an empty queue.
+
+    Each delay is drawn uniformly between min_interval and the current
+    interval, which then grows by factor up to max_interval.
+    """
+
+    min_interval: float = 1.0
+    max_interval: float = 30.0
+    factor: float = 2.0
+
+    def __post_init__(self):
+        self._interval = self.min_interval
+
+    def next_delay(self) -> float:
+        delay = random.uniform(self.min_interval, self._interval)
+        self._interval = min(self._interval * self.factor, self.max_interval)
+        return delay
+
+    def reset(self):
+        self._interval = self.min_interval
+
+
+@dataclass
+class PollingStats:
+    """How long a replica spent waiting for messages versus running jobs.
+
+    Idle and busy time are wall-clock time with no job and with at least
+    one job running, so they add up to the uptime of the replica however
+    many workers it has.
+    """
+
+    idle_seconds: float = 0.0
+    busy_seconds: float = 0.0
+    running: int = 0
+    polls: int = 0
+    empty_polls: int = 0
+    messages: int = 0
+    first_message_at: Optional[float] = None
+    messages_by_queue: Dict[str, int] = field(default_factory=dict)
+    since: float = field(default_factory=time, repr=False)
+
+    def record_poll(self, found: bool, queue_name: Optional[str] = None):
+        self.polls += 1
+        if found:
+            self.messages += 1
+            if self.first_message_at is None:
+                self.first_message_at = time()
+            if queue_name is not None:
+                self.messages_by_queue[queue_name] = (
+                    self.messages_by_queue.get(queue_name, 0) + 1
+                )
+        else:
+            self.empty_polls += 1
+
+    def _advance(self):
+        now = time()
+        if self.running:
+            self.busy_seconds += now - self.since
+        else:
+            self.idle_seconds += now - self.since
+        self.since = now
+
+    def job_started(self):
+        self._advance()
+        self.running += 1
+
+    def job_finished(self):
+        self._advance()
+        self.running -= 1
+
+    def as_dict(self) -> Dict:
+        self._advance()
+        total = self.idle_seconds + self.busy_seconds
+        stats = {
+            "idle_seconds": round(self.idle_seconds, 2),
+            "busy_seconds": round(self.busy_seconds, 2),
+            "idle_fraction": round(self.idle_seconds / total, 3) if total else 0.0,
+            "polls": self.polls,
+            "empty_polls": self.empty_polls,
+            "messages": self.messages,
+        }
+        if self.messages_by_queue:
+            stats["messages_by_queue"] = self.messages_by_queue
+        return stats
+
+
+class LocalQueueClient:
+    """A queue in a SQLite database, for running without Azure.
+
+    It implements the part of the asyncio QueueClient API that Queue uses.
+    A received message is hidden until its visibility timeout passes, each
+    receive hands out a new pop receipt and bumps the dequeue count, and an
+    update or delete with a stale pop receipt raises ResourceNotFoundError,
+    as the service does. Several processes can share a database file; use
+    ":memory:" for a queue that only lives in this process.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages (id TEXT PRIMARY KEY, "
+            "content TEXT, inserted_on REAL, next_visible_on REAL, "
+            "dequeue_count INTEGER, pop_receipt TEXT)"
+        )
+
+    def _transaction(self, func: Callable, *args):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(*args)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    async def _run(self, func: Callable, *args):
+        return await asyncio.to_thread(self._transaction, func, *args)
+
+    @staticmethod
+    def _message(row) -> QueueMessage:
+        from azure.storage.queue import QueueMessage
+
+        id_, content, inserted_on, next_visible_on, dequeue_count, pop_receipt = row
+        return QueueMessage(
+            content,
+            id=id_,
+            inserted_on=datetime.fromtimestamp(inserted_on, timezone.utc),
+            next_visible_on=datetime.fromtimestamp(next_visible_on, timezone.utc),
+            dequeue_count=dequeue_count,
+            pop_receipt=pop_receipt,
+        )
+
+    def _send(self, content: str, visibility_timeout: int) -> QueueMessage:
+        now = time()
+        row = (str(uuid.uuid4()), content, now, now + visibility_timeout, 0, None)
+        self._db.execute("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)", row)
+        return self._message(row)
+
+    def _receive(self, max_messages: int, visibility_timeout: int):
+        now = time()
+        rows = self._db.execute(
+            "SELECT * FROM messages WHERE next_visible_on <= ? "
+            "ORDER BY inserted_on LIMIT ?",
+            (now, max_messages),
+        ).fetchall()
+        messages = []
+        for row in rows:
+            receipt = str(uuid.uuid4())
+            visible = now + visibility_timeout
+            self._db.execute(
+                "UPDATE messages SET next_visible_on = ?, pop_receipt = ?, "
+                "dequeue_count = dequeue_count + 1 WHERE id = ?",
+                (visible, receipt, row[0]),
+            )
+            messages.append(self._message(row[:3] + (visible, row[4] + 1, receipt)))
+        return messages
+
+    def _update(
+        self,
+        message_id: str,
+        pop_receipt: str,
+        visibility_timeout: int,
+        content: Optional[str] = None,
+    ):
+        row = self._db.execute(
+            "SELECT * FROM messages WHERE id = ? AND pop_receipt = ?",
+            (message_id, pop_receipt),
+        ).fetchone()
+        if row is None:
+            raise ResourceNotFoundError(f"Message {message_id} was not found")
+        receipt = str(uuid.uuid4())
+        visible = time() + visibility_timeout
+        if content is None:
+            content = row[1]
+        self._db.execute(
+            "UPDATE messages SET content = ?, next_visible_on = ?, pop_receipt = ? "
+            "WHERE id = ?",
+            (content, visible, receipt, message_id),
+        )
+        return self._message((row[0], content, row[2], visible, row[4], receipt))
+
+    def _delete(self, message_id: str, pop_receipt: str):
+        deleted = self._db.execute(
+            "DELETE FROM messages WHERE id = ? AND pop_receipt = ?",
+            (message_id, pop_receipt),
+        ).rowcount
+        if not deleted:
+            raise ResourceNotFoundError(f"Message {message_id} was not found")
+
+    async def send_message(self, content: str, visibility_timeout: int = 0):
+        return await self._run(self._send, content, visibility_timeout)
+
+    async def receive_message(self, visibility_timeout: Optional[int] = None):
+        messages = await self._run(self._receive, 1, visibility_timeout or 30)
+        return messages[0] if messages else None
+
+    async def receive_messages(
+        self,
+        messages_per_page: Optional[int] = None,
+        max_messages: Optional[int] = None,
+        visibility_timeout: Optional[int] = None,
+    ):
+        messages = await self._run(
+            self._receive, max_messages or 1, visibility_timeout or 30
+        )
+        for message in messages:
+            yield message
+
+    async def update_message(
+        self,
+        message: QueueMessage,
+        pop_receipt: Optional[str] = None,
+        content: Optional[str] = None,
+        visibility_timeout: Optional[int] = None,
+    ) -> QueueMessage:
+        return await self._run(
+            self._update,
+            message.id,
+            pop_receipt or message.pop_receipt,
+            visibility_timeout or 0,
+            content,
+        )
+
+    async def delete_message(
+        self, message: QueueMessage, pop_receipt: Optional[str] = None
+    ):
+        await self._run(self._delete, message.id, pop_receipt or message.pop_receipt)
+
+    async def close(self):
+        self._db.close()
 
 
 class Queue:
-    """Wrapper around Azure Storage Queue."""
+    """Wrapper around Azure Storage Queue, or a LocalQueueClient.
+
+    Messages are received in batches of up to `prefetch` (the service
+    allows at most 32 per call) and kept in a local buffer. A buffered
+    message keeps the lease it was received with until it is handed out
+    or until half of the lease is left. At that point the lease is
+    extended if the worker is expected to reach the message within one
+    more lease, otherwise the message is released (visibility 0) so
+    another replica can pick it up. Until two messages have been handed
+    out there is no estimate of when the worker will reach a message, so
+    it is released.
+
+    Receiving a message bumps its dequeue count, even if it is released
+    without running. Each release is therefore counted in the job info of
+    the message (RELEASES_KEY), and job_attempts discounts them, so a job
+    is not taken for a poison message because it was prefetched a few
+    times. The prefetch defaults to the number of concurrent jobs and is
+    at most twice that, so a replica does not hide messages from the
+    queue-length scaler that it cannot run soon.
+    """
+
+    MAX_BATCH_SIZE = 32
+    RELEASES_KEY = "prefetch_releases"
 
     def __init__(
         self,
         queue: QueueClient,
-        max_tries: int,
         visibility_timeout: int,
-        retry_time: int,
+        idle_budget: float,
+        backoff: Backoff,
+        prefetch: int = 1,
+        name: Optional[str] = None,
     ):
         self.queue = queue
-        self.max_tries = max_tries
+        self.name = name
         self.visibility_timeout = visibility_timeout
-        self.retry_time = retry_time
+        self.idle_budget = idle_budget
+        self.backoff = backoff
+        self.prefetch = prefetch
+        self.stats = PollingStats()
+        self._buffer: Deque[QueueMessage] = deque()
+        self._lock = asyncio.Lock()
+        self._poll_lock = asyncio.Lock()
+        self._last_handout: Optional[float] = None
+        self._handout_interval: Optional[float] = None
 
     def __repr__(self):
         return (
-            f"Queue(queue={self.queue}, max_tries={self.max_tries}, "
+            f"Queue(queue={self.queue}, "
             f"visibility_timeout={self.visibility_timeout}, "
-            f"retry_time={self.retry_time})"
+            f"idle_budget={self.idle_budget}, backoff={self.backoff}, "
+            f"prefetch={self.prefetch})"
         )
 
     @staticmethod
-    def _kwargs_from_env():
-        credential = DefaultAzureCredential()
-        storage_queue_name = getenv("APBS_QUEUE_NAME")
+    def _client_from_env(queue_name: Optional[str] = None):
+        """Create the queue client for the backend named by APBS_BACKEND.
+
+        Args:
+            queue_name (str): The queue to use instead of APBS_QUEUE_NAME.
+                With the local backend it names a database next to
+                APBS_LOCAL_QUEUE_PATH.
+        """
+        backend = getenv("APBS_BACKEND", "azure").lower()
+        if backend == "local":
+            path = getenv("APBS_LOCAL_QUEUE_PATH", "/var/tmp/apbs-queue.sqlite")
+            if queue_name:
+                root, extension = os.path.splitext(path)
+                path = f"{root}-{queue_name}{extension}"
+            return LocalQueueClient(path)
+        if backend != "azure":
+            raise ValueError(f"Unknown APBS_BACKEND, {backend}")
+        from azure.storage.queue.aio import QueueClient
+
+        connections = shared_connections()
+        storage_queue_name = queue_name or getenv("APBS_QUEUE_NAME")
         if not storage_queue_name:
             raise ValueError("APBS_QUEUE_NAME is not set")
         queue_url = getenv("APBS_QUEUE_URL")
         if not queue_url:
             raise ValueError("APBS_QUEUE_URL is not set")
         queue_client = QueueClient(
-            queue_url, queue_name=storage_queue_name, credential=credential
+            queue_url,
+            queue_name=storage_queue_name,
+            credential=connections.credential,
+            transport=connections.transport(),
         )
+        return queue_client
+
+    @staticmethod
+    def _kwargs_from_env(queue_name: Optional[str] = None):
         dct = {
-            "queue": queue_client,
-            "max_tries": int(getenv("MAX_TRIES", "60")),
-            "retry_time": int(getenv("RETRY_TIME", "15")),
+            "queue": Queue._client_from_env(queue_name),
+            "name": queue_name,
+            "idle_budget": float(getenv("IDLE_BUDGET", "300")),
+            "backoff": Backoff(
+                min_interval=float(getenv("POLL_MIN_INTERVAL", "1")),
+                max_interval=float(getenv("POLL_MAX_INTERVAL", "30")),
+                factor=float(getenv("POLL_BACKOFF_FACTOR", "2")),
+            ),
             "visibility_timeout": int(getenv("Q_TIMEOUT", "300")),
+            "prefetch": Queue.prefetch_from_env(),
         }
-        dct["max_tries"] = 3  # TODO DEBUG TESTING
-        dct["retry_time"] = 1  # TODO DEBUG TESTING
         return dct
 
+    @staticmethod
+    def prefetch_from_env() -> int:
+        """APBS_QUEUE_PREFETCH, by default and at most twice the concurrency."""
+        concurrency = get_max_concurrent_jobs()
+        prefetch = int(getenv("APBS_QUEUE_PREFETCH", "0")) or concurrency
+        return max(1, min(prefetch, 2 * concurrency, Queue.MAX_BATCH_SIZE))
+
     @classmethod
-    def from_environment(cls):
-        return cls(**cls._kwargs_from_env())
+    def from_environment(cls, queue_name: Optional[str] = None):
+        return cls(**cls._kwargs_from_env(queue_name))
 
     def update_from_environment(self):
-        self.__dict__.update(self._kwargs_from_env())
+        self.__dict__.update(self._kwargs_from_env(self.name))
 
     def extract_jobinfo(self, message):
         content = message.content
@@ -236,46 +1206,432 @@ class Queue:
             )
             raise
 
-    def mark_message_completed(self, message):
-        self.queue.delete_message(message)
+    async def close(self):
+        """Close the client; the shared credential is closed with the connections."""
+        await self.queue.close()
+
+    async def mark_message_completed(self, message):
+        await self.queue.delete_message(message)
 
-    def requeue_message(self, message):
+    async def requeue_message(self, message):
         content = message.content
-        self.queue.send_message(content)
-        self.queue.delete_message(message)
+        await self.queue.send_message(content)
+        await self.queue.delete_message(message)
 
-    def set_visibility_timeout(self, message, timeout):
-        self.queue.update_message(message, visibility_timeout=timeout)
+    async def route(self, message, size: JobSize) -> Optional[str]:
+        """Forward a job that belongs on another queue; see WeightedQueues.
 
-    def _get_single_message(self):
-        return self.queue.receive_message(visibility_timeout=self.visibility_timeout)
+        A single queue has nowhere to forward jobs to.
+        """
+        return None
 
-    def get_message(self):
-        message = None
-        tries = 0
-        while message is None and tries < self.max_tries:
-            tries += 1
-            message = self._get_single_message()
-            if message is None:
-                _LOGGER.info(f"No message ({tries})")
-                sleep(self.retry_time)
+    async def set_visibility_timeout(self, message, timeout):
+        """Change the visibility timeout of a message.
 
+        Updating a message invalidates its pop receipt, so the new receipt
+        and visibility time are copied onto the message that was passed in.
+        """
+        updated = await self.queue.update_message(message, visibility_timeout=timeout)
+        message.pop_receipt = updated.pop_receipt
+        message.next_visible_on = updated.next_visible_on
         return message
 
+    async def release(self, message):
+        """Make a message visible again, counting the release in its content.
 
-class JobMetrics:
-    """
-    A way to collect metrics from a subprocess.
+        Content that is not a job is released unchanged.
+        """
+        content = message.content
+        try:
+            job_info = loads(base64.b64decode(content).decode("utf-8"))
+        except (ValueError, TypeError):
+            job_info = None
+        if isinstance(job_info, dict):
+            job_info[self.RELEASES_KEY] = job_info.get(self.RELEASES_KEY, 0) + 1
+            content = base64.b64encode(dumps(job_info).encode("utf-8")).decode()
+        updated = await self.queue.update_message(
+            message, content=content, visibility_timeout=0
+        )
+        message.content = content
+        message.pop_receipt = updated.pop_receipt
+        message.next_visible_on = updated.next_visible_on
 
-    To get memory, we use resource.getrusage(RUSAGE_CHILDREN).
-    To avoid accumulating the memory usage from all subprocesses
-    we subtract the previous rusage values to get a delta for
-    just the current subprocess.
+    @classmethod
+    def without_releases(cls, content: str) -> str:
+        """The content of a message with its release count removed.
 
-    To get the time to run metrics we subtract the start time from
-    the end time (e.g., {jobtype}_end_time - {jobtype}_start_time)
+        Used for a copy sent to another queue, where the job has not been
+        released yet. Content that is not a job is returned unchanged.
+        """
+        try:
+            job_info = loads(base64.b64decode(content).decode("utf-8"))
+        except (ValueError, TypeError):
+            return content
+        if not isinstance(job_info, dict) or cls.RELEASES_KEY not in job_info:
+            return content
+        del job_info[cls.RELEASES_KEY]
+        return base64.b64encode(dumps(job_info).encode("utf-8")).decode()
+
+    @staticmethod
+    def _lease_remaining(message) -> float:
+        """The number of seconds until a message becomes visible again."""
+        if message.next_visible_on is None:
+            return 0.0
+        return (message.next_visible_on - datetime.now(timezone.utc)).total_seconds()
+
+    async def _fill_buffer(self):
+        """Receive a batch of messages into the local buffer."""
+        batch_size = min(self.prefetch, self.MAX_BATCH_SIZE)
+        if batch_size <= 1:
+            message = await self.queue.receive_message(
+                visibility_timeout=self.visibility_timeout
+            )
+            if message is not None:
+                self._buffer.append(message)
+            return
+        messages = self.queue.receive_messages(
+            messages_per_page=batch_size,
+            max_messages=batch_size,
+            visibility_timeout=self.visibility_timeout,
+        )
+        self._buffer.extend([message async for message in messages])
+        if len(self._buffer) > 1:
+            _LOGGER.info("Prefetched %s messages", len(self._buffer))
+
+    async def warm_up(self):
+        """Receive the first batch early, so it overlaps with the rest of start-up."""
+        try:
+            async with self._lock:
+                if not self._buffer:
+                    await self._fill_buffer()
+        except Exception as error:
+            _LOGGER.warning("First poll failed, the workers will retry: %s", error)
+
+    async def _renew_or_release(self, message, position: int) -> bool:
+        """Decide what to do with a buffered message whose lease is running out.
+
+        Args:
+            message (QueueMessage): The buffered message.
+            position (int): How many messages are ahead of it in the buffer.
+        Return:
+            bool: True if the message was renewed and should stay buffered.
+        """
+        try:
+            if self._handout_interval is not None:
+                expected_wait = (position + 1) * self._handout_interval
+                if expected_wait < self.visibility_timeout:
+                    await self.set_visibility_timeout(message, self.visibility_timeout)
+                    return True
+            _LOGGER.info("Releasing prefetched message %s", message.id)
+            await self.release(message)
+        except (ResourceNotFoundError, HttpResponseError) as error:
+            # The lease already expired and someone else took the message
+            _LOGGER.warning("Lost prefetched message %s: %s", message.id, error)
+        return False
+
+    async def maintain_buffer(self):
+        """Renew or release buffered messages with less than half a lease left."""
+        async with self._lock:
+            kept: Deque[QueueMessage] = deque()
+            for position, message in enumerate(self._buffer):
+                remaining = self._lease_remaining(message)
+                if remaining > self.visibility_timeout / 2:
+                    kept.append(message)
+                elif await self._renew_or_release(message, position):
+                    kept.append(message)
+            self._buffer = kept
+
+    async def release_messages(self):
+        """Make every buffered message visible to other consumers again."""
+        async with self._lock:
+            while self._buffer:
+                message = self._buffer.popleft()
+                try:
+                    await self.release(message)
+                except (ResourceNotFoundError, HttpResponseError) as error:
+                    _LOGGER.warning(
+                        "Unable to release message %s: %s", message.id, error
+                    )
+
+    async def _get_single_message(self):
+        async with self._lock:
+            if not self._buffer:
+                await self._fill_buffer()
+            while self._buffer:
+                message = self._buffer.popleft()
+                if self._lease_remaining(message) > self.visibility_timeout / 2:
+                    break
+                if await self._renew_or_release(message, 0):
+                    break
+            else:
+                return None
+            now = time()
+            if self._last_handout is not None:
+                interval = now - self._last_handout
+                if self._handout_interval is None:
+                    self._handout_interval = interval
+                else:
+                    self._handout_interval = (
+                        0.8 * self._handout_interval + 0.2 * interval
+                    )
+            self._last_handout = now
+            return message
+
+    async def get_message(self):
+        """Wait for the next message.
+
+        The queue is polled with jittered exponential backoff, which resets
+        to the fastest interval whenever a message arrives. If no message
+        shows up within idle_budget seconds, None is returned so the
+        replica can exit.
+
+        Only one worker polls at a time; the others wait for it to find a
+        message, so idle workers do not multiply the empty polls. The
+        wait counts towards their idle budget.
+        """
+        start = time()
+        async with self._poll_lock:
+            while True:
+                message = await self._get_single_message()
+                self.stats.record_poll(message is not None)
+                elapsed = time() - start
+                if message is not None:
+                    self.backoff.reset()
+                    return message
+                if elapsed >= self.idle_budget:
+                    return None
+                delay = min(self.backoff.next_delay(), self.idle_budget - elapsed)
+                _LOGGER.info("No message, polling again in %.1f seconds", delay)
+                await asyncio.sleep(delay)
+
+
+class WeightedQueues:
+    """Several Queues polled in proportion to their weights.
+
+    APBS_QUEUE_NAMES lists the queues as name:weight pairs, for example
+    "interactive:8,small:4,large:1". Every poll tries all of the queues,
+    starting with the one picked by a smooth weighted round robin: a queue
+    with waiting messages goes first in weight / total of the polls, so no
+    queue is starved by a busier one, and an otherwise idle worker still
+    takes whatever work there is.
+
+    A job that arrived on any queue but APBS_LARGE_JOB_QUEUE and whose
+    estimated size (see estimate_job_size) exceeds APBS_LARGE_JOB_ATOMS or
+    APBS_LARGE_JOB_GRID_POINTS is forwarded to the large-job queue instead
+    of being run, so a long APBS run does not hold up the short jobs
+    behind it.
+
+    It offers the same methods as Queue, and remembers which queue each
+    message came from.
+    """
+
+    def __init__(
+        self,
+        queues: Dict[str, Queue],
+        weights: Dict[str, int],
+        idle_budget: float,
+        backoff: Backoff,
+        large_queue: Optional[str] = None,
+        large_atoms: int = 50000,
+        large_grid_points: int = 2000000,
+    ):
+        if large_queue is not None and large_queue not in queues:
+            raise ValueError(f"Unknown large job queue, {large_queue}")
+        self.queues = queues
+        self.weights = weights
+        self.idle_budget = idle_budget
+        self.backoff = backoff
+        self.large_queue = large_queue
+        self.large_atoms = large_atoms
+        self.large_grid_points = large_grid_points
+        self.stats = PollingStats()
+        self._poll_lock = asyncio.Lock()
+        self._credit = dict.fromkeys(weights, 0)
+        self._sources: Dict[str, str] = {}
+
+    def __repr__(self):
+        return (
+            f"WeightedQueues(weights={self.weights}, "
+            f"large_queue={self.large_queue}, large_atoms={self.large_atoms}, "
+            f"large_grid_points={self.large_grid_points})"
+        )
+
+    @staticmethod
+    def parse_weights(value: str) -> Dict[str, int]:
+        """Parse "name:weight,name,..." into weights; the default weight is 1."""
+        weights = {}
+        for entry in value.split(","):
+            name, _, weight = entry.strip().partition(":")
+            if name:
+                weights[name] = max(1, int(weight or 1))
+        return weights
+
+    @staticmethod
+    def _kwargs_from_env():
+        weights = WeightedQueues.parse_weights(getenv("APBS_QUEUE_NAMES", ""))
+        if not weights:
+            raise ValueError("APBS_QUEUE_NAMES is not set")
+        queues = {name: Queue.from_environment(name) for name in weights}
+        first = next(iter(queues.values()))
+        return {
+            "queues": queues,
+            "weights": weights,
+            "idle_budget": first.idle_budget,
+            "backoff": first.backoff,
+            "large_queue": getenv("APBS_LARGE_JOB_QUEUE") or None,
+            "large_atoms": int(getenv("APBS_LARGE_JOB_ATOMS", "50000")),
+            "large_grid_points": int(getenv("APBS_LARGE_JOB_GRID_POINTS", "2000000")),
+        }
+
+    @classmethod
+    def from_environment(cls):
+        return cls(**cls._kwargs_from_env())
+
+    @property
+    def visibility_timeout(self) -> int:
+        return max(queue.visibility_timeout for queue in self.queues.values())
+
+    def _source(self, message) -> Queue:
+        return self.queues[self._sources[message.id]]
+
+    def _poll_order(self) -> List[str]:
+        """The queues in the order to try them, by smooth weighted round robin."""
+        for name, weight in self.weights.items():
+            self._credit[name] += weight
+        first = max(self._credit, key=self._credit.get)
+        self._credit[first] -= sum(self.weights.values())
+        rest = sorted(self.weights, key=self.weights.get, reverse=True)
+        return [first] + [name for name in rest if name != first]
+
+    def extract_jobinfo(self, message):
+        return self._source(message).extract_jobinfo(message)
+
+    async def close(self):
+        await asyncio.gather(*(queue.close() for queue in self.queues.values()))
+
+    async def mark_message_completed(self, message):
+        await self._source(message).mark_message_completed(message)
+        self._sources.pop(message.id, None)
+
+    async def requeue_message(self, message):
+        await self._source(message).requeue_message(message)
+        self._sources.pop(message.id, None)
+
+    async def set_visibility_timeout(self, message, timeout):
+        return await self._source(message).set_visibility_timeout(message, timeout)
+
+    async def route(self, message, size: JobSize) -> Optional[str]:
+        """Forward a large job to the large-job queue.
+
+        Only a copy is sent, without the releases counted on this queue; the
+        caller deletes the original message as it would for a job that ran.
+
+        Args:
+            message (QueueMessage): The message of the job.
+            size (JobSize): The estimated size of the job.
+        Return:
+            str: The queue the job was forwarded to, or None to run it here.
+        """
+        source = self._sources.get(message.id)
+        if (
+            self.large_queue is None
+            or source == self.large_queue
+            or not size.exceeds(self.large_atoms, self.large_grid_points)
+        ):
+            return None
+        try:
+            await self.queues[self.large_queue].queue.send_message(
+                Queue.without_releases(message.content)
+            )
+        except HttpResponseError as error:
+            _LOGGER.warning(
+                "Unable to forward message %s to %s, running it here: %s",
+                message.id,
+                self.large_queue,
+                error,
+            )
+            return None
+        _LOGGER.info(
+            "Forwarded message %s with %s from %s to %s",
+            message.id,
+            size,
+            source,
+            self.large_queue,
+        )
+        return self.large_queue
+
+    async def warm_up(self):
+        await asyncio.gather(*(queue.warm_up() for queue in self.queues.values()))
+
+    async def maintain_buffer(self):
+        for queue in self.queues.values():
+            await queue.maintain_buffer()
+
+    async def release_messages(self):
+        for queue in self.queues.values():
+            await queue.release_messages()
+
+    async def _get_single_message(self):
+        for name in self._poll_order():
+            message = await self.queues[name]._get_single_message()
+            if message is not None:
+                self._sources[message.id] = name
+                return name, message
+        return None, None
+
+    async def get_message(self):
+        """Wait for the next message from any of the queues.
+
+        The polling backs off and gives up after idle_budget seconds like
+        Queue.get_message, but only once every queue came up empty, and
+        only one worker polls at a time.
+        """
+        start = time()
+        async with self._poll_lock:
+            while True:
+                name, message = await self._get_single_message()
+                self.stats.record_poll(message is not None, name)
+                elapsed = time() - start
+                if message is not None:
+                    self.backoff.reset()
+                    return message
+                if elapsed >= self.idle_budget:
+                    return None
+                delay = min(self.backoff.next_delay(), self.idle_budget - elapsed)
+                _LOGGER.info("No message, polling again in %.1f seconds", delay)
+                await asyncio.sleep(delay)
+
+
+def open_queue() -> Queue | WeightedQueues:
+    """Open the queues listed in APBS_QUEUE_NAMES, or else APBS_QUEUE_NAME."""
+    if getenv("APBS_QUEUE_NAMES"):
+        return WeightedQueues.from_environment()
+    return Queue.from_environment()
+
+
+class JobMetrics:
+    """
+    A way to collect metrics from a subprocess.
+
+    To get memory, we use resource.getrusage(RUSAGE_CHILDREN).
+    To avoid accumulating the memory usage from all subprocesses
+    we subtract the previous rusage values to get a delta for
+    just the current subprocess.
+
+    To get the time to run metrics we subtract the start time from
+    the end time (e.g., {jobtype}_end_time - {jobtype}_start_time)
+
+    Note that RUSAGE_CHILDREN covers every child of the process, so
+    when several jobs run at once the rusage values of overlapping
+    jobs are included in each other's deltas. ru_maxrss is a high-water
+    mark and is reported as is rather than as a delta; the job's own peak
+    RSS comes from the ResourceSampler when one ran.
+
+    The time spent in each stage of the job (download, status writes,
+    execution, upload, ...) is collected with the stage() context manager.
 
-    To get the disk usage we sum up the stats of all the files in
+    To get the disk usage we sum up the sizes in the output manifest
+    (see scan_outputs) or, without one, the stats of all the files in
     the output directory.
 
     The result for each job will to to output a file named:
@@ -304,6 +1660,7 @@ class JobMetrics:
             },
             "runtime_in_seconds": 262,
             "disk_storage_in_bytes": 4003345,
+            "peak_rss_in_bytes": 1027604480,
         },
     }
     """
@@ -315,6 +1672,18 @@ class JobMetrics:
         self._start_time = 0
         self._end_time = 0
         self.exit_code = None
+        self.disk_usage: Optional[int] = None
+        self.cached_from: Optional[str] = None
+        self.peak_rss: Optional[int] = None
+        self.size: Optional[JobSize] = None
+        self.routed_to: Optional[str] = None
+        self.predicted_rss: Optional[int] = None
+        self.rejected: Optional[str] = None
+        self.max_run_time: Optional[float] = None
+        self.stages: Dict[str, float] = {}
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+        self.status_retries = 0
         self.values: Dict = {}
         self.values["ru_utime"] = metrics.ru_utime
         self.values["ru_stime"] = metrics.ru_stime
@@ -345,7 +1714,7 @@ class JobMetrics:
         metrics = getrusage(RUSAGE_CHILDREN)
         self.values["ru_utime"] = round(metrics.ru_utime - self.values["ru_utime"], 2)
         self.values["ru_stime"] = round(metrics.ru_stime - self.values["ru_stime"], 2)
-        self.values["ru_maxrss"] = metrics.ru_maxrss - self.values["ru_maxrss"]
+        self.values["ru_maxrss"] = metrics.ru_maxrss
         self.values["ru_ixrss"] = metrics.ru_ixrss - self.values["ru_ixrss"]
         self.values["ru_idrss"] = metrics.ru_idrss - self.values["ru_idrss"]
         self.values["ru_isrss"] = metrics.ru_isrss - self.values["ru_isrss"]
@@ -361,6 +1730,15 @@ class JobMetrics:
         self.values["ru_nivcsw"] = metrics.ru_nivcsw - self.values["ru_nivcsw"]
         return self.values
 
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Add the time spent in the with block to the named stage."""
+        start = time()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time() - start
+
     def get_storage_usage(self):
         """Get the total number of bytes of the output files.
 
@@ -414,13 +1792,32 @@ class JobMetrics:
         metrics = {
             "metrics": {"rusage": {}},
         }
-        disk_usage = self.get_storage_usage()
+        disk_usage = self.disk_usage
+        if disk_usage is None:
+            disk_usage = self.get_storage_usage()
         metrics["metrics"]["rusage"] = self.get_rusage_delta()
         metrics["metrics"]["runtime_in_seconds"] = round(
             self.end_time - self.start_time, 2
         )
         metrics["metrics"]["disk_storage_in_bytes"] = disk_usage
+        metrics["metrics"]["peak_rss_in_bytes"] = self.peak_rss
+        if self.predicted_rss is not None:
+            metrics["metrics"]["predicted_peak_rss_in_bytes"] = self.predicted_rss
+        if self.max_run_time is not None:
+            metrics["metrics"]["max_run_time_in_seconds"] = self.max_run_time
+        if self.size is not None:
+            metrics["metrics"]["estimated_size"] = {
+                "atoms": self.size.atoms,
+                "grid_points": self.size.grid_points,
+            }
+        metrics["metrics"]["stages_in_seconds"] = {
+            name: round(seconds, 3) for name, seconds in self.stages.items()
+        }
         metrics["metrics"]["exit_code"] = self.exit_code
+        metrics["metrics"]["result_cache"] = {
+            "hit": self.cached_from is not None,
+            "cached_from": self.cached_from,
+        }
         return metrics
 
     def write_metrics(self, job_tag: str, job_type: str, output_dir: str):
@@ -430,7 +1827,7 @@ class JobMetrics:
             job_type (str): Either "apbs" or "pdb2pqr".
             output_dir (str): The directory to find the output files.
         Returns:
-            N/A
+            Path: The path of the metrics file.
         """
         self.output_dir = Path(output_dir)
         metrics = self.get_metrics()
@@ -441,201 +1838,1331 @@ class JobMetrics:
             metrics["metrics"]["exit_code"],
             metrics,
         )
-        with open(f"{job_type}-metrics.json", "w") as fout:
+        metrics_path = self.output_dir / f"{job_type}-metrics.json"
+        with open(metrics_path, "w") as fout:
             fout.write(dumps(metrics, indent=4))
+        return metrics_path
 
 
-def print_current_state():
-    # DWHS TODO -- see if this can be changed (remove globals?)
-    for idx in sorted(GLOBAL_VARS):
-        _LOGGER.info("VAR: %s, VALUE: %s", idx, GLOBAL_VARS[idx])
-        print(f"VAR: {idx}, VALUE: set to: {GLOBAL_VARS[idx]}", file=stderr)
-    _LOGGER.info("PROCESSING state: %s", PROCESSING)
-    print(f"PROCESSING state: {PROCESSING}\n", file=stderr)
+class Telemetry:
+    """Aggregate stage timings and counters across the jobs of a worker.
 
+    Each finished job adds its stage timings to a histogram per stage and
+    bumps the counters. If settings.metrics_textfile is set, the totals are
+    rewritten there in the OpenMetrics text format after every job, for a
+    local scraper (e.g. the node exporter's textfile collector). If
+    settings.metrics_jsonl is set, one JSON line per job is appended there.
+    """
 
-def receive_signal(signal_number, frame):
-    _LOGGER.info("Received signal: %s, %s", signal_number, frame)
-    print(f"Received signal: {signal_number}, {frame}", file=stderr)
-    signal_help(signal_number, frame)
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+    COUNTERS = {
+        "jobs": "Jobs finished, by outcome",
+        "message_retries": "Messages received again after an earlier attempt",
+        "poison_messages": "Messages removed after too many attempts",
+        "routed_jobs": "Jobs forwarded to the large job queue",
+        "status_write_retries": "Status writes retried after an ETag conflict",
+        "downloaded_bytes": "Bytes of input files staged",
+        "uploaded_bytes": "Bytes of output files stored",
+    }
 
+    def __init__(
+        self,
+        textfile: Optional[os.PathLike] = None,
+        jsonl: Optional[os.PathLike] = None,
+    ):
+        self.textfile = textfile
+        self.jsonl = jsonl
+        self.counters: Dict[Tuple[str, str], float] = {}
+        self.histograms: Dict[str, List] = {}
+        self.gauges: Dict[str, float] = {}
+        self.process_started = process_start_time() or time()
 
-def signal_help(signal_number, frame):
-    # pylint: disable=unused-argument
-    print("\n", file=stderr)
-    print(f"RECEIVED SIGNAL: {signal_number}\n\n", file=stderr)
-    print("\tYou have asked for help:\n\n", file=stderr)
-    print(
-        f"\tTo update environment variables, type: kill -USR1 {getpid()}\n\n",
-        file=stderr,
-    )
-    print(f"\tTo toggle processing, type: kill -USR2 {getpid()}\n\n", file=stderr)
-    print_current_state()
+    @classmethod
+    def from_settings(cls, settings: Settings):
+        return cls(settings.metrics_textfile, settings.metrics_jsonl)
+
+    def mark_startup(self, stage: str):
+        """Record how long after the process started a startup stage ended."""
+        name = f"{stage}_seconds"
+        if name in self.gauges:
+            return
+        self.gauges[name] = round(time() - self.process_started, 3)
+        _LOGGER.info("STARTUP: %s after %.2f seconds", stage, self.gauges[name])
+
+    def count(self, name: str, value: float = 1, label: str = ""):
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, stage: str, seconds: float):
+        histogram = self.histograms.setdefault(
+            stage, [[0] * (len(self.BUCKETS) + 1), 0.0]
+        )
+        index = next(
+            (i for i, bound in enumerate(self.BUCKETS) if seconds <= bound),
+            len(self.BUCKETS),
+        )
+        histogram[0][index] += 1
+        histogram[1] += seconds
 
+    def record_job(
+        self,
+        job_tag: str,
+        job_type: str,
+        metrics: JobMetrics,
+        code: int,
+        dequeue_count: int = 1,
+    ):
+        """Add a finished job to the totals and export them."""
+        for stage, seconds in metrics.stages.items():
+            self.observe(stage, seconds)
+        outcome = "success" if code == 0 else "failure"
+        if metrics.cached_from:
+            outcome = "cached"
+        elif metrics.rejected:
+            outcome = "rejected"
+        elif metrics.max_run_time and code == TIMEOUT_EXIT_CODE:
+            outcome = "timeout"
+        self.count("jobs", label=outcome)
+        if dequeue_count and dequeue_count > 1:
+            self.count("message_retries")
+        self.count("status_write_retries", metrics.status_retries)
+        self.count("downloaded_bytes", metrics.bytes_downloaded)
+        self.count("uploaded_bytes", metrics.bytes_uploaded)
+        if self.jsonl:
+            line = {
+                "job_tag": job_tag,
+                "job_type": job_type,
+                "exit_code": code,
+                "outcome": outcome,
+                "dequeue_count": dequeue_count,
+                "stages_in_seconds": {
+                    name: round(seconds, 3) for name, seconds in metrics.stages.items()
+                },
+                "status_write_retries": metrics.status_retries,
+                "downloaded_bytes": metrics.bytes_downloaded,
+                "uploaded_bytes": metrics.bytes_uploaded,
+                "peak_rss_in_bytes": metrics.peak_rss,
+                "predicted_peak_rss_in_bytes": metrics.predicted_rss,
+                "timestamp": time(),
+            }
+            with open(self.jsonl, "a") as fout:
+                fout.write(dumps(line) + "\n")
+        self.export()
+
+    def render(self) -> str:
+        """Format the totals in the OpenMetrics text format."""
+        lines = [
+            "# TYPE apbs_stage_seconds histogram",
+            "# HELP apbs_stage_seconds Time spent in each stage of a job.",
+        ]
+        for stage, (buckets, total) in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, value in zip(self.BUCKETS + (math.inf,), buckets):
+                cumulative += value
+                le = "+Inf" if bound == math.inf else str(bound)
+                lines.append(
+                    f'apbs_stage_seconds_bucket{{stage="{stage}",le="{le}"}} '
+                    f"{cumulative}"
+                )
+            lines.append(f'apbs_stage_seconds_count{{stage="{stage}"}} {cumulative}')
+            lines.append(f'apbs_stage_seconds_sum{{stage="{stage}"}} {total:.3f}')
+        for name, description in self.COUNTERS.items():
+            lines.append(f"# TYPE apbs_{name} counter")
+            lines.append(f"# HELP apbs_{name} {description}.")
+            for (key, label), value in sorted(self.counters.items()):
+                if key != name:
+                    continue
+                labels = f'{{outcome="{label}"}}' if label else ""
+                lines.append(f"apbs_{name}_total{labels} {value:g}")
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f"# TYPE apbs_{name} gauge")
+            lines.append(f"apbs_{name} {value:g}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        """Atomically rewrite the textfile, if one is configured."""
+        if not self.textfile:
+            return
+        temporary = f"{self.textfile}.{getpid()}.tmp"
+        with open(temporary, "w") as fout:
+            fout.write(self.render())
+        os.replace(temporary, self.textfile)
 
-def terminate_process(signal_number, frame):
-    # pylint: disable=unused-argument
-    print("Caught (SIGTERM) terminating the process\n", file=stderr)
-    sys.exit()
 
+@dataclass
+class OutputFile:
+    """A file in a job's run directory, as listed in the output manifest."""
 
-def toggle_processing(signal_number, frame):
-    # pylint: disable=unused-argument
-    global PROCESSING
-    PROCESSING = not PROCESSING
-    _LOGGER.info("PROCESSING set to: %s", PROCESSING)
-    print(f"PROCESSING set to:{PROCESSING}\n", file=stderr)
+    name: str
+    path: Path
+    size: int
+    md5: Optional[bytes] = None
+    mtime_ns: int = 0
+    content_encoding: Optional[str] = None
+    stored_size: Optional[int] = None
 
+    @classmethod
+    def from_path(cls, rundir: Path, path: Path):
+        stat = path.stat()
+        return cls(
+            name=path.relative_to(rundir).as_posix(),
+            path=path,
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+        )
 
-def update_environment(signal_number, frame):
-    pass
-    # DWHS TODO -- update to remove AWS-specific stuff
-    # pylint: disable=unused-argument
-    # TODO: This may need to be increased or calculated based
-    #       on complexity of the job (dimension of molecule?)
-    #       The job could get launched multiple times if the
-    #       job takes longer than Q_TIMEOUT
-    # global GLOBAL_VARS
-    # GLOBAL_VARS["Q_TIMEOUT"] = int(getenv("SQS_QUEUE_TIMEOUT", "300"))
-    # GLOBAL_VARS["AWS_REGION"] = getenv("SQS_AWS_REGION", "us-west-2")
-    # GLOBAL_VARS["MAX_TRIES"] = int(getenv("SQS_MAX_TRIES", "60"))
-    # GLOBAL_VARS["RETRY_TIME"] = int(getenv("SQS_RETRY_TIME", "15"))
-    # GLOBAL_VARS["LOG_LEVEL"] = int(getenv("LOG_LEVEL", str(INFO)))
-    # GLOBAL_VARS["JOB_PATH"] = getenv("JOB_PATH", "/var/tmp/")
-    # GLOBAL_VARS["S3_TOPLEVEL_BUCKET"] = getenv("OUTPUT_BUCKET")
-    # GLOBAL_VARS["QUEUE"] = getenv("JOB_QUEUE_NAME")
-    # _LOGGER.setLevel(GLOBAL_VARS["LOG_LEVEL"])
+    def as_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "size": self.size,
+            "md5": self.md5.hex() if self.md5 else None,
+            "content_encoding": self.content_encoding,
+            "stored_size": self.stored_size,
+        }
 
-    # if GLOBAL_VARS["S3_TOPLEVEL_BUCKET"] is None:
-    # raise ValueError("Environment variable 'OUTPUT_BUCKET' is not set")
-    # if GLOBAL_VARS["QUEUE"] is None:
-    # raise ValueError("Environment variable 'JOB_QUEUE_NAME' is not set")
 
+def scan_outputs(rundir: Path) -> List[OutputFile]:
+    """List every file under the run directory in a single walk.
 
-def get_messages(sqs, qurl: str) -> Any:
-    # DWHS TODO -- this can probably be removed
-    """Get SQS Messages from the queue.
+    Files that disappear while the directory is walked, such as the
+    temporary files of a running job, are left out.
 
-    :param sqs:  S3 output bucket for the job being updated
-    :type sqs:  boto3.client connection
-    :param qurl:  URL for the SNS Queue to listen for new messages
-    :return:  List of messages from the queue
-    :rtype:  Any
+    Args:
+        rundir (Path): The job's run directory.
+    Returns:
+        List[OutputFile]: The files found, without checksums.
     """
-    loop = 0
+    manifest = []
+    for dirpath, _, filenames in os.walk(rundir):
+        for filename in filenames:
+            try:
+                output = OutputFile.from_path(rundir, Path(dirpath) / filename)
+            except FileNotFoundError:
+                continue
+            manifest.append(output)
+    return manifest
 
-    messages = sqs.receive_message(
-        QueueUrl=qurl,
-        MaxNumberOfMessages=1,
-        VisibilityTimeout=GLOBAL_VARS["Q_TIMEOUT"],
-    )
 
-    while "Messages" not in messages:
-        loop += 1
-        if loop == GLOBAL_VARS["MAX_TRIES"]:
+def process_tree(pid: int) -> List[int]:
+    """Get a process and all of its descendants from /proc.
+
+    Args:
+        pid (int): The process id at the root of the tree.
+    Returns:
+        List[int]: The process ids, or an empty list if pid is gone.
+    """
+    pids = []
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            tasks = listdir(f"/proc/{current}/task")
+        except OSError:
+            continue
+        pids.append(current)
+        for task in tasks:
+            children = _read_cgroup_file(f"/proc/{current}/task/{task}/children")
+            if children:
+                stack.extend(int(child) for child in children.split())
+    return pids
+
+
+def open_files(pids: List[int]) -> Set[str]:
+    """Get the paths of the files the given processes have open."""
+    paths = set()
+    for pid in pids:
+        fd_dir = f"/proc/{pid}/fd"
+        try:
+            fds = listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            with contextlib.suppress(OSError):
+                paths.add(os.readlink(f"{fd_dir}/{fd}"))
+    return paths
+
+
+class ResourceSampler:
+    """Sample the resource usage of a job's process tree over time.
+
+    Every interval seconds the RSS, CPU time, thread count and storage I/O
+    of every process in the tree are read from /proc and summed, together
+    with the container's cgroup memory usage when available. Once
+    max_samples are held, every other sample is dropped and the interval
+    doubles, so long jobs keep a bounded series. The peak RSS also takes
+    each process's VmHWM into account, which catches peaks between samples.
+    """
+
+    COLUMNS = [
+        "elapsed",
+        "rss_bytes",
+        "cpu_percent",
+        "threads",
+        "read_bytes",
+        "write_bytes",
+        "cgroup_memory_bytes",
+    ]
+    CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+    def __init__(self, interval: float = 1.0, max_samples: int = 3600):
+        self.interval = interval
+        self.max_samples = max_samples
+        self.pid: Optional[int] = None
+        self.samples: List[List] = []
+        self.peak_rss = 0
+        self._start = time()
+        self._last: Optional[Tuple[float, int]] = None
+
+    def set_pid(self, pid: int):
+        self.pid = pid
+        self._start = time()
+
+    @staticmethod
+    def _read_process(pid: int) -> Optional[Dict[str, int]]:
+        stat = _read_cgroup_file(f"/proc/{pid}/stat")
+        if not stat:
             return None
-        _LOGGER.debug("Waiting ....")
-        sleep(GLOBAL_VARS["RETRY_TIME"])
-        messages = sqs.receive_message(
-            QueueUrl=qurl,
-            MaxNumberOfMessages=1,
-            VisibilityTimeout=GLOBAL_VARS["Q_TIMEOUT"],
+        fields = stat.rpartition(")")[2].split()
+        values = {
+            "ticks": int(fields[11]) + int(fields[12]),
+            "threads": int(fields[17]),
+            "rss": int(fields[21]) * ResourceSampler.PAGE_SIZE,
+            "hwm": 0,
+            "read_bytes": 0,
+            "write_bytes": 0,
+        }
+        for line in (_read_cgroup_file(f"/proc/{pid}/status") or "").splitlines():
+            if line.startswith("VmHWM:"):
+                values["hwm"] = int(line.split()[1]) * 1024
+        for line in (_read_cgroup_file(f"/proc/{pid}/io") or "").splitlines():
+            key, _, value = line.partition(": ")
+            if key in ("read_bytes", "write_bytes"):
+                values[key] = int(value)
+        return values
+
+    def sample(self):
+        """Record one sample of the process tree."""
+        if self.pid is None:
+            return
+        now = time()
+        totals = dict.fromkeys(
+            ("ticks", "threads", "rss", "read_bytes", "write_bytes"), 0
         )
-    return messages
+        for pid in process_tree(self.pid):
+            values = self._read_process(pid)
+            if values is None:
+                continue
+            for key in totals:
+                totals[key] += values[key]
+            self.peak_rss = max(self.peak_rss, values["hwm"])
+        if not totals["threads"]:
+            return
+        self.peak_rss = max(self.peak_rss, totals["rss"])
+        cpu_percent = 0.0
+        if self._last is not None and now > self._last[0]:
+            cpu_seconds = (totals["ticks"] - self._last[1]) / self.CLOCK_TICKS
+            cpu_percent = max(cpu_seconds, 0) / (now - self._last[0]) * 100
+        self._last = (now, totals["ticks"])
+        cgroup_memory = _read_cgroup_file(
+            "/sys/fs/cgroup/memory.current",
+            "/sys/fs/cgroup/memory/memory.usage_in_bytes",
+        )
+        self.samples.append(
+            [
+                round(now - self._start, 2),
+                totals["rss"],
+                round(cpu_percent, 1),
+                totals["threads"],
+                totals["read_bytes"],
+                totals["write_bytes"],
+                int(cgroup_memory) if cgroup_memory else None,
+            ]
+        )
+        if len(self.samples) >= self.max_samples:
+            self.samples = self.samples[::2]
+            self.interval *= 2
 
+    async def collect(self):
+        """Sample until cancelled."""
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
 
-def update_status(
-    output_storage: Storage,
-    job_tag: str,
-    jobtype: str,
-    status: JOBSTATUS,
-    output_files: List,
-    message: Optional[str] = None,
-) -> Dict:
-    """Update the status file in the S3 bucket for the current job.
+    def write(self, path: Path) -> Path:
+        """Write the time series as JSON, one row per sample.
 
-    :param s3:  S3 output bucket for the job being updated
-    :param job_tag:  Unique ID for this job
-    :param jobtype:  The job type (apbs, pdb2pqr, etc.)
-    :param status:  The job status
-    :param output_files:  List of output files
-    :return:  Response from storing status file in S3 bucket
-    :rtype:  Dict
+        Args:
+            path (Path): The file to write.
+        Returns:
+            Path: The path of the file.
+        """
+        with open(path, "w") as fout:
+            json.dump(
+                {
+                    "interval": self.interval,
+                    "peak_rss_in_bytes": self.peak_rss,
+                    "columns": self.COLUMNS,
+                    "samples": self.samples,
+                },
+                fout,
+                separators=(",", ":"),
+            )
+        return path
+
+
+def file_md5(path: Path) -> bytes:
+    """Compute the MD5 digest of a file without reading it all into memory."""
+    digest = hashlib.md5()
+    with open(path, "rb") as fin:
+        while chunk := fin.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def should_compress(output: OutputFile, settings: Settings) -> bool:
+    """Whether an output is a large text file worth compressing on upload."""
+    return (
+        settings.compress_outputs
+        and output.size >= settings.compress_min_bytes
+        and output.path.suffix.lower() in settings.compress_suffixes
+    )
+
+
+def gzip_file(source: Path, target: Path, level: int = 6) -> Tuple[int, bytes]:
+    """Gzip a file in a single pass, checksumming the compressed bytes.
+
+    Args:
+        source (Path): The file to compress.
+        target (Path): Where to write the gzip stream.
+        level (int): The zlib compression level.
+    Returns:
+        Tuple[int, bytes]: The compressed size and its MD5 digest.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    digest = hashlib.md5()
+    size = 0
+    with open(source, "rb") as fin, open(target, "wb") as fout:
+        while chunk := fin.read(1024 * 1024):
+            data = compressor.compress(chunk)
+            if data:
+                fout.write(data)
+                digest.update(data)
+                size += len(data)
+        data = compressor.flush()
+        fout.write(data)
+        digest.update(data)
+        size += len(data)
+    return size, digest.digest()
+
+
+def bundle_directory(directory: Path, target: Path):
+    """Write a directory to a gzipped tarball as a stream.
+
+    Args:
+        directory (Path): The directory to archive.
+        target (Path): The tarball to create.
     """
-    # load current status from blob storage
-    objectfile = f"{job_tag}/{jobtype}-status.json"
-    storage_bytes = output_storage.get_contents(objectfile)
-    statobj: dict = loads(storage_bytes.decode("utf-8"))
+    with tarfile.open(str(target), mode="w|gz") as tar:
+        tar.add(directory, arcname=directory.name)
 
-    # Update status and timestamps
-    statobj[jobtype]["status"] = status.name.lower()
-    if status == JOBSTATUS.COMPLETE or status == JOBSTATUS.FAILED:
-        statobj[jobtype]["endTime"] = time()
 
-    if status == JOBSTATUS.FAILED and message is not None:
-        statobj[jobtype]["message"] = message
+async def bundle_subdirectories(
+    job_tag: str, job_id: str, rundir: Path, manifest: List[OutputFile]
+) -> List[OutputFile]:
+    """Replace the files in each subdirectory of the run directory with a tarball.
 
-    statobj[jobtype]["outputFiles"] = output_files
+    A subdirectory such as "pdb2pka_output" is uploaded as
+    "{job_id}-pdb2pka_output.tar.gz". The archives are written in threads,
+    one per subdirectory.
 
-    object_response = {}
-    try:
-        object_response: dict = output_storage.put_contents(
-            objectfile,
-            dumps(statobj),
-            overwrite=True,
-        )
-    except Exception as error:
-        _LOGGER.exception(
-            "%s ERROR: Failed to update status file, %s \n\t%s",
-            job_tag,
-            objectfile,
-            error,
+    Args:
+        job_tag (str): The unique job id, for logging.
+        job_id (str): The job id, used to name the tarballs.
+        rundir (Path): The job's run directory.
+        manifest (List[OutputFile]): The files found in the run directory.
+    Returns:
+        List[OutputFile]: The manifest with the bundled files replaced.
+    """
+    subdirectories = sorted(
+        {output.name.split("/")[0] for output in manifest if "/" in output.name}
+    )
+    if not subdirectories:
+        return manifest
+    targets = [rundir / f"{job_id}-{name}.tar.gz" for name in subdirectories]
+    await asyncio.gather(
+        *(
+            asyncio.to_thread(bundle_directory, rundir / name, target)
+            for name, target in zip(subdirectories, targets)
         )
+    )
+    _LOGGER.info(
+        "%s Bundled %s subdirectories: %s", job_tag, len(targets), subdirectories
+    )
+    return [output for output in manifest if "/" not in output.name] + [
+        OutputFile.from_path(rundir, target) for target in targets
+    ]
 
-    return object_response
 
+# The size of the pieces the data block of an OpenDX file is parsed in
+DX_CHUNK_BYTES = 4 * 1024**2
 
-def cleanup_job(job_tag: str, rundir: str, settings: Settings) -> int:
-    """Remove the directory for the job.
 
-    :param rundir:  The local directory where the job is being executed.
-    :return:  int
-    """
-    _LOGGER.info("%s Deleting run directory, %s", job_tag, rundir)
-    chdir(settings.job_path)
-    rmtree(rundir)
-    return 1
+def _split_token(data: bytes) -> Tuple[bytes, bytes]:
+    """Split data before its last token, which may continue in the next chunk."""
+    end = len(data)
+    while end and not data[end - 1 : end].isspace():
+        end -= 1
+    return data[:end], data[end:]
 
 
-async def read_stream(stream, is_stderr=False, output_file=None):
-    while True:
-        line = await stream.readline()
-        if not line:
-            break
-        line_str = line.decode("utf-8").rstrip("\n")
+def read_dx(path: Path) -> Tuple[Dict[str, Any], np.ndarray]:
+    """Read a regular OpenDX grid, as written by APBS.
 
-        if is_stderr:
-            print(line_str, file=sys.stderr, flush=True)
-        else:
-            print(line_str, file=sys.stdout, flush=True)
+    The header is read line by line. The data block is parsed in pieces of
+    DX_CHUNK_BYTES, each in one vectorized call instead of one Python
+    float() per value, straight into a float32 array of the declared
+    size, so a large grid never has its text in memory at once.
 
-        if output_file:
-            output_file.write(line_str + "\n")
-            output_file.flush()
+    Args:
+        path (Path): The .dx file.
+    Returns:
+        Tuple[Dict[str, Any], np.ndarray]: The grid's counts, origin and
+            delta, and the values as a float32 array of shape counts.
+    """
+    import numpy as np
+
+    header = {"counts": None, "origin": None, "delta": []}
+    with open(path, "rb") as fin:
+        while True:
+            line = fin.readline()
+            if not line:
+                raise ValueError(f"No data block in {path}")
+            fields = line.split()
+            if not fields or fields[0].startswith(b"#"):
+                continue
+            if fields[0] == b"object" and b"gridpositions" in fields:
+                header["counts"] = [int(value) for value in fields[-3:]]
+            elif fields[0] == b"origin":
+                header["origin"] = [float(value) for value in fields[1:4]]
+            elif fields[0] == b"delta":
+                header["delta"].append([float(value) for value in fields[1:4]])
+            elif line.rstrip().endswith(b"data follows"):
+                items = int(fields[fields.index(b"items") + 1])
+                break
+        counts = header["counts"]
+        if counts is None or items != int(np.prod(counts)):
+            raise ValueError(f"Expected {counts} grid values in {path}, not {items}")
+        values = np.empty(items, dtype=np.float32)
+        found = 0
+        carry = b""
+        while True:
+            chunk = fin.read(DX_CHUNK_BYTES)
+            data = carry + chunk
+            # The data block ends where the trailing objects begin
+            ends = [
+                data.find(marker) for marker in (b"attribute", b"object", b"component")
+            ]
+            ends = [end for end in ends if end != -1]
+            last = bool(ends) or not chunk
+            if ends:
+                data = data[: min(ends)]
+            elif chunk:
+                data, carry = _split_token(data)
+            if data.strip():
+                parsed = np.fromstring(data, dtype=np.float32, sep=" ")
+            else:
+                # fromstring reads a value from a string of only whitespace
+                parsed = values[:0]
+            if found + parsed.size > items:
+                raise ValueError(f"Expected {items} grid values in {path}, found more")
+            values[found : found + parsed.size] = parsed
+            found += parsed.size
+            if last:
+                break
+    if found != items:
+        raise ValueError(f"Expected {items} grid values in {path}, found {found}")
+    return header, values.reshape(counts)
+
+
+def write_dx_companion(path: Path) -> List[Path]:
+    """Write a float32 .npy copy of a .dx grid with a JSON header beside it.
 
+    Args:
+        path (Path): The .dx file.
+    Returns:
+        List[Path]: The .npy and .json files that were written.
+    """
+    import numpy as np
+
+    header, values = read_dx(path)
+    data_path = path.with_name(f"{path.name}.npy")
+    header_path = path.with_name(f"{path.name}.json")
+    np.save(data_path, values)
+    header.update(
+        {
+            "source": path.name,
+            "data": data_path.name,
+            "dtype": "float32",
+            "order": "C",
+        }
+    )
+    with open(header_path, "w") as fout:
+        json.dump(header, fout)
+    return [data_path, header_path]
 
-async def monitor_termination(process, stop_event):
-    await stop_event.wait()
+
+async def convert_dx_outputs(
+    job_tag: str, rundir: Path, manifest: List[OutputFile], concurrency: int = 1
+) -> List[OutputFile]:
+    """Write binary companions for the OpenDX grids in the manifest.
+
+    At most concurrency grids are converted at once, since each holds its
+    values in memory. A grid that cannot be parsed is logged and skipped;
+    the job's result does not depend on its companion.
+
+    Args:
+        job_tag (str): The unique job id, for logging.
+        rundir (Path): The job's run directory.
+        manifest (List[OutputFile]): The files found in the run directory.
+        concurrency (int): The most grids to convert at once.
+    Returns:
+        List[OutputFile]: The companion files that were written.
+    """
+    grids = [output for output in manifest if output.path.suffix.lower() == ".dx"]
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def convert(output: OutputFile) -> List[Path]:
+        async with semaphore:
+            start = time()
+            try:
+                paths = await asyncio.to_thread(write_dx_companion, output.path)
+            except Exception as error:
+                _LOGGER.warning(
+                    "%s Could not convert %s to binary: %s", job_tag, output.name, error
+                )
+                return []
+        _LOGGER.info(
+            "%s Converted %s (%s bytes) to binary in %.2f seconds",
+            job_tag,
+            output.name,
+            output.size,
+            time() - start,
+        )
+        return paths
+
+    results = await asyncio.gather(*(convert(output) for output in grids))
+    return [OutputFile.from_path(rundir, path) for paths in results for path in paths]
+
+
+class InputCache:
+    """A size-capped, least-recently-used cache of input files on local disk.
+
+    Entries are keyed by a hash of the source (a blob key or URL) and its
+    version (the ETag, or Last-Modified when a server sends no ETag), so a
+    changed source never matches a stale entry. Cached files are copied
+    into the run directory, so a job that modifies its inputs cannot
+    change the cache. Each key has a lock for as long as its entry exists,
+    so concurrent fetches of a source download it once.
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._locks: Dict[str, asyncio.Lock] = {}
+        makedirs(self.root, exist_ok=True)
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> Optional["InputCache"]:
+        """Create the cache, or return None when it is disabled."""
+        if settings.input_cache_bytes <= 0:
+            return None
+        return cls(Path(settings.job_path) / ".input-cache", settings.input_cache_bytes)
+
+    @staticmethod
+    def key(source: str, version: str) -> str:
+        return hashlib.sha256(f"{source}\n{version}".encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    @staticmethod
+    def _copy(source: Path, target: Path):
+        with contextlib.suppress(FileNotFoundError):
+            target.unlink()
+        copyfile(source, target)
+
+    async def fetch(
+        self,
+        source: str,
+        version: str,
+        target: Path,
+        download: Callable[[Path], Awaitable[Any]],
+    ) -> bool:
+        """Put a source into target, downloading it only on a cache miss.
+
+        Args:
+            source (str): The blob key or URL of the input.
+            version (str): The ETag or Last-Modified of the source.
+            target (Path): Where the input should appear.
+            download (Callable): Downloads the source into a given path.
+        Returns:
+            bool: True if the input was served from the cache.
+        """
+        key = self.key(source, version)
+        entry = self._entry_path(key)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            hit = entry.exists()
+            if hit:
+                self.hits += 1
+                os.utime(entry)
+            else:
+                self.misses += 1
+                makedirs(entry.parent, exist_ok=True)
+                partial = entry.with_name(f"{entry.name}.{uuid.uuid4().hex}.part")
+                try:
+                    await download(partial)
+                    os.replace(partial, entry)
+                finally:
+                    with contextlib.suppress(FileNotFoundError):
+                        partial.unlink()
+            await asyncio.to_thread(self._copy, entry, target)
+        if not hit:
+            self.evict()
+        return hit
+
+    def evict(self):
+        """Remove the least recently used entries until under max_bytes.
+
+        Entries that are being fetched, and may be being copied into a run
+        directory, are kept until a later eviction.
+        """
+        entries = []
+        total = 0
+        for path in self.root.glob("*/*"):
+            if path.name.endswith(".part"):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            lock = self._locks.get(path.name)
+            if lock is not None and lock.locked():
+                continue
+            _LOGGER.info("Evicting %s (%s bytes) from the input cache", path, size)
+            with contextlib.suppress(FileNotFoundError):
+                path.unlink()
+            total -= size
+            self._locks.pop(path.name, None)
+
+
+def tool_version(job_type: str) -> Optional[str]:
+    """Get the version of the program that runs a job type.
+
+    Returns None when the version cannot be determined, in which case
+    results of that job type must not be reused.
+    """
+    if JOBTYPE.APBS.name.lower() in job_type:
+        return getenv("APBS_VERSION")
+    if JOBTYPE.PDB2PQR.name.lower() in job_type:
+        try:
+            return f"pdb2pqr-{importlib.metadata.version('pdb2pqr')}"
+        except importlib.metadata.PackageNotFoundError:
+            return None
+    return None
+
+
+def file_sha256(path: Path) -> str:
+    """Compute the SHA-256 of a file without reading it all into memory."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fin:
+        while chunk := fin.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Reuse the outputs of an identical job instead of running it again.
+
+    A job's key hashes its type, its command line (with the job id
+    replaced by a placeholder), the content of every input file and the
+    version of the program. After a job succeeds, a small index record
+    naming its job tag and outputs is written to index_storage under
+    PREFIX. When a later job has the same key, the recorded outputs are
+    copied server side to the new job's prefix, renaming the old job id
+    to the new one. If any copy fails, for example because the old
+    outputs expired, the job runs as usual.
+    """
+
+    PREFIX = "result-cache"
+
+    def __init__(self, index_storage: BlobStore, output_storage: BlobStore):
+        self.index_storage = index_storage
+        self.output_storage = output_storage
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize_command_line(command_line_args: str, job_id: str) -> str:
+        return " ".join(command_line_args.replace(job_id, "{job_id}").split())
+
+    async def job_key(self, job_info: Dict, rundir: Path) -> Optional[str]:
+        """Compute the cache key of a job whose inputs are in rundir.
+
+        Returns:
+            Optional[str]: The key, or None if the job cannot be cached.
+        """
+        job_type = job_info["job_type"]
+        version = tool_version(job_type)
+        if version is None:
+            return None
+        job_id = job_info["job_id"]
+        inputs = {}
+        for file in job_info["input_files"]:
+            name = file.split("/")[-1]
+            inputs[name.replace(job_id, "{job_id}")] = await asyncio.to_thread(
+                file_sha256, rundir / name
+            )
+        description = {
+            "job_type": job_type,
+            "command_line": self.normalize_command_line(
+                job_info.get("command_line_args", ""), job_id
+            ),
+            "inputs": inputs,
+            "version": version,
+        }
+        return hashlib.sha256(
+            dumps(description, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def _index_key(self, key: str) -> str:
+        return f"{self.PREFIX}/{key}.json"
+
+    async def restore(self, key: str, job_tag: str, job_id: str) -> Optional[Dict]:
+        """Copy the outputs of a cached job to job_tag.
+
+        Returns:
+            Optional[Dict]: The index record if the outputs were copied,
+            with "outputs" renamed for the new job, otherwise None.
+        """
+        index_key = self._index_key(key)
+        if not await self.index_storage.exists(index_key):
+            self.misses += 1
+            return None
+        record = loads(await self.index_storage.get_contents(index_key))
+        renamed = [name.replace(record["job_id"], job_id) for name in record["outputs"]]
+        try:
+            await asyncio.gather(
+                *(
+                    self.output_storage.copy_blob(
+                        f"{record['job_tag']}/{name}", f"{job_tag}/{new_name}"
+                    )
+                    for name, new_name in zip(record["outputs"], renamed)
+                )
+            )
+        except (ResourceNotFoundError, HttpResponseError) as error:
+            _LOGGER.warning(
+                "%s Unable to reuse the results of %s: %s",
+                job_tag,
+                record["job_tag"],
+                error,
+            )
+            self.misses += 1
+            return None
+        self.hits += 1
+        _LOGGER.info("%s Reused the results of %s", job_tag, record["job_tag"])
+        return {**record, "outputs": renamed}
+
+    async def store(
+        self,
+        key: str,
+        job_tag: str,
+        job_id: str,
+        outputs: List[str],
+        disk_usage: Optional[int],
+    ):
+        """Record the outputs of a successful job under its key."""
+        record = {
+            "job_tag": job_tag,
+            "job_id": job_id,
+            "outputs": outputs,
+            "disk_storage_in_bytes": disk_usage,
+            "created": time(),
+        }
+        try:
+            await self.index_storage.put_contents(
+                self._index_key(key), dumps(record), overwrite=True
+            )
+        except HttpResponseError as error:
+            _LOGGER.warning("%s Unable to store result cache entry: %s", job_tag, error)
+
+
+def print_current_state():
+    # DWHS TODO -- see if this can be changed (remove globals?)
+    for idx in sorted(GLOBAL_VARS):
+        _LOGGER.info("VAR: %s, VALUE: %s", idx, GLOBAL_VARS[idx])
+        print(f"VAR: {idx}, VALUE: set to: {GLOBAL_VARS[idx]}", file=stderr)
+    _LOGGER.info("PROCESSING state: %s", PROCESSING)
+    print(f"PROCESSING state: {PROCESSING}\n", file=stderr)
+
+
+def receive_signal(signal_number, frame):
+    _LOGGER.info("Received signal: %s, %s", signal_number, frame)
+    print(f"Received signal: {signal_number}, {frame}", file=stderr)
+    signal_help(signal_number, frame)
+
+
+def signal_help(signal_number, frame):
+    # pylint: disable=unused-argument
+    print("\n", file=stderr)
+    print(f"RECEIVED SIGNAL: {signal_number}\n\n", file=stderr)
+    print("\tYou have asked for help:\n\n", file=stderr)
+    print(
+        f"\tTo update environment variables, type: kill -USR1 {getpid()}\n\n",
+        file=stderr,
+    )
+    print(f"\tTo toggle processing, type: kill -USR2 {getpid()}\n\n", file=stderr)
+    print_current_state()
+
+
+def terminate_process(signal_number, frame):
+    # pylint: disable=unused-argument
+    print("Caught (SIGTERM) terminating the process\n", file=stderr)
+    sys.exit()
+
+
+def toggle_processing(signal_number, frame):
+    # pylint: disable=unused-argument
+    global PROCESSING
+    PROCESSING = not PROCESSING
+    _LOGGER.info("PROCESSING set to: %s", PROCESSING)
+    print(f"PROCESSING set to:{PROCESSING}\n", file=stderr)
+
+
+def update_environment(signal_number, frame):
+    pass
+    # DWHS TODO -- update to remove AWS-specific stuff
+    # pylint: disable=unused-argument
+    # TODO: This may need to be increased or calculated based
+    #       on complexity of the job (dimension of molecule?)
+    #       The job could get launched multiple times if the
+    #       job takes longer than Q_TIMEOUT
+    # global GLOBAL_VARS
+    # GLOBAL_VARS["Q_TIMEOUT"] = int(getenv("SQS_QUEUE_TIMEOUT", "300"))
+    # GLOBAL_VARS["AWS_REGION"] = getenv("SQS_AWS_REGION", "us-west-2")
+    # GLOBAL_VARS["MAX_TRIES"] = int(getenv("SQS_MAX_TRIES", "60"))
+    # GLOBAL_VARS["RETRY_TIME"] = int(getenv("SQS_RETRY_TIME", "15"))
+    # GLOBAL_VARS["LOG_LEVEL"] = int(getenv("LOG_LEVEL", str(INFO)))
+    # GLOBAL_VARS["JOB_PATH"] = getenv("JOB_PATH", "/var/tmp/")
+    # GLOBAL_VARS["S3_TOPLEVEL_BUCKET"] = getenv("OUTPUT_BUCKET")
+    # GLOBAL_VARS["QUEUE"] = getenv("JOB_QUEUE_NAME")
+    # _LOGGER.setLevel(GLOBAL_VARS["LOG_LEVEL"])
+
+    # if GLOBAL_VARS["S3_TOPLEVEL_BUCKET"] is None:
+    # raise ValueError("Environment variable 'OUTPUT_BUCKET' is not set")
+    # if GLOBAL_VARS["QUEUE"] is None:
+    # raise ValueError("Environment variable 'JOB_QUEUE_NAME' is not set")
+
+
+def get_messages(sqs, qurl: str) -> Any:
+    # DWHS TODO -- this can probably be removed
+    """Get SQS Messages from the queue.
+
+    :param sqs:  S3 output bucket for the job being updated
+    :type sqs:  boto3.client connection
+    :param qurl:  URL for the SNS Queue to listen for new messages
+    :return:  List of messages from the queue
+    :rtype:  Any
+    """
+    loop = 0
+
+    messages = sqs.receive_message(
+        QueueUrl=qurl,
+        MaxNumberOfMessages=1,
+        VisibilityTimeout=GLOBAL_VARS["Q_TIMEOUT"],
+    )
+
+    while "Messages" not in messages:
+        loop += 1
+        if loop == GLOBAL_VARS["MAX_TRIES"]:
+            return None
+        _LOGGER.debug("Waiting ....")
+        sleep(GLOBAL_VARS["RETRY_TIME"])
+        messages = sqs.receive_message(
+            QueueUrl=qurl,
+            MaxNumberOfMessages=1,
+            VisibilityTimeout=GLOBAL_VARS["Q_TIMEOUT"],
+        )
+    return messages
+
+
+class StatusManager:
+    """Keep a job's status file in memory and write it with ETag checks.
+
+    The status file is read once, the first time it is needed. update()
+    only changes what will be written, so several updates made before a
+    flush() go out as a single PUT. flush_later() writes intermediate
+    updates behind, after a delay, so a job that reaches a terminal
+    status sooner costs one GET and one PUT. Each write is conditional on
+    the ETag of the copy it was based on. If another writer changed the
+    file in the meantime, the file is read again, the pending updates are
+    applied to the new copy and the write is retried. A terminal status
+    (complete, failed or timeout) written by someone else is never moved
+    back to running. A status file that cannot be read or written is
+    logged and the updates stay pending for the next flush.
+    """
+
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, output_storage: BlobStore, job_tag: str, jobtype: str):
+        self.output_storage = output_storage
+        self.job_tag = job_tag
+        self.jobtype = jobtype
+        self.objectfile = f"{job_tag}/{jobtype}-status.json"
+        self._statobj: Optional[Dict] = None
+        self._etag: Optional[str] = None
+        self._pending: List[Tuple[JOBSTATUS, List, Optional[str], float]] = []
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self.retries = 0
+        self.seconds = 0.0
+
+    async def load(self):
+        """Read the status file and remember its ETag."""
+        storage_bytes, self._etag = await self.output_storage.get_contents_and_etag(
+            self.objectfile
+        )
+        self._statobj = loads(storage_bytes.decode("utf-8"))
+
+    def update(
+        self,
+        status: JOBSTATUS,
+        output_files: List,
+        message: Optional[str] = None,
+    ):
+        """Stage a status change to be written by the next flush()."""
+        self._pending.append((status, output_files, message, time()))
+
+    def flush_later(self, delay: float):
+        """Write the pending updates after delay seconds, unless flush() does."""
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._flush_after(delay))
+
+    async def _flush_after(self, delay: float):
+        await asyncio.sleep(delay)
+        # From here on flush() waits for this write instead of cancelling it
+        self._timer = None
+        await self.flush()
+
+    def _apply(self, statobj: Dict, pending: List) -> Dict:
+        statobj = deepcopy(statobj)
+        job = statobj[self.jobtype]
+        terminal = (
+            JOBSTATUS.COMPLETE.name.lower(),
+            JOBSTATUS.FAILED.name.lower(),
+            JOBSTATUS.TIMEOUT.name.lower(),
+        )
+        for status, output_files, message, timestamp in pending:
+            if status == JOBSTATUS.RUNNING and job.get("status") in terminal:
+                _LOGGER.warning(
+                    "%s Status is already %s, not setting it to running",
+                    self.job_tag,
+                    job["status"],
+                )
+                continue
+            # Update status and timestamps
+            job["status"] = status.name.lower()
+            if status in (JOBSTATUS.COMPLETE, JOBSTATUS.FAILED, JOBSTATUS.TIMEOUT):
+                job["endTime"] = timestamp
+
+            if status != JOBSTATUS.COMPLETE and message is not None:
+                job["message"] = message
+
+            job["outputFiles"] = output_files
+        return statobj
+
+    async def flush(self) -> Dict:
+        """Write the pending updates to the status file.
+
+        Returns:
+            Dict: The response from storing the status file, or an empty
+            dictionary if nothing was written.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            if not self._pending:
+                return {}
+            start = time()
+            try:
+                return await self._flush()
+            finally:
+                self.seconds += time() - start
+
+    async def _flush(self) -> Dict:
+        # Updates staged while the PUT is in flight are left for the next flush
+        pending = list(self._pending)
+        for _ in range(self.MAX_ATTEMPTS):
+            try:
+                if self._statobj is None:
+                    await self.load()
+                statobj = self._apply(self._statobj, pending)
+                object_response: dict = await self.output_storage.put_contents(
+                    self.objectfile,
+                    dumps(statobj),
+                    overwrite=True,
+                    etag=self._etag,
+                )
+            except ResourceModifiedError:
+                _LOGGER.info("%s Status file changed, reading it again", self.job_tag)
+                self.retries += 1
+                self._statobj = None
+                continue
+            except Exception as error:
+                _LOGGER.exception(
+                    "%s ERROR: Failed to update status file, %s \n\t%s",
+                    self.job_tag,
+                    self.objectfile,
+                    error,
+                )
+                return {}
+            self._statobj = statobj
+            self._etag = object_response.get("etag")
+            del self._pending[: len(pending)]
+            return object_response
+        _LOGGER.error(
+            "%s ERROR: Gave up updating status file, %s, after %s conflicts",
+            self.job_tag,
+            self.objectfile,
+            self.MAX_ATTEMPTS,
+        )
+        return {}
+
+
+async def update_status(
+    output_storage: BlobStore,
+    job_tag: str,
+    jobtype: str,
+    status: JOBSTATUS,
+    output_files: List,
+    message: Optional[str] = None,
+) -> Dict:
+    """Update the status file in the S3 bucket for the current job.
+
+    This is a one-off read and write; jobs that update their status more
+    than once should keep a StatusManager instead.
+
+    :param s3:  S3 output bucket for the job being updated
+    :param job_tag:  Unique ID for this job
+    :param jobtype:  The job type (apbs, pdb2pqr, etc.)
+    :param status:  The job status
+    :param output_files:  List of output files
+    :return:  Response from storing status file in S3 bucket
+    :rtype:  Dict
+    """
+    manager = StatusManager(output_storage, job_tag, jobtype)
+    manager.update(status, output_files, message)
+    return await manager.flush()
+
+
+def cleanup_job(job_tag: str, rundir: str, settings: Settings) -> int:
+    """Remove the directory for the job.
+
+    :param rundir:  The local directory where the job is being executed.
+    :return:  int
+    """
+    _LOGGER.info("%s Deleting run directory, %s", job_tag, rundir)
+    rmtree(rundir)
+    return 1
+
+
+class StreamLog:
+    """Buffer a subprocess stream into a log file and mirror it to the console.
+
+    Output is written in chunks once settings.log_flush_bytes have been
+    buffered or settings.log_flush_interval seconds have passed. A stream
+    within settings.log_max_bytes is written byte for byte. A longer one
+    keeps its start and at most its last TAIL_BYTES, from a line boundary,
+    with a marker in between, so the log stays about log_max_bytes long
+    and only the tail is held in memory. The console only receives whole
+    lines, at most settings.log_console_rate bytes per second when set;
+    lines over the rate are counted and reported instead of printed.
+    """
+
+    # The most output kept from the end of a truncated stream
+    TAIL_BYTES = 64 * 1024
+
+    def __init__(self, output_file, console, settings: Settings):
+        self.output_file = output_file
+        self.console = console
+        self.settings = settings
+        self.tail_bytes = min(settings.log_max_bytes // 2, self.TAIL_BYTES)
+        self.total = 0
+        self.written = 0
+        self.dropped = 0
+        self._buffer = bytearray()
+        self._tail = bytearray()
+        self._pending = bytearray()
+        self._allowance = float(settings.log_console_rate)
+        self._last_mirror = self._last_flush = time()
+
+    @property
+    def buffered(self) -> bool:
+        return bool(self._buffer or self._pending)
+
+    @property
+    def due(self) -> bool:
+        return (
+            self.buffered
+            and time() - self._last_flush >= self.settings.log_flush_interval
+        )
+
+    def feed(self, data: bytes):
+        self.total += len(data)
+        if self.output_file is not None:
+            self._store(data)
+        if self.console is not None:
+            self._pending += data
+            self._mirror(final=False)
+        if len(self._buffer) >= self.settings.log_flush_bytes:
+            self.flush()
+
+    def _store(self, data: bytes):
+        if not self.settings.log_max_bytes:
+            self._buffer += data
+            return
+        # Everything past the head is held back until the stream ends, when
+        # it is known whether anything has to be omitted
+        head_bytes = self.settings.log_max_bytes - self.tail_bytes
+        room = max(head_bytes - self.written - len(self._buffer), 0)
+        self._buffer += data[:room]
+        if room < len(data):
+            self._tail += data[room:]
+            if len(self._tail) > 2 * self.tail_bytes:
+                # With a tail_bytes of 0 (a cap of 1 byte) nothing is kept
+                del self._tail[: len(self._tail) - self.tail_bytes]
+
+    def _mirror(self, final: bool):
+        end = len(self._pending) if final else self._pending.rfind(b"\n") + 1
+        if not end and len(self._pending) >= self.settings.log_flush_bytes:
+            end = len(self._pending)
+        if not end:
+            return
+        chunk = bytes(self._pending[:end])
+        del self._pending[:end]
+        rate = self.settings.log_console_rate
+        if rate:
+            now = time()
+            self._allowance = min(
+                self._allowance + (now - self._last_mirror) * rate, float(rate)
+            )
+            self._last_mirror = now
+            if len(chunk) > self._allowance:
+                self.dropped += len(chunk)
+                return
+            self._allowance -= len(chunk)
+        if self.dropped:
+            self.console.write(
+                f"[{self.dropped} bytes of output not mirrored]\n".encode()
+            )
+            self.dropped = 0
+        self.console.write(chunk)
+
+    def flush(self):
+        if self._buffer:
+            self.output_file.write(self._buffer)
+            self.output_file.flush()
+            self.written += len(self._buffer)
+            self._buffer.clear()
+        if self.console is not None:
+            self.console.flush()
+        self._last_flush = time()
+
+    def close(self):
+        """Flush everything, joining the kept head and tail if truncated."""
+        if self.console is not None and self._pending:
+            self._mirror(final=True)
+        self.flush()
+        if self.output_file is not None and self.total > self.written:
+            if self.total <= self.settings.log_max_bytes:
+                self.output_file.write(self._tail)
+            else:
+                tail = self._tail[-self.tail_bytes :]
+                tail = tail[tail.find(b"\n") + 1 :]
+                omitted = self.total - self.written - len(tail)
+                self.output_file.write(
+                    f"\n[... {omitted} bytes omitted ...]\n".encode() + tail
+                )
+            self.output_file.flush()
+            self._tail.clear()
+        if self.dropped and self.console is not None:
+            self.console.write(
+                f"[{self.dropped} bytes of output not mirrored]\n".encode()
+            )
+            self.console.flush()
+            self.dropped = 0
+
+
+async def read_stream(stream, is_stderr=False, output_file=None, settings=None):
+    """Copy a subprocess stream to a log file and the console in chunks.
+
+    Args:
+        stream (asyncio.StreamReader): The stdout or stderr of the process.
+        is_stderr (bool): Whether to mirror to stderr instead of stdout.
+        output_file (BinaryIO): The log file, opened for binary writing.
+        settings (Settings): The buffering and mirroring settings.
+    """
+    settings = settings or Settings()
+    console = None
+    if settings.log_console:
+        console = getattr(sys.stderr if is_stderr else sys.stdout, "buffer", None)
+    log = StreamLog(output_file, console, settings)
+    try:
+        while True:
+            timeout = settings.log_flush_interval if log.buffered else None
+            try:
+                data = await asyncio.wait_for(stream.read(64 * 1024), timeout)
+            except asyncio.TimeoutError:
+                log.flush()
+                continue
+            if not data:
+                break
+            log.feed(data)
+            if log.due:
+                log.flush()
+    finally:
+        log.close()
+
+
+async def monitor_termination(process, stop_event):
+    """Stop the job's process group once the replica is asked to stop.
+
+    Like enforce_deadline, this signals the whole group, so processes the
+    job started do not survive it.
+    """
+    await stop_event.wait()
     print("Terminating process", flush=True)
     try:
-        process.terminate()
+        os.killpg(process.pid, signal.SIGTERM)
         print("Sent SIGTERM, waiting for process to finish", flush=True)
         try:
             await asyncio.wait_for(process.wait(), timeout=5)
             print("Process finished", flush=True)
         except asyncio.TimeoutError:
             print("Process did not finish in time, killing it", flush=True)
-            process.kill()
+            os.killpg(process.pid, signal.SIGKILL)
             await process.wait()
             print("Process killed", flush=True)
     except ProcessLookupError:
@@ -647,21 +3174,524 @@ async def handle_signal(stop_event):
     stop_event.set()
 
 
+class MessageLease:
+    """How long a message stays invisible on the queue while its job runs.
+
+    The lease starts at the visibility timeout of the queue. Once the
+    declared or estimated run time of the job is known, the lease is
+    extended to cover it, so a long job does not reappear on the queue
+    when a few renewals fail in a row. Renewals and extensions both
+    replace the pop receipt of the message, so they are serialized.
+    """
+
+    # The longest visibility timeout Azure Storage queues accept
+    MAX_SECONDS = 7 * 24 * 60 * 60
+
+    def __init__(self, queue: Queue, message: QueueMessage):
+        self.queue = queue
+        self.message = message
+        self.seconds = queue.visibility_timeout
+        self._lock = asyncio.Lock()
+
+    async def renew(self, seconds: Optional[int] = None):
+        """Make the message invisible for another lease, or for seconds."""
+        async with self._lock:
+            await self.queue.set_visibility_timeout(
+                self.message, seconds or self.seconds
+            )
+
+    async def extend(self, seconds: float):
+        """Lengthen the lease to at least seconds; it is never shortened.
+
+        A failure is only logged, since renew_lease keeps the message
+        invisible at the current lease.
+        """
+        seconds = min(math.ceil(seconds), self.MAX_SECONDS)
+        if seconds <= self.seconds:
+            return
+        try:
+            await self.renew(seconds)
+        except (ResourceNotFoundError, HttpResponseError) as error:
+            _LOGGER.warning("Unable to extend lease on %s: %s", self.message.id, error)
+            return
+        self.seconds = seconds
+        _LOGGER.info("Extended lease on %s to %d seconds", self.message.id, seconds)
+
+
+async def renew_lease(
+    lease: MessageLease,
+    job_done: asyncio.Event,
+    stop_event: asyncio.Event,
+):
+    """Keep a message invisible on the queue while its job is running.
+
+    The lease is renewed every third of its length, so one failed renewal
+    does not let the message reappear. Each renewal stores the new pop
+    receipt on the message, which is needed to delete it once the job is
+    done. The heartbeat stops when job_done or stop_event is set; it is
+    not cancelled so that a renewal in flight can finish updating the pop
+    receipt.
+
+    Args:
+        lease (MessageLease): The lease on the message to keep invisible.
+        job_done (asyncio.Event): Set when the job has finished.
+        stop_event (asyncio.Event): Set when the process received SIGTERM.
+    """
+    message = lease.message
+    while True:
+        interval = max(1, lease.seconds / 3)
+        waiters = [
+            asyncio.create_task(event.wait()) for event in (job_done, stop_event)
+        ]
+        done, pending = await asyncio.wait(
+            waiters, timeout=interval, return_when=asyncio.FIRST_COMPLETED
+        )
+        for task in pending:
+            task.cancel()
+        if done:
+            return
+        try:
+            await lease.renew()
+            _LOGGER.debug("Renewed lease on message %s", message.id)
+        except ResourceNotFoundError as error:
+            _LOGGER.error("Lost lease on message %s: %s", message.id, error)
+            return
+        except HttpResponseError as error:
+            _LOGGER.warning("Unable to renew lease on %s: %s", message.id, error)
+
+
+async def download_url(url: str, filename: os.PathLike):
+    """Download a file over HTTP(S) without blocking the event loop.
+
+    Args:
+        url (str): The URL to download.
+        filename (os.PathLike): The path to write the file to.
+    """
+    session = shared_connections().session()
+    async with session.get(url, raise_for_status=True) as response:
+        with open(filename, "wb") as fout:
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                fout.write(chunk)
+
+
+async def url_version(url: str) -> Optional[str]:
+    """Get the ETag or Last-Modified of a URL with a HEAD request.
+
+    Returns None, so the URL is downloaded without the cache, if the
+    server does not answer the HEAD request.
+    """
+    session = shared_connections().session()
+    try:
+        async with session.head(
+            url, allow_redirects=True, raise_for_status=True
+        ) as response:
+            return response.headers.get("ETag") or response.headers.get("Last-Modified")
+    except Exception as error:
+        _LOGGER.warning("Unable to get the version of %s: %s", url, error)
+        return None
+
+
+async def download_input(
+    job_tag: str,
+    file: str,
+    rundir: Path,
+    input_storage: BlobStore,
+    input_cache: Optional[InputCache] = None,
+) -> int:
+    """Download a single input file into the run directory.
+
+    Args:
+        job_tag (str): The unique job id.
+        file (str): An https URL or the key of a blob in the input storage.
+        rundir (Path): The directory to download the file to.
+        input_storage (Storage): The storage for input files.
+        input_cache (InputCache): The local cache of inputs, if enabled.
+    Return:
+        int: The number of bytes downloaded.
+    """
+    start = time()
+    target = rundir / file.split("/")[-1]
+    if "https" in file:
+
+        async def download(path: Path):
+            await download_url(file, path)
+
+        version = await url_version(file) if input_cache else None
+    else:
+
+        async def download(path: Path):
+            await input_storage.download_file(file, path)
+
+        # The job's own inputs are only ever read once, so are not cached
+        shared = not file.startswith(f"{job_tag}/")
+        version = await input_storage.get_etag(file) if input_cache and shared else None
+
+    cached = False
+    if input_cache and version:
+        cached = await input_cache.fetch(file, version, target, download)
+    else:
+        await download(target)
+    size = target.stat().st_size
+    _LOGGER.info(
+        "%s %s %s (%s bytes) in %.2f seconds",
+        job_tag,
+        "Found cached" if cached else "Downloaded",
+        file,
+        size,
+        time() - start,
+    )
+    return size
+
+
+async def download_inputs(
+    job_tag: str,
+    input_files: List[str],
+    rundir: Path,
+    input_storage: BlobStore,
+    settings: Settings,
+    input_cache: Optional[InputCache] = None,
+) -> int:
+    """Download all of a job's input files concurrently.
+
+    At most settings.download_concurrency files are fetched at once. If
+    any download fails the remaining ones are cancelled and the error is
+    raised.
+
+    Args:
+        job_tag (str): The unique job id.
+        input_files (List[str]): The https URLs or blob keys to download.
+        rundir (Path): The directory to download the files to.
+        input_storage (Storage): The storage for input files.
+        settings (Settings): The settings for the job.
+        input_cache (InputCache): The local cache of inputs, if enabled.
+    Return:
+        int: The total number of bytes downloaded.
+    """
+    start = time()
+    semaphore = asyncio.Semaphore(settings.download_concurrency)
+
+    async def bounded_download(file: str) -> int:
+        async with semaphore:
+            return await download_input(
+                job_tag, file, rundir, input_storage, input_cache
+            )
+
+    tasks = [asyncio.create_task(bounded_download(file)) for file in input_files]
+    if not tasks:
+        return 0
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    for task in done:
+        if task.exception() is not None:
+            raise task.exception()
+    total_bytes = sum(task.result() for task in tasks)
+    _LOGGER.info(
+        "%s Staged %s input files (%s bytes) in %.2f seconds",
+        job_tag,
+        len(tasks),
+        total_bytes,
+        time() - start,
+    )
+    return total_bytes
+
+
+async def upload_outputs(
+    job_tag: str,
+    manifest: List[OutputFile],
+    output_storage: BlobStore,
+    settings: Settings,
+    overwrite: bool = False,
+) -> bool:
+    """Upload the files in the manifest concurrently.
+
+    At most settings.upload_concurrency files are uploaded at once. The
+    MD5 checksum of each file is computed in a thread, recorded in the
+    manifest and stored as the blob's Content-MD5. Large text files are
+    gzipped in a thread first and stored with Content-Encoding: gzip, so
+    browsers still see the original content.
+
+    Args:
+        job_tag (str): The unique job id, used as the blob prefix.
+        manifest (List[OutputFile]): The files to upload.
+        output_storage (Storage): The storage for output files.
+        settings (Settings): The settings for the job.
+        overwrite (bool): Whether to replace blobs that already exist.
+    Returns:
+        bool: True if every file was uploaded.
+    """
+    from azure.storage.blob import ContentSettings
+
+    start = time()
+    semaphore = asyncio.Semaphore(settings.upload_concurrency)
+
+    async def upload(output: OutputFile) -> bool:
+        async with semaphore:
+            compressed = None
+            try:
+                filepath = output.path
+                content_settings = ContentSettings()
+                if should_compress(output, settings):
+                    handle, compressed = tempfile.mkstemp(
+                        prefix=".upload-", suffix=".gz", dir=settings.job_path
+                    )
+                    os.close(handle)
+                    output.stored_size, output.md5 = await asyncio.to_thread(
+                        gzip_file, output.path, Path(compressed)
+                    )
+                    output.content_encoding = "gzip"
+                    filepath = Path(compressed)
+                    content_settings.content_encoding = "gzip"
+                    content_settings.content_type = (
+                        mimetypes.guess_type(output.name)[0] or "text/plain"
+                    )
+                else:
+                    output.md5 = await asyncio.to_thread(file_md5, output.path)
+                    output.stored_size = output.size
+                content_settings.content_md5 = bytearray(output.md5)
+                _LOGGER.info(
+                    "%s Uploading file to output bucket, %s", job_tag, output.name
+                )
+                await output_storage.upload_file(
+                    filepath=filepath,
+                    prefix=job_tag,
+                    name=output.name,
+                    overwrite=overwrite,
+                    content_settings=content_settings,
+                )
+                return True
+            except Exception as error:
+                _LOGGER.exception(
+                    "%s ERROR: Failed to upload file, %s \n\t%s",
+                    job_tag,
+                    f"{job_tag}/{output.name}",
+                    error,
+                )
+                return False
+            finally:
+                if compressed:
+                    with contextlib.suppress(OSError):
+                        os.remove(compressed)
+
+    results = await asyncio.gather(*(upload(output) for output in manifest))
+    _LOGGER.info(
+        "%s Uploaded %s files (%s bytes, %s stored) in %.2f seconds",
+        job_tag,
+        len(manifest),
+        sum(output.size for output in manifest),
+        sum(output.stored_size or 0 for output in manifest),
+        time() - start,
+    )
+    _LOGGER.debug(
+        "%s MANIFEST: %s", job_tag, dumps([output.as_dict() for output in manifest])
+    )
+    return all(results)
+
+
+class OutputWatcher:
+    """Upload finished output files while the job is still running.
+
+    The run directory is scanned every settings.pipeline_interval seconds.
+    A file is uploaded early once its size and modification time have not
+    changed since the previous scan and neither the job's process tree nor
+    this process has it open. After the job exits, remaining() returns only
+    the files that still need to be uploaded.
+    """
+
+    def __init__(
+        self,
+        job_tag: str,
+        rundir: Path,
+        output_storage: BlobStore,
+        settings: Settings,
+    ):
+        self.job_tag = job_tag
+        self.rundir = rundir
+        self.output_storage = output_storage
+        self.settings = settings
+        self.pid: Optional[int] = None
+        self.uploaded: Dict[str, OutputFile] = {}
+        self._previous: Dict[str, Tuple[int, int]] = {}
+
+    def set_pid(self, pid: int):
+        self.pid = pid
+
+    def _stable_files(self) -> List[OutputFile]:
+        """Find files that look complete and have not been uploaded yet."""
+        pids = [getpid()]
+        if self.pid is not None:
+            pids.extend(process_tree(self.pid))
+        busy = open_files(pids)
+        current = {}
+        stable = []
+        for output in scan_outputs(self.rundir):
+            if self.settings.bundle_subdirectories and "/" in output.name:
+                # Subdirectories are uploaded as a tarball after the job
+                continue
+            state = (output.size, output.mtime_ns)
+            current[output.name] = state
+            if self._previous.get(output.name) != state:
+                continue
+            if str(output.path) in busy:
+                continue
+            uploaded = self.uploaded.get(output.name)
+            if uploaded and (uploaded.size, uploaded.mtime_ns) == state:
+                continue
+            stable.append(output)
+        self._previous = current
+        return stable
+
+    async def poll(self):
+        """Upload the files that look complete.
+
+        Failures are only logged; whatever was not uploaded early is
+        uploaded after the job exits.
+        """
+        try:
+            stable = self._stable_files()
+            if not stable:
+                return
+            _LOGGER.info(
+                "%s Uploading %s finished files early", self.job_tag, len(stable)
+            )
+            await upload_outputs(
+                self.job_tag, stable, self.output_storage, self.settings, overwrite=True
+            )
+        except Exception as error:
+            _LOGGER.warning("%s Early upload failed: %s", self.job_tag, error)
+            return
+        for output in stable:
+            if output.md5 is not None:
+                self.uploaded[output.name] = output
+
+    async def watch(self, execution: Awaitable[int]) -> int:
+        """Wait for the job to finish, uploading stable files meanwhile.
+
+        If the watch itself is cancelled, so is the job, which stops its
+        process, so the job never outlives its slot.
+
+        Args:
+            execution (Awaitable[int]): The running job.
+        Returns:
+            int: The exit code of the job.
+        """
+        task = asyncio.ensure_future(execution)
+        try:
+            while True:
+                done, _ = await asyncio.wait(
+                    [task], timeout=self.settings.pipeline_interval
+                )
+                if done:
+                    return task.result()
+                await self.poll()
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+    def remaining(self, manifest: List[OutputFile]) -> List[OutputFile]:
+        """Drop the files that were uploaded early and have not changed.
+
+        The checksums of early uploads are copied into the manifest.
+        """
+        pending = []
+        for output in manifest:
+            uploaded = self.uploaded.get(output.name)
+            if uploaded and (uploaded.size, uploaded.mtime_ns) == (
+                output.size,
+                output.mtime_ns,
+            ):
+                output.md5 = uploaded.md5
+                output.content_encoding = uploaded.content_encoding
+                output.stored_size = uploaded.stored_size
+            else:
+                pending.append(output)
+        _LOGGER.info(
+            "%s %s of %s files were uploaded while the job ran",
+            self.job_tag,
+            len(manifest) - len(pending),
+            len(manifest),
+        )
+        return pending
+
+
+# The exit code of a job stopped at its deadline, as with timeout(1)
+TIMEOUT_EXIT_CODE = 124
+
+
+async def enforce_deadline(
+    job_tag: str,
+    process: asyncio.subprocess.Process,
+    timeout: float,
+    kill_after: float,
+) -> bool:
+    """Stop a process that runs longer than timeout seconds.
+
+    The process group of the job is sent SIGTERM at the soft deadline and
+    SIGKILL if it is still running kill_after seconds later. The job runs
+    in a process group of its own (see execute_command_async), so this
+    also stops any children it started, which would otherwise keep its
+    output pipes open, and nothing else.
+
+    Return:
+        bool: Whether the process was stopped.
+    """
+    try:
+        await asyncio.wait_for(process.wait(), timeout)
+        return False
+    except asyncio.TimeoutError:
+        pass
+    _LOGGER.error("%s exceeded its maximum run time of %s seconds", job_tag, timeout)
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), kill_after)
+        except asyncio.TimeoutError:
+            _LOGGER.error(
+                "%s did not stop within %s seconds, killing it", job_tag, kill_after
+            )
+            os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    return True
+
+
+async def kill_process_group(process: asyncio.subprocess.Process):
+    """SIGKILL the process group of a job and reap the job."""
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(process.pid, signal.SIGKILL)
+    await process.wait()
+
+
 async def execute_command_async(
     job_tag: str,
     command_line_str: str,
     stdout_filename: str,
     stderr_filename: str,
     stop_event: asyncio.Event,
+    cwd: Optional[os.PathLike] = None,
+    on_spawn: Optional[Callable[[int], None]] = None,
+    settings: Optional[Settings] = None,
+    timeout: Optional[float] = None,
+    kill_after: float = 30,
 ) -> int:
     """Spawn a subprocess and collect all the information about it.
-    Returns the exit code the of the executed command.
+    Returns the exit code the of the executed command, or
+    TIMEOUT_EXIT_CODE if it ran past its deadline.
 
     Args:
         job_tag (str): The unique job id.
         command_line_str (str): The command and arguments.
         stdout_filename (str): The name of the output file for stdout.
         stderr_filename (str): The name of the output file for stderr.
+        stop_event (asyncio.Event): The event to stop the job.
+        cwd (os.PathLike): The directory to run the command in.
+        on_spawn (Callable[[int], None]): Called with the pid of the process.
+        settings (Settings): The settings for piping the output.
+        timeout (float): The seconds after which the command is sent
+            SIGTERM, or None to let it run.
+        kill_after (float): The seconds after SIGTERM before SIGKILL.
     Return:
         exit_code (int): The exit code of the executed command
 
@@ -671,42 +3701,603 @@ async def execute_command_async(
         *command_split,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
+        cwd=cwd,
+        process_group=0,
     )
-    termination_task = asyncio.create_task(monitor_termination(process, stop_event))
-    with contextlib.ExitStack() as stack:
-        files = [
-            stack.enter_context(open(file, "w"))
-            for file in (stdout_filename, stderr_filename)
-        ]
-        stdout_task = asyncio.create_task(read_stream(process.stdout, False, files[0]))
-        stderr_task = asyncio.create_task(read_stream(process.stderr, True, files[1]))
+    termination_task = None
+    deadline_task = None
+    try:
+        if on_spawn is not None:
+            on_spawn(process.pid)
+        termination_task = asyncio.create_task(monitor_termination(process, stop_event))
+        if timeout:
+            deadline_task = asyncio.create_task(
+                enforce_deadline(job_tag, process, timeout, kill_after)
+            )
+        with contextlib.ExitStack() as stack:
+            files = [
+                stack.enter_context(open(file, "wb"))
+                for file in (stdout_filename, stderr_filename)
+            ]
+            streams = asyncio.gather(
+                read_stream(process.stdout, False, files[0], settings),
+                read_stream(process.stderr, True, files[1], settings),
+            )
+
+            try:
+                done, pending = await asyncio.wait(
+                    [streams, termination_task],
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+            except BaseException:
+                # Drain the output of the killed job before its files close
+                await kill_process_group(process)
+                await asyncio.gather(streams, return_exceptions=True)
+                raise
+
+            if termination_task in done:
+                print("Termination task requested, cancelling...", flush=True)
+                if deadline_task:
+                    pending.add(deadline_task)
+                for task in pending:
+                    task.cancel()
+                try:
+                    await asyncio.gather(*pending, return_exceptions=True)
+                except asyncio.CancelledError:
+                    pass
+                return 143
+
+        termination_task.cancel()
+        code = await process.wait()
+        # Handle signal termination
+        if code < 0:
+            # Convert negative signal code to conventional exit code (128 + signal number)
+            signal_number = -code  # Make the negative code positive
+            code = 128 + signal_number
+        if deadline_task and await deadline_task:
+            code = TIMEOUT_EXIT_CODE
+    finally:
+        # Only reached with the process running when the job was cancelled
+        # or failed; it must not keep running without anyone watching it
+        for task in (termination_task, deadline_task):
+            if task is not None and not task.done():
+                task.cancel()
+        if process.returncode is None:
+            await kill_process_group(process)
+
+    if code != 0:
+        _LOGGER.error(f"{job_tag} failed to run command, {command_line_str}")
+
+    return code
+
+
+class _Pdb2pqrTerminated(BaseException):
+    """Raised in a pool process when its pdb2pqr job receives SIGTERM.
+
+    It is not an Exception so that pdb2pqr's error handling cannot catch it.
+    """
+
+
+# The state of a pdb2pqr pool process, see _init_pdb2pqr_process
+_PDB2PQR_CONNECTION = None
+_PDB2PQR_RUNNING = False
+
+
+def _terminate_pdb2pqr(signal_number, frame):
+    if _PDB2PQR_RUNNING:
+        raise _Pdb2pqrTerminated(signal_number)
+
+
+def _init_pdb2pqr_process(connection):
+    """Load pdb2pqr into a new pool process.
+
+    The pdb2pqr and PROPKA modules are imported and the topology
+    definitions are parsed once. Each job gets its own copy of the
+    definitions, unpickled from a snapshot, which is much faster than
+    parsing the XML files again.
+
+    Args:
+        connection (multiprocessing.connection.Connection): The process's
+            end of the pipe to the worker, where jobs report their pid.
+    """
+    global _PDB2PQR_CONNECTION
+    _PDB2PQR_CONNECTION = connection
+    signal.signal(signal.SIGTERM, _terminate_pdb2pqr)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Each job sets up the log handlers the pdb2pqr30 command would
+    root = getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    import pickle
+    from pdb2pqr import io
+
+    importlib.import_module("pdb2pqr.main")
+    snapshot = pickle.dumps(io.get_definitions(), pickle.HIGHEST_PROTOCOL)
+    load_definitions = io.get_definitions
+
+    def get_definitions(*args, **kwargs):
+        if args or kwargs:
+            return load_definitions(*args, **kwargs)
+        return pickle.loads(snapshot)
+
+    io.get_definitions = get_definitions
+
+
+def _pdb2pqr_process(connection):
+    """The main loop of a pdb2pqr pool process.
+
+    Each job arrives on the connection as the arguments of _run_pdb2pqr,
+    and its exit code is sent back. None, or the worker closing its end of
+    the pipe, ends the process.
+    """
+    _init_pdb2pqr_process(connection)
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        connection.send(_run_pdb2pqr(*job))
+
+
+def _pdb2pqr_log_handlers(output_pqr: str, level: str) -> List[Handler]:
+    """The log file and console handlers pdb2pqr.io.setup_logger creates."""
+    output_path = Path(output_pqr)
+    log_file = Path(output_path.parent, output_path.stem + ".log")
+    log_handler = FileHandler(log_file)
+    log_handler.setFormatter(
+        Formatter(
+            "%(asctime)s %(levelname)s:%(filename)s:"
+            "%(lineno)d:%(funcName)s:%(message)s"
+        )
+    )
+    console = StreamHandler(sys.stderr)
+    console.setFormatter(Formatter("%(levelname)s:%(message)s"))
+    console.setLevel(level)
+    return [log_handler, console]
+
+
+def _run_pdb2pqr(
+    job_tag: str,
+    arguments: List[str],
+    cwd: str,
+    stdout_path: str,
+    stderr_path: str,
+) -> int:
+    """Run one job in a pool process the way the pdb2pqr30 command would.
+
+    stdout and stderr are redirected to the named pipes the worker reads
+    and the job runs in its own directory. The peak RSS of the process is
+    reset first, so VmHWM only covers this job.
+
+    Return:
+        int: The exit code pdb2pqr30 would have returned.
+    """
+    global _PDB2PQR_RUNNING
+    import traceback
+    from pdb2pqr.io import DuplicateFilter
+    from pdb2pqr.main import build_main_parser, main_driver
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    for fd, path in ((1, stdout_path), (2, stderr_path)):
+        pipe = os.open(path, os.O_WRONLY)
+        os.dup2(pipe, fd)
+        os.close(pipe)
+    with contextlib.suppress(OSError):
+        with open("/proc/self/clear_refs", "w") as fout:
+            fout.write("5")
+    root = getLogger()
+    log_filter = DuplicateFilter()
+    handlers = []
+    previous_cwd = os.getcwd()
+    code = 1
+    try:
+        os.chdir(cwd)
+        # A SIGTERM sent once the worker knows the job started must not
+        # interrupt the message that tells it so
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+        _PDB2PQR_RUNNING = True
+        _PDB2PQR_CONNECTION.send(("started", job_tag, getpid()))
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+        args = build_main_parser().parse_args(arguments)
+        handlers = _pdb2pqr_log_handlers(args.output_pqr, args.log_level)
+        for handler in handlers:
+            root.addHandler(handler)
+        root.addFilter(log_filter)
+        root.setLevel(args.log_level)
+        main_driver(args)
+        code = 0
+    except _Pdb2pqrTerminated:
+        code = 143
+    except SystemExit as error:
+        if error.code is None or isinstance(error.code, int):
+            code = error.code or 0
+        else:
+            print(error.code, file=sys.stderr)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        _PDB2PQR_RUNNING = False
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+        root.removeFilter(log_filter)
+        for handler in handlers:
+            root.removeHandler(handler)
+            handler.close()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, original in zip((1, 2), saved):
+            os.dup2(original, fd)
+            os.close(original)
+        os.chdir(previous_cwd)
+    return code
+
+
+async def _wait_readable(fileno: int, timeout: Optional[float] = None) -> bool:
+    """Wait in the event loop for a file descriptor to become readable.
+
+    The pool waits on its pipes and process sentinels this way rather than
+    with asyncio.to_thread, which would hold a thread of the default
+    executor, shared by the whole worker, for the length of each job.
+
+    Returns:
+        bool: False if timeout seconds passed first.
+    """
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+    loop.add_reader(fileno, lambda: readable.done() or readable.set_result(None))
+    try:
+        done, _ = await asyncio.wait([readable], timeout=timeout)
+        return bool(done)
+    finally:
+        loop.remove_reader(fileno)
+
+
+@dataclass
+class _Pdb2pqrProcess:
+    """A pdb2pqr pool process and the worker's end of its pipe."""
+
+    process: Any
+    connection: Any
+    jobs: int = 0
+
+
+class Pdb2pqrPool:
+    """Run pdb2pqr jobs through its Python API in warm processes.
+
+    Every pdb2pqr30 subprocess pays for an interpreter start-up, the
+    imports of pdb2pqr and PROPKA and the parsing of the topology
+    definitions, which for small proteins takes longer than the
+    protonation itself. The pool keeps processes with all of that loaded
+    and replaces each one after jobs_per_process jobs, so memory and
+    state left behind by pdb2pqr do not build up. The processes are
+    spawned rather than forked, so they don't inherit the event loop,
+    sockets or credentials of the worker.
+
+    Each process runs one job at a time and gets its jobs over a pipe of
+    its own, so a job can be stopped without touching the others: a
+    process that does not stop within the grace period after SIGTERM is
+    killed, and only that process is replaced.
+
+    A job's stdout and stderr reach the worker through two named pipes, so
+    they are logged, capped and mirrored like a subprocess's. The job
+    reports the pid of its process when it starts, which the
+    ResourceSampler, the OutputWatcher and SIGTERM are pointed at.
+
+    Note that RUSAGE_CHILDREN only counts processes that have exited, so
+    the rusage in the metrics of a pooled job says nothing about the job;
+    its peak RSS comes from the ResourceSampler.
+    """
+
+    def __init__(self, processes: int = 1, jobs_per_process: int = 20):
+        self.processes = processes
+        self.jobs_per_process = jobs_per_process
+        self._context = None
+        self._idle: List[_Pdb2pqrProcess] = []
+        self._busy = 0
+        self._closed = False
+        self._retiring: Set[asyncio.Task] = set()
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> Optional[Pdb2pqrPool]:
+        if not settings.pdb2pqr_pool:
+            return None
+        return cls(settings.max_concurrent_jobs, settings.pdb2pqr_jobs_per_process)
+
+    def start(self):
+        """Spawn the processes; they load pdb2pqr in the background."""
+        import multiprocessing
+
+        self._context = multiprocessing.get_context("spawn")
+        while len(self._idle) + self._busy < self.processes:
+            self._idle.append(self._spawn())
+
+    def _spawn(self) -> _Pdb2pqrProcess:
+        connection, child_connection = self._context.Pipe()
+        process = self._context.Process(
+            target=_pdb2pqr_process,
+            args=(child_connection,),
+            name="pdb2pqr",
+            daemon=True,
+        )
+        process.start()
+        # Only the process holds its end, so a dead process reads as EOF
+        child_connection.close()
+        return _Pdb2pqrProcess(process, connection)
+
+    def _acquire(self) -> _Pdb2pqrProcess:
+        if self._context is None:
+            self.start()
+        while self._idle:
+            worker = self._idle.pop()
+            if worker.process.is_alive():
+                return worker
+            self._retire(worker)
+        return self._spawn()
+
+    def _release(self, worker: _Pdb2pqrProcess, reusable: bool):
+        """Take back a process after a job, or replace it."""
+        worker.jobs += 1
+        if (
+            reusable
+            and not self._closed
+            and worker.jobs < self.jobs_per_process
+            and worker.process.is_alive()
+        ):
+            self._idle.append(worker)
+            return
+        self._retire(worker)
+        if not self._closed and len(self._idle) + self._busy < self.processes:
+            self._idle.append(self._spawn())
+
+    def _retire(self, worker: _Pdb2pqrProcess):
+        """Ask a process to exit and reap it in the background."""
+        with contextlib.suppress(OSError, ValueError):
+            worker.connection.send(None)
+        worker.connection.close()
+        task = asyncio.create_task(self._join(worker.process))
+        self._retiring.add(task)
+        task.add_done_callback(self._retiring.discard)
+
+    @staticmethod
+    async def _join(process):
+        if not await _wait_readable(process.sentinel, 5):
+            process.kill()
+            await _wait_readable(process.sentinel)
+        process.join()
+
+    @staticmethod
+    async def _wait(worker: _Pdb2pqrProcess, started: asyncio.Future):
+        """Wait for the job sent to a process to start and to finish.
+
+        Returns:
+            Optional[int]: The exit code of the job, or None if the process
+                died.
+        """
+        try:
+            while True:
+                while not worker.connection.poll():
+                    await _wait_readable(worker.connection.fileno())
+                message = worker.connection.recv()
+                if isinstance(message, tuple):
+                    if not started.done():
+                        started.set_result(message[2])
+                    continue
+                return message
+        except (EOFError, OSError):
+            return None
+
+    @staticmethod
+    async def _open_pipe(path: str):
+        """Create a named pipe and a StreamReader for its output.
+
+        The pipe is also held open for writing until the job has opened it,
+        otherwise the reader would see the end of the stream at once.
+
+        Returns:
+            Tuple[asyncio.StreamReader, asyncio.ReadTransport, int]: The
+                reader, its transport and the file descriptor to close once
+                the job has started.
+        """
+        os.mkfifo(path)
+        reader = asyncio.StreamReader()
+        pipe = open(os.open(path, os.O_RDONLY | os.O_NONBLOCK), "rb", buffering=0)
+        hold = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        transport, _ = await asyncio.get_running_loop().connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), pipe
+        )
+        return reader, transport, hold
+
+    @staticmethod
+    async def _stop(worker: _Pdb2pqrProcess, job: asyncio.Future, grace: float):
+        """Send SIGTERM to the job, and SIGKILL to its process after grace."""
+        pid = worker.process.pid
+        try:
+            os.kill(pid, signal.SIGTERM)
+            print("Sent SIGTERM, waiting for process to finish", flush=True)
+            await asyncio.wait([job], timeout=grace)
+            if job.done():
+                print("Process finished", flush=True)
+                return
+            print("Process did not finish in time, killing it", flush=True)
+            os.kill(pid, signal.SIGKILL)
+            await asyncio.wait([job])
+            print("Process killed", flush=True)
+        except ProcessLookupError:
+            print("Process already finished", flush=True)
+
+    async def _monitor_termination(
+        self, worker: _Pdb2pqrProcess, job: asyncio.Future, stop_event: asyncio.Event
+    ):
+        await stop_event.wait()
+        print("Terminating process", flush=True)
+        await self._stop(worker, job, 5)
 
-        done, pending = await asyncio.wait(
-            [stdout_task, stderr_task, termination_task],
-            return_when=asyncio.FIRST_COMPLETED,
+    async def _enforce_deadline(
+        self,
+        job_tag: str,
+        worker: _Pdb2pqrProcess,
+        job: asyncio.Future,
+        timeout: float,
+        kill_after: float,
+    ) -> bool:
+        """Stop a job that runs longer than timeout, like enforce_deadline."""
+        await asyncio.wait([job], timeout=timeout)
+        if job.done():
+            return False
+        _LOGGER.error(
+            "%s exceeded its maximum run time of %s seconds", job_tag, timeout
         )
+        await self._stop(worker, job, kill_after)
+        return True
 
-        if termination_task in done:
-            print("Termination task requested, cancelling...", flush=True)
-            for task in pending:
-                task.cancel()
-            try:
-                await asyncio.gather(*pending, return_exceptions=True)
-            except asyncio.CancelledError:
-                pass
-            return 143
-
-    code = await process.wait()
-    # Handle signal termination
-    if code < 0:
-        # Convert negative signal code to conventional exit code (128 + signal number)
-        signal_number = -code  # Make the negative code positive
-        code = 128 + signal_number
-
-    if code != 0:
-        _LOGGER.error(f"{job_tag} failed to run command, {command_line_str}")
+    async def execute(
+        self,
+        job_tag: str,
+        arguments: List[str],
+        stdout_filename: str,
+        stderr_filename: str,
+        stop_event: asyncio.Event,
+        cwd: os.PathLike,
+        on_spawn: Optional[Callable[[int], None]] = None,
+        settings: Optional[Settings] = None,
+        timeout: Optional[float] = None,
+        kill_after: float = 30,
+    ) -> int:
+        """Run pdb2pqr in a pool process, like execute_command_async.
 
-    return code
+        Args:
+            job_tag (str): The unique job id.
+            arguments (List[str]): The command line arguments of pdb2pqr30.
+            stdout_filename (str): The name of the output file for stdout.
+            stderr_filename (str): The name of the output file for stderr.
+            stop_event (asyncio.Event): The event to stop the job.
+            cwd (os.PathLike): The directory to run the job in.
+            on_spawn (Callable[[int], None]): Called with the pid of the
+                process running the job.
+            settings (Settings): The settings for piping the output.
+            timeout (float): The seconds after which the job is sent
+                SIGTERM, or None to let it run.
+            kill_after (float): The seconds after SIGTERM before SIGKILL.
+        Return:
+            exit_code (int): The exit code of the job.
+        """
+        worker = self._acquire()
+        self._busy += 1
+        started = asyncio.get_running_loop().create_future()
+        job = None
+        try:
+            with contextlib.ExitStack() as stack:
+                pipes = stack.enter_context(
+                    tempfile.TemporaryDirectory(prefix="pdb2pqr-")
+                )
+                files = [
+                    stack.enter_context(open(file, "wb"))
+                    for file in (stdout_filename, stderr_filename)
+                ]
+                readers = []
+                holds = []
+                for name in ("stdout", "stderr"):
+                    reader, transport, hold = await self._open_pipe(
+                        os.path.join(pipes, name)
+                    )
+                    stack.callback(transport.close)
+                    readers.append(reader)
+                    holds.append(hold)
+                try:
+                    worker.connection.send(
+                        (
+                            job_tag,
+                            arguments,
+                            str(cwd),
+                            os.path.join(pipes, "stdout"),
+                            os.path.join(pipes, "stderr"),
+                        )
+                    )
+                    job = asyncio.ensure_future(self._wait(worker, started))
+                    await asyncio.wait(
+                        [started, job], return_when=asyncio.FIRST_COMPLETED
+                    )
+                except OSError as error:
+                    _LOGGER.error("%s pdb2pqr pool process died: %s", job_tag, error)
+                    return 1
+                finally:
+                    for hold in holds:
+                        os.close(hold)
+                termination_task = None
+                deadline_task = None
+                if started.done():
+                    if on_spawn is not None:
+                        on_spawn(started.result())
+                    termination_task = asyncio.create_task(
+                        self._monitor_termination(worker, job, stop_event)
+                    )
+                    if timeout:
+                        deadline_task = asyncio.create_task(
+                            self._enforce_deadline(
+                                job_tag, worker, job, timeout, kill_after
+                            )
+                        )
+                streams = asyncio.gather(
+                    read_stream(readers[0], False, files[0], settings),
+                    read_stream(readers[1], True, files[1], settings),
+                )
+                done, pending = await asyncio.wait(
+                    [task for task in (streams, termination_task) if task],
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if termination_task in done:
+                    print("Termination task requested, cancelling...", flush=True)
+                    if deadline_task:
+                        pending.add(deadline_task)
+                    for task in pending:
+                        task.cancel()
+                    await asyncio.gather(*pending, return_exceptions=True)
+                    return 143
+
+            if termination_task:
+                termination_task.cancel()
+            code = await asyncio.shield(job)
+            if code is None:
+                _LOGGER.error("%s pdb2pqr pool process died", job_tag)
+                code = 1
+            if deadline_task and await deadline_task:
+                code = TIMEOUT_EXIT_CODE
+        finally:
+            # The process is only reused once it is known to be idle
+            if job is not None and not job.done():
+                with contextlib.suppress(ProcessLookupError):
+                    os.kill(worker.process.pid, signal.SIGKILL)
+                await asyncio.wait([job])
+            self._busy -= 1
+            self._release(worker, job is not None and job.result() is not None)
+
+        if code != 0:
+            _LOGGER.error(f"{job_tag} failed to run pdb2pqr, {' '.join(arguments)}")
+
+        return code
+
+    async def close(self):
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for worker in idle:
+            self._retire(worker)
+        if self._retiring:
+            await asyncio.gather(*self._retiring)
+
+
+def job_attempts(message: QueueMessage, job_info: Dict) -> Optional[int]:
+    """How many times the job in a message was received to be run.
+
+    Releases of prefetched messages also bump the dequeue count; they are
+    recorded in the job info by Queue.release and are not counted.
+    """
+    if message.dequeue_count is None:
+        return None
+    return message.dequeue_count - job_info.get(Queue.RELEASES_KEY, 0)
 
 
 def get_job_info(
@@ -736,18 +4327,272 @@ def get_job_info(
     return job_info
 
 
+STRUCTURE_SUFFIXES = (".pdb", ".pqr", ".ent", ".cif", ".mmcif")
+
+
+@dataclass
+class JobSize:
+    """A cheap estimate of the size of a job, from its input files.
+
+    atoms is the number of ATOM and HETATM records in the structure inputs
+    and grid_points the number of grid points of all the elec blocks of an
+    APBS input file, which drive the run time of pdb2pqr and APBS.
+    """
+
+    atoms: int = 0
+    grid_points: int = 0
+
+    def exceeds(self, atoms: int, grid_points: int) -> bool:
+        return self.atoms > atoms or self.grid_points > grid_points
+
+    def runtime(self, settings: Settings) -> float:
+        """A rough estimate of the seconds the job will run."""
+        return (
+            self.grid_points * settings.runtime_per_grid_point
+            + self.atoms * settings.runtime_per_atom
+        )
+
+
+def count_atoms(path: Path) -> int:
+    """Count the ATOM and HETATM records of a PDB, PQR or mmCIF file."""
+    with open(path, "rb") as fin:
+        return sum(1 for line in fin if line.startswith((b"ATOM", b"HETATM")))
+
+
+def count_grid_points(path: Path) -> int:
+    """Count the grid points of all the elec blocks in an APBS input file.
+
+    Each block solves on dime[0] * dime[1] * dime[2] points. A parallel
+    focusing (mg-para) block uses that dime for each of its pdime pieces,
+    but one APBS process only solves one piece, so pdime is not counted.
+    """
+    with open(path, errors="replace") as fin:
+        tokens = [token.lower() for line in fin for token in line.split("#")[0].split()]
+    total = 0
+    for index, token in enumerate(tokens):
+        if token == "dime":
+            try:
+                total += math.prod(
+                    int(value) for value in tokens[index + 1 : index + 4]
+                )
+            except ValueError:
+                continue
+    return total
+
+
+def estimate_job_size(rundir: Path, input_names: List[str]) -> JobSize:
+    """Estimate the size of a job from its downloaded input files.
+
+    Args:
+        rundir (Path): The directory of the job.
+        input_names (List[str]): The names of the input files in rundir.
+    Return:
+        JobSize: The atoms and grid points of the job.
+    """
+    size = JobSize()
+    for name in input_names:
+        path = rundir / name
+        suffix = path.suffix.lower()
+        try:
+            if suffix in STRUCTURE_SUFFIXES:
+                size.atoms += count_atoms(path)
+            elif suffix == ".in":
+                size.grid_points += count_grid_points(path)
+        except OSError as error:
+            _LOGGER.warning("Unable to read %s to estimate its size: %s", path, error)
+    return size
+
+
+class MemoryAdmission:
+    """Predict the peak RSS of APBS jobs and only start the ones that fit.
+
+    APBS keeps the multigrid solver of every elec block until it exits, so
+    its memory is close to linear in the grid points of the input file
+    (psize.py assumes 200 bytes per point), plus a little per atom and a
+    fixed base. A job predicted to need more than capacity can never run
+    on this replica and is failed before it starts, instead of being
+    killed for running out of memory and retried until it becomes a
+    poison message. Other jobs wait until the predictions of the jobs
+    already running leave room for theirs.
+
+    After each job calibrate() derives the cost per grid point from the
+    peak RSS the ResourceSampler measured. Jobs whose prediction is mostly
+    the base and atom terms say little about that cost and are skipped.
+    The learned cost is a high quantile of the last SAMPLES estimates, so
+    it follows the jobs as they change, in both directions, and it stays
+    within MAX_ADJUSTMENT times the configured cost. It only decides how
+    long jobs wait for each other: whether a job can run at all is judged
+    with the configured costs, so a few odd samples cannot fail jobs that
+    fit. The predictions and peaks are written to the job metrics, so the
+    configured costs can be refitted offline.
+    """
+
+    SAMPLES = 20
+    QUANTILE = 0.9
+    MAX_ADJUSTMENT = 2.0
+
+    def __init__(
+        self,
+        capacity: int,
+        per_grid_point: float = 200.0,
+        per_atom: int = 1024,
+        base: int = 64 * 1024**2,
+    ):
+        self.capacity = capacity
+        self.per_grid_point = per_grid_point
+        self.per_atom = per_atom
+        self.base = base
+        self.learned_per_grid_point = per_grid_point
+        self.reserved = 0
+        self._samples: Deque[float] = deque(maxlen=self.SAMPLES)
+        self._condition = asyncio.Condition()
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> Optional[MemoryAdmission]:
+        if not settings.memory_admission:
+            return None
+        return cls(
+            settings.memory_capacity,
+            settings.memory_per_grid_point,
+            settings.memory_per_atom,
+            settings.memory_base,
+        )
+
+    def _fixed(self, size: JobSize) -> float:
+        """The part of the model that does not depend on the grid."""
+        return self.base + self.per_atom * size.atoms
+
+    def predict(self, size: JobSize) -> int:
+        """The predicted peak RSS in bytes of an APBS job of this size."""
+        return int(self._fixed(size) + self.learned_per_grid_point * size.grid_points)
+
+    def rejection(self, size: JobSize) -> Optional[str]:
+        """The reason a job can never run here, or None if it fits."""
+        predicted = self._fixed(size) + self.per_grid_point * size.grid_points
+        if predicted <= self.capacity:
+            return None
+        return (
+            f"The job needs about {predicted / 1024**3:.1f} GiB of memory, more "
+            f"than the {self.capacity / 1024**3:.1f} GiB available to a job. "
+            "Reduce the grid dimensions (dime) in the APBS input file."
+        )
+
+    async def acquire(self, predicted: int):
+        """Wait until the job fits next to the running jobs and reserve it."""
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: not self.reserved or self.reserved + predicted <= self.capacity
+            )
+            self.reserved += predicted
+
+    async def release(self, predicted: int):
+        async with self._condition:
+            self.reserved -= predicted
+            self._condition.notify_all()
+
+    def calibrate(self, size: JobSize, peak_rss: int) -> Optional[float]:
+        """Learn the cost per grid point from the measured peak of a job.
+
+        Returns:
+            float: The cost per grid point the job implies, or None if the
+                job was skipped.
+        """
+        fixed = self._fixed(size)
+        if self.per_grid_point * size.grid_points < fixed:
+            return None
+        implied = (peak_rss - fixed) / size.grid_points
+        if implied <= 0:
+            return None
+        self._samples.append(implied)
+        ranked = sorted(self._samples)
+        learned = ranked[int(self.QUANTILE * (len(ranked) - 1))]
+        self.learned_per_grid_point = min(
+            max(learned, self.per_grid_point / self.MAX_ADJUSTMENT),
+            self.per_grid_point * self.MAX_ADJUSTMENT,
+        )
+        _LOGGER.debug(
+            "APBS used %.1f bytes per grid point; predicting %.1f",
+            implied,
+            self.learned_per_grid_point,
+        )
+        return implied
+
+
+def job_deadline(job_info: Dict, settings: Settings) -> Optional[float]:
+    """The seconds a job may run before it is sent SIGTERM.
+
+    This is the max_run_time of the job, or else settings.job_timeout;
+    None means the job may run until the replica times out.
+    """
+    max_run_time = job_info.get("max_run_time")
+    if max_run_time is not None:
+        try:
+            return float(max_run_time) or None
+        except (TypeError, ValueError):
+            _LOGGER.warning("Ignoring invalid max_run_time, %s", max_run_time)
+    return settings.job_timeout or None
+
+
 # TODO: intendo - 2021/05/10 - Break run_job into multiple functions
 #                              to reduce complexity.
+async def complete_from_cache(
+    job_tag: str,
+    job_type: str,
+    record: Dict,
+    rundir: Path,
+    output_storage: BlobStore,
+    status: StatusManager,
+    metrics: JobMetrics,
+    settings: Settings,
+) -> int:
+    """Finish a job whose outputs were copied from the result cache.
+
+    A fresh {job_type}-metrics.json that records the cache hit is written
+    and uploaded, and the job is marked COMPLETE.
+
+    Return:
+        int: The exit code of the job, always 0.
+    """
+    metrics.start_time = metrics.end_time = time()
+    metrics.exit_code = 0
+    metrics.disk_usage = record.get("disk_storage_in_bytes") or 0
+    metrics.cached_from = record["job_tag"]
+    metrics_path = metrics.write_metrics(job_tag, job_type, rundir)
+    manifest = [OutputFile.from_path(rundir, metrics_path)]
+    with metrics.stage("upload"):
+        await upload_outputs(job_tag, manifest, output_storage, settings, True)
+    metrics.bytes_uploaded = sum(output.stored_size or 0 for output in manifest)
+    output_files = [f"{job_tag}/{name}" for name in record["outputs"]]
+    output_files.append(f"{job_tag}/{metrics_path.name}")
+    with metrics.stage("cleanup"):
+        cleanup_job(job_tag, rundir, settings)
+    status.update(JOBSTATUS.COMPLETE, output_files)
+    await status.flush()
+    metrics.stages["status"] = status.seconds
+    metrics.status_retries = status.retries
+    return 0
+
+
 async def run_job(
     message: QueueMessage,
-    output_storage: Storage,
-    input_storage: Storage,
+    output_storage: BlobStore,
+    input_storage: BlobStore,
     metrics: JobMetrics,
     settings: Settings,
     stop_event: asyncio.Event,
+    input_cache: Optional[InputCache] = None,
+    result_cache: Optional[ResultCache] = None,
+    pdb2pqr_pool: Optional[Pdb2pqrPool] = None,
+    router: Optional[Callable[[JobSize], Awaitable[Optional[str]]]] = None,
+    admission: Optional[MemoryAdmission] = None,
+    lease: Optional[MessageLease] = None,
 ) -> int:
     """Run the job described in the queue message.
 
+    Each job runs in its own directory under settings.job_path and never
+    changes the working directory of the process, so several jobs can run
+    concurrently.
+
     Args:
         message (QueueMessage): The message from the queue.
         output_storage (Storage): The storage for output files.
@@ -755,6 +4600,17 @@ async def run_job(
         metrics (JobMetrics): The metrics for the job.
         settings (Settings): The settings for the job.
         stop_event (asyncio.Event): The event to stop the job.
+        input_cache (InputCache): The local cache of inputs, if enabled.
+        result_cache (ResultCache): The cache of job results, if enabled.
+        pdb2pqr_pool (Pdb2pqrPool): The warm processes for pdb2pqr jobs,
+            if enabled.
+        router (Callable): Given the estimated size of the job, forwards it
+            to another queue and returns that queue's name, or returns None
+            to run it here. metrics.routed_to records where it went.
+        admission (MemoryAdmission): Rejects APBS jobs that cannot fit in
+            memory and holds back those that do not fit yet, if enabled.
+        lease (MessageLease): The lease on the message, which is extended
+            to the declared or estimated run time of the job.
     Return:
         int: The exit code of the job.
     """
@@ -767,68 +4623,45 @@ async def run_job(
     job_type = job_info["job_type"]
     job_tag = f"{job_info['job_date']}/{job_info['job_id']}"
     rundir = pathlib.Path(settings.job_path) / job_tag
+    status = StatusManager(output_storage, job_tag, job_type)
 
     # Prepare job directory and download input files
     makedirs(rundir, exist_ok=True)
-    chdir(rundir)
-
-    for file in job_info["input_files"]:
-        if "https" in file:
-            name = f"{job_tag}/{file.split('/')[-1]}"
-            try:
-                request.urlretrieve(file, f"{settings.job_path}/{name}")
-            except Exception as error:
-                # TODO: intendo 2021/05/05 - Find more specific exception
-                _LOGGER.exception(
-                    "%s ERROR: Download failed for file, %s \n\t%s",
-                    job_tag,
-                    name,
-                    error,
-                )
-                update_status(
-                    output_storage,
-                    job_tag,
-                    job_type,
-                    JOBSTATUS.FAILED,
-                    [],
-                    "Failed to download input file. Job did not run.",
-                )
-                return cleanup_job(job_tag, rundir, settings)
-
-        else:
-            try:
-                # DWHS: TODO -- check where this downloads to
-                _LOGGER.info(f"Downloading file, {file} to {file}")
-                input_storage.download_file(file, Path(file).name)
-                # s3client.download_file(
-                #     inbucket, file, f"{GLOBAL_VARS['JOB_PATH']}{file}"
-                # )
-            except Exception as error:
-                # TODO: intendo 2021/05/05 - Find more specific exception
-                _LOGGER.exception(
-                    "%s ERROR: Download failed for file, %s \n\t%s",
-                    job_tag,
-                    file,
-                    error,
-                )
-                update_status(
-                    output_storage,
-                    job_tag,
-                    job_type,
-                    JOBSTATUS.FAILED,
-                    [],
-                    "Failed to download input file. Job did not run.",
-                )
-                return cleanup_job(job_tag, rundir, settings)
 
-    # Run job and record associated metrics
-    update_status(
-        output_storage,
-        job_tag,
-        job_type,
-        JOBSTATUS.RUNNING,
-        [],
+    try:
+        with metrics.stage("download"):
+            metrics.bytes_downloaded = await download_inputs(
+                job_tag,
+                job_info["input_files"],
+                rundir,
+                input_storage,
+                settings,
+                input_cache,
+            )
+    except Exception as error:
+        # TODO: intendo 2021/05/05 - Find more specific exception
+        _LOGGER.exception(
+            "%s ERROR: Download failed for input files \n\t%s",
+            job_tag,
+            error,
+        )
+        status.update(
+            JOBSTATUS.FAILED, [], "Failed to download input file. Job did not run."
+        )
+        await status.flush()
+        metrics.stages["status"] = status.seconds
+        metrics.status_retries = status.retries
+        with metrics.stage("cleanup"):
+            return cleanup_job(job_tag, rundir, settings)
+
+    metrics.size = estimate_job_size(
+        rundir, [file.split("/")[-1] for file in job_info["input_files"]]
     )
+    if router is not None:
+        metrics.routed_to = await router(metrics.size)
+        if metrics.routed_to:
+            with metrics.stage("cleanup"):
+                return cleanup_job(job_tag, rundir, settings)
 
     # TODO: (Eo300) consider moving binary
     #       command (e.g. 'apbs', 'pdb2pqr30') into SQS message
@@ -841,29 +4674,136 @@ async def run_job(
     else:
         raise KeyError(f"Invalid job type, {job_type}")
 
-    # DWHS TODO -- move this elsewhere
-    # if "max_run_time" in job_info:
-    #     sqs = client("sqs", region_name=GLOBAL_VARS["AWS_REGION"])
-    #     sqs.change_message_visibility(
-    #         QueueUrl=queue_url,
-    #         ReceiptHandle=receipt_handle,
-    #         VisibilityTimeout=int(job_info["max_run_time"]),
-    #     )
+    # Reuse the outputs of an identical earlier job when possible
+    result_key = None
+    if result_cache:
+        result_key = await result_cache.job_key(job_info, rundir)
+    if result_key:
+        record = await result_cache.restore(result_key, job_tag, job_info["job_id"])
+        if record is not None:
+            return await complete_from_cache(
+                job_tag,
+                job_type,
+                record,
+                rundir,
+                output_storage,
+                status,
+                metrics,
+                settings,
+            )
+
+    # Fail jobs that can never fit in memory instead of letting them be
+    # killed and retried, and wait for room for the others
+    if admission and JOBTYPE.APBS.name.lower() in job_type:
+        metrics.predicted_rss = admission.predict(metrics.size)
+        metrics.rejected = admission.rejection(metrics.size)
+        if metrics.rejected:
+            _LOGGER.error("%s ERROR: %s", job_tag, metrics.rejected)
+            status.update(JOBSTATUS.FAILED, [], metrics.rejected)
+            await status.flush()
+            metrics.stages["status"] = status.seconds
+            metrics.status_retries = status.retries
+            with metrics.stage("cleanup"):
+                cleanup_job(job_tag, rundir, settings)
+            return ret_val
+        with metrics.stage("admission"):
+            await admission.acquire(metrics.predicted_rss)
+
+    # Keep the message invisible for as long as the job may run: until
+    # its hard deadline, or else its estimated run time
+    metrics.max_run_time = job_deadline(job_info, settings)
+    if lease:
+        if metrics.max_run_time:
+            runtime = metrics.max_run_time + settings.kill_grace
+        else:
+            runtime = metrics.size.runtime(settings)
+        await lease.extend(runtime + lease.queue.visibility_timeout)
+
+    # Run job and record associated metrics. The running status is only
+    # written if the job is still running after settings.status_flush_delay.
+    status.update(JOBSTATUS.RUNNING, [])
+    status.flush_later(settings.status_flush_delay)
 
     # Execute job binary with appropriate arguments and record metrics
+    watcher = None
+    if settings.pipeline_uploads:
+        watcher = OutputWatcher(job_tag, rundir, output_storage, settings)
+    sampler = None
+    if settings.resource_sample_interval > 0:
+        sampler = ResourceSampler(settings.resource_sample_interval)
+    spawn_hooks = [hook.set_pid for hook in (watcher, sampler) if hook]
+
+    def on_spawn(pid: int):
+        for hook in spawn_hooks:
+            hook(pid)
+
     try:
         metrics.start_time = time()
-        metrics.exit_code = await execute_command_async(
-            job_tag,
-            command,
-            f"{job_type}.stdout.txt",
-            f"{job_type}.stderr.txt",
-            stop_event,
-        )
+        if pdb2pqr_pool and JOBTYPE.PDB2PQR.name.lower() in job_type:
+            execution = pdb2pqr_pool.execute(
+                job_tag,
+                job_info["command_line_args"].split(),
+                rundir / f"{job_type}.stdout.txt",
+                rundir / f"{job_type}.stderr.txt",
+                stop_event,
+                cwd=rundir,
+                on_spawn=on_spawn,
+                settings=settings,
+                timeout=metrics.max_run_time,
+                kill_after=settings.kill_grace,
+            )
+        else:
+            execution = execute_command_async(
+                job_tag,
+                command,
+                rundir / f"{job_type}.stdout.txt",
+                rundir / f"{job_type}.stderr.txt",
+                stop_event,
+                cwd=rundir,
+                on_spawn=on_spawn,
+                settings=settings,
+                timeout=metrics.max_run_time,
+                kill_after=settings.kill_grace,
+            )
+        sampling = asyncio.create_task(sampler.collect()) if sampler else None
+        try:
+            with metrics.stage("execute"):
+                if watcher:
+                    metrics.exit_code = await watcher.watch(execution)
+                else:
+                    metrics.exit_code = await execution
+        finally:
+            if sampling:
+                sampling.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await sampling
+            if metrics.predicted_rss:
+                await admission.release(metrics.predicted_rss)
         metrics.end_time = time()
         # We need to create the {job_type}-metrics.json before we upload
-        # the files to the S3_TOPLEVEL_BUCKET.
-        metrics.write_metrics(job_tag, job_type, ".")
+        # the files to the S3_TOPLEVEL_BUCKET. The run directory is only
+        # walked once; the manifest gives the disk usage, the files to
+        # upload and the list of output files.
+        manifest = scan_outputs(rundir)
+        if settings.dx_companions and metrics.exit_code == 0:
+            manifest.extend(
+                await convert_dx_outputs(
+                    job_tag, rundir, manifest, settings.dx_concurrency
+                )
+            )
+        metrics.disk_usage = sum(output.size for output in manifest)
+        if settings.bundle_subdirectories:
+            manifest = await bundle_subdirectories(
+                job_tag, job_info["job_id"], rundir, manifest
+            )
+        if sampler:
+            metrics.peak_rss = sampler.peak_rss or None
+            if metrics.predicted_rss and metrics.peak_rss and metrics.exit_code == 0:
+                admission.calibrate(metrics.size, metrics.peak_rss)
+            resources_path = sampler.write(rundir / f"{job_type}-resources.json")
+            manifest.append(OutputFile.from_path(rundir, resources_path))
+        metrics_path = metrics.write_metrics(job_tag, job_type, rundir)
+        manifest.append(OutputFile.from_path(rundir, metrics_path))
     except Exception as error:
         # TODO: intendo 2021/05/05 - Find more specific exception
         _LOGGER.exception(
@@ -873,70 +4813,74 @@ async def run_job(
         )
         # TODO: Should this return 1 because noone else will succeed?
         ret_val = 1
+        manifest = scan_outputs(rundir)
 
-    # Upload directory contents to S3
-    for file in listdir("."):
-        try:
-            file_path = f"{job_tag}/{file}"
-            _LOGGER.info("%s Uploading file to output bucket, %s", job_tag, file)
-            output_storage.upload_file(
-                filepath=os.path.join(settings.job_path, file_path),
-                prefix=job_tag,
-                name=file,
-            )
-            # output_storage.upload_file(
-            #     os.path.join(settings.job_path, file_path), file_path
-            # )
-        except Exception as error:
-            _LOGGER.exception(
-                "%s ERROR: Failed to upload file, %s \n\t%s",
-                job_tag,
-                f"{job_tag}/{file}",
-                error,
-            )
-            ret_val = 1
-
-    # TODO: 2021/03/30, Elvis - Will need to address how we bundle output
-    #       subdirectory for PDB2PKA when used; I previous bundled it as
-    #       a compressed tarball (i.e. "{job_id}-pdb2pka_output.tar.gz")
+    # Upload directory contents to S3. Blobs may already exist if they
+    # were uploaded early or partially copied from the result cache.
+    pending = watcher.remaining(manifest) if watcher else manifest
+    with metrics.stage("upload"):
+        uploaded = await upload_outputs(
+            job_tag,
+            pending,
+            output_storage,
+            settings,
+            overwrite=watcher is not None or result_key is not None,
+        )
+    metrics.bytes_uploaded = sum(output.stored_size or 0 for output in manifest)
+    if not uploaded:
+        ret_val = 1
 
     # Create list of output files
     input_files_no_id = [  # Remove job_id prefix from input file list
         "".join(name.split("/")[-1]) for name in job_info["input_files"]
     ]
     output_files = [
-        f"{job_tag}/{filename}"
-        for filename in listdir(".")
-        if filename not in input_files_no_id
+        f"{job_tag}/{output.name}"
+        for output in manifest
+        if output.name not in input_files_no_id
     ]
+    if result_key and uploaded and metrics.exit_code == 0:
+        await result_cache.store(
+            result_key,
+            job_tag,
+            job_info["job_id"],
+            [
+                output.name
+                for output in manifest
+                if output.name not in input_files_no_id
+                and output.name
+                not in (f"{job_type}-metrics.json", f"{job_type}-resources.json")
+            ],
+            metrics.disk_usage,
+        )
 
     # Cleanup job directory and update status
-    cleanup_job(job_tag, rundir, settings)
+    with metrics.stage("cleanup"):
+        cleanup_job(job_tag, rundir, settings)
     _LOGGER.info(f"Job completed with exit code: {metrics.exit_code}")
-    if metrics.exit_code != 0:
-        update_status(
-            output_storage,
-            job_tag,
-            job_type,
-            JOBSTATUS.FAILED,
+    if metrics.max_run_time and metrics.exit_code == TIMEOUT_EXIT_CODE:
+        status.update(
+            JOBSTATUS.TIMEOUT,
             output_files,
-            "Job failed to run.",
+            "Job exceeded its maximum run time of "
+            f"{metrics.max_run_time:g} seconds.",
         )
+        await status.flush()
+    elif metrics.exit_code != 0:
+        status.update(JOBSTATUS.FAILED, output_files, "Job failed to run.")
+        await status.flush()
     else:
-        update_status(
-            output_storage,
-            job_tag,
-            job_type,
-            JOBSTATUS.COMPLETE,
-            output_files,
-        )
+        status.update(JOBSTATUS.COMPLETE, output_files)
+        await status.flush()
+    metrics.stages["status"] = status.seconds
+    metrics.status_retries = status.retries
 
     return metrics.exit_code
 
 
-def dry_run(jobinfo, inputs, outputs: Storage, metrics):
+async def dry_run(jobinfo, inputs, outputs: BlobStore, metrics):
     job_tag = f"{jobinfo['job_date']}/{jobinfo['job_id']}"
-    update_status(
+    await update_status(
         outputs,
         job_tag,
         jobinfo["job_type"],
@@ -948,7 +4892,7 @@ def dry_run(jobinfo, inputs, outputs: Storage, metrics):
         fout.write(dumps(jobinfo, indent=4))
 
     # outputs.upload_file("jobinfo.json", jobinfo["job_id"])
-    outputs.upload_file(
+    await outputs.upload_file(
         filepath="jobinfo.json",
         prefix=job_tag,
         name="jobinfo.json",
@@ -956,6 +4900,272 @@ def dry_run(jobinfo, inputs, outputs: Storage, metrics):
     print(jobinfo)
 
 
+async def process_message(
+    message: QueueMessage,
+    queue: Queue,
+    output_storage: BlobStore,
+    input_storage: BlobStore,
+    settings: Settings,
+    stop_event: asyncio.Event,
+    input_cache: Optional[InputCache] = None,
+    result_cache: Optional[ResultCache] = None,
+    telemetry: Optional[Telemetry] = None,
+    pdb2pqr_pool: Optional[Pdb2pqrPool] = None,
+    admission: Optional[MemoryAdmission] = None,
+) -> int:
+    """Run the job in a message and remove the message from the queue.
+
+    Args:
+        message (QueueMessage): The message from the queue.
+        queue (Queue): The queue the message came from.
+        output_storage (Storage): The storage for output files.
+        input_storage (Storage): The storage for input files.
+        settings (Settings): The settings for the job.
+        stop_event (asyncio.Event): The event to stop the job.
+        input_cache (InputCache): The local cache of inputs, if enabled.
+        result_cache (ResultCache): The cache of job results, if enabled.
+        telemetry (Telemetry): Where to record the job's timings.
+        pdb2pqr_pool (Pdb2pqrPool): The warm processes for pdb2pqr jobs,
+            if enabled.
+        admission (MemoryAdmission): The memory admission control for APBS
+            jobs, if enabled.
+    Return:
+        int: The exit code of the job.
+    """
+    code = 0
+    telemetry = telemetry or Telemetry()
+    job_info = get_job_info(message.content) or {}
+    attempts = job_attempts(message, job_info)
+    if attempts is not None and attempts > 5:
+        _LOGGER.info("Job has repeatedly failed and needs to be removed from queue.")
+        job_type = job_info["job_type"]
+        job_tag = f"{job_info['job_date']}/{job_info['job_id']}"
+        await update_status(
+            output_storage,
+            job_tag,
+            job_type,
+            JOBSTATUS.FAILED,
+            [],
+            "Job failed too many times.",
+        )
+        await queue.mark_message_completed(message)
+        telemetry.count("poison_messages")
+        telemetry.export()
+    else:
+        metrics = JobMetrics()
+        inserted_on = getattr(message, "inserted_on", None)
+        if inserted_on is not None:
+            metrics.stages["queue_wait"] = max(
+                datetime.now(timezone.utc).timestamp() - inserted_on.timestamp(), 0.0
+            )
+        job_done = asyncio.Event()
+        lease = MessageLease(queue, message)
+        heartbeat = asyncio.create_task(renew_lease(lease, job_done, stop_event))
+        try:
+            code = await run_job(
+                message,
+                output_storage,
+                input_storage,
+                metrics,
+                settings,
+                stop_event,
+                input_cache,
+                result_cache,
+                pdb2pqr_pool,
+                functools.partial(queue.route, message),
+                admission,
+                lease,
+            )
+        finally:
+            job_done.set()
+            await heartbeat
+        await queue.mark_message_completed(message)
+        if metrics.routed_to:
+            telemetry.count("routed_jobs")
+            telemetry.export()
+            return code
+        telemetry.record_job(
+            f"{job_info.get('job_date')}/{job_info.get('job_id')}",
+            job_info.get("job_type"),
+            metrics,
+            code,
+            attempts,
+        )
+    return code
+
+
+async def worker(
+    worker_id: int,
+    queue: Queue,
+    output_storage: BlobStore,
+    input_storage: BlobStore,
+    settings: Settings,
+    stop_event: asyncio.Event,
+    input_cache: Optional[InputCache] = None,
+    result_cache: Optional[ResultCache] = None,
+    telemetry: Optional[Telemetry] = None,
+    pdb2pqr_pool: Optional[Pdb2pqrPool] = None,
+    admission: Optional[MemoryAdmission] = None,
+) -> int:
+    """Pull messages from the queue and run them until the queue is empty.
+
+    Args:
+        worker_id (int): The number of the worker, used for logging.
+        queue (Queue): The queue to pull messages from.
+        output_storage (Storage): The storage for output files.
+        input_storage (Storage): The storage for input files.
+        settings (Settings): The settings for the jobs.
+        stop_event (asyncio.Event): The event to stop the jobs.
+        input_cache (InputCache): The local cache of inputs, if enabled.
+        result_cache (ResultCache): The cache of job results, if enabled.
+        telemetry (Telemetry): Where to record the timings of the jobs.
+        pdb2pqr_pool (Pdb2pqrPool): The warm processes for pdb2pqr jobs,
+            if enabled.
+        admission (MemoryAdmission): The memory admission control for APBS
+            jobs, if enabled.
+    Return:
+        int: 143 if the worker was interrupted, otherwise 0.
+
+    A job that raises is logged and its message is left to become visible
+    again, so one bad message does not stop the other workers.
+    """
+    while not stop_event.is_set():
+        message = await queue.get_message()
+        if message is None:
+            break
+        if telemetry is not None:
+            telemetry.mark_startup("first_message")
+        if stop_event.is_set():
+            # Leave the message to become visible again for another replica
+            break
+        queue.stats.job_started()
+        try:
+            code = await process_message(
+                message,
+                queue,
+                output_storage,
+                input_storage,
+                settings,
+                stop_event,
+                input_cache,
+                result_cache,
+                telemetry,
+                pdb2pqr_pool,
+                admission,
+            )
+        except Exception as error:
+            _LOGGER.exception(
+                "Worker %s failed to process message %s: %s",
+                worker_id,
+                message.id,
+                error,
+            )
+            code = 1
+        finally:
+            queue.stats.job_finished()
+        # 143 is the exit code for a SIGTERM signal, which means the job was interrupted
+        # and we will not request the message since it can gunk up the queue.
+        if code == 143:
+            return code
+        while not PROCESSING:
+            await asyncio.sleep(10)
+    _LOGGER.info("Worker %s found no more messages", worker_id)
+    return 0
+
+
+async def maintain_queue_buffer(queue: Queue, stop_event: asyncio.Event):
+    """Periodically renew or release prefetched messages.
+
+    This keeps the buffer healthy while every worker is busy with a long
+    job and nobody is calling Queue.get_message.
+    """
+    interval = max(1, queue.visibility_timeout // 4)
+    while not stop_event.is_set():
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stop_event.wait(), timeout=interval)
+        await queue.maintain_buffer()
+
+
+def preload_modules(settings: Settings) -> float:
+    """Import the modules that are only needed once jobs run.
+
+    main() calls this in a thread while the queue client is created and
+    polls for the first message, so the imports overlap with waiting for
+    the token and the queue instead of delaying them.
+
+    Returns:
+        float: The seconds spent importing.
+    """
+    start = time()
+    modules = ["aiohttp"]
+    if getenv("APBS_BACKEND", "azure").lower() == "azure":
+        modules.extend(["azure.storage.blob", "azure.storage.blob.aio"])
+    if settings.dx_companions:
+        modules.append("numpy")
+    for module in modules:
+        importlib.import_module(module)
+    return time() - start
+
+
+def _import_times(statement: str) -> Dict[str, Tuple[int, List[Tuple[str, int]]]]:
+    """Run a statement in a fresh interpreter with -X importtime.
+
+    Returns:
+        Dict[str, Tuple[int, List[Tuple[str, int]]]]: For each top-level
+            import, its cumulative microseconds and the cumulative
+            microseconds of the modules it imported directly.
+    """
+    result = run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=Path(__file__).resolve().parent,
+        stdout=PIPE,
+        stderr=PIPE,
+        text=True,
+        check=True,
+    )
+    times = {}
+    children = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            times[name.strip()] = (int(cumulative), children)
+            children = []
+        elif depth == 1:
+            children.append((name.strip(), int(cumulative)))
+    return times
+
+
+def print_startup_profile(top: int = 15) -> int:
+    """Report where start-up time goes, measured in fresh interpreters.
+
+    The report lists the time to import this module, its slowest direct
+    imports, and how much each lazily imported module adds when it is
+    first used.
+    """
+    total, direct = _import_times("import job_control")["job_control"]
+    print(f"import job_control: {total / 1000:.1f} ms")
+    print(f"\nSlowest direct imports (cumulative ms, top {top}):")
+    for name, cumulative in sorted(direct, key=lambda item: item[1], reverse=True)[
+        :top
+    ]:
+        print(f"  {cumulative / 1000:8.1f}  {name}")
+    print("\nImported on first use (additional ms):")
+    for module in (
+        "azure.storage.queue.aio",
+        "azure.identity.aio",
+        "azure.storage.blob.aio",
+        "aiohttp",
+        "numpy",
+    ):
+        with contextlib.suppress(CalledProcessError):
+            lazy = _import_times(f"import job_control; import {module}")
+            print(f"  {lazy.get(module, (0, []))[0] / 1000:8.1f}  {module}")
+    return 0
+
+
 async def main() -> int:
     stop_event = asyncio.Event()
     loop = asyncio.get_event_loop()
@@ -963,50 +5173,94 @@ async def main() -> int:
         signal.SIGTERM, lambda: asyncio.create_task(handle_signal(stop_event))
     )
     lasttime = datetime.now()
-    queue = Queue.from_environment()
-    inputs = Storage.from_environment("inputs")
-    outputs = Storage.from_environment("outputs")
-    settings = Settings()
-    metrics = JobMetrics()
-    return_code = 0
-    while message := queue.get_message():
-        code = 0
-        if message.dequeue_count is not None and message.dequeue_count > 5:
-            _LOGGER.info(
-                "Job has repeatedly failed and needs to be removed from queue."
-            )
-            job = message.content
-            job_info = get_job_info(job)
-            job_type = job_info["job_type"]
-            job_tag = f"{job_info['job_date']}/{job_info['job_id']}"
-            update_status(
+    settings = Settings.from_environment()
+    telemetry = Telemetry.from_settings(settings)
+    telemetry.mark_startup("main")
+    # Import what the jobs need while the queue client starts and polls
+    preload = asyncio.create_task(asyncio.to_thread(preload_modules, settings))
+    queue = open_queue()
+    pdb2pqr_pool = Pdb2pqrPool.from_settings(settings)
+    if pdb2pqr_pool:
+        pdb2pqr_pool.start()
+    first_poll = asyncio.create_task(queue.warm_up())
+    _LOGGER.info("Preloaded modules in %.2f seconds", await preload)
+    inputs = open_storage("inputs")
+    outputs = open_storage("outputs")
+    input_cache = InputCache.from_settings(settings)
+    result_cache = ResultCache(inputs, outputs) if settings.result_cache else None
+    admission = MemoryAdmission.from_settings(settings)
+    telemetry.mark_startup("clients")
+    await first_poll
+    _LOGGER.info("Running up to %s jobs at once", settings.max_concurrent_jobs)
+    if admission:
+        _LOGGER.info(
+            "Admitting APBS jobs predicted to need up to %.1f GiB",
+            admission.capacity / 1024**3,
+        )
+    maintenance_task = asyncio.create_task(maintain_queue_buffer(queue, stop_event))
+    workers = [
+        asyncio.create_task(
+            worker(
+                worker_id,
+                queue,
                 outputs,
-                job_tag,
-                job_type,
-                JOBSTATUS.FAILED,
-                [],
-                "Job failed too many times.",
-            )
-            queue.mark_message_completed(message)
-        else:
-            code = await run_job(
-                message, outputs, inputs, metrics, settings, stop_event
+                inputs,
+                settings,
+                stop_event,
+                input_cache,
+                result_cache,
+                telemetry,
+                pdb2pqr_pool,
+                admission,
             )
-            queue.mark_message_completed(message)
-        # 143 is the exit code for a SIGTERM signal, which means the job was interrupted
-        # and we will not request the message since it can gunk up the queue.
-        if code == 143:
-            _LOGGER.info("DONE: %s", str(datetime.now() - lasttime))
-            return_code = code
-            break
-        while not PROCESSING:
-            sleep(10)
-
+        )
+        for worker_id in range(settings.max_concurrent_jobs)
+    ]
+    codes = await asyncio.gather(*workers, return_exceptions=True)
+    for worker_id, code in enumerate(codes):
+        if isinstance(code, Exception):
+            _LOGGER.error("Worker %s stopped: %r", worker_id, code)
+    return_code = 143 if 143 in codes else 0
+    maintenance_task.cancel()
+    await queue.release_messages()
+    await asyncio.gather(queue.close(), inputs.close(), outputs.close())
+    if pdb2pqr_pool:
+        await pdb2pqr_pool.close()
+    await shared_connections().close()
+
+    _LOGGER.info("POLLING STATS: %s", dumps(queue.stats.as_dict()))
+    telemetry.gauges["queue_idle_seconds"] = queue.stats.idle_seconds
+    telemetry.gauges["queue_busy_seconds"] = queue.stats.busy_seconds
+    telemetry.gauges["uptime_seconds"] = (datetime.now() - lasttime).total_seconds()
+    telemetry.export()
+    if input_cache:
+        _LOGGER.info(
+            "INPUT CACHE: %s hits, %s misses", input_cache.hits, input_cache.misses
+        )
+    if result_cache:
+        _LOGGER.info(
+            "RESULT CACHE: %s hits, %s misses", result_cache.hits, result_cache.misses
+        )
     _LOGGER.info("DONE: %s", str(datetime.now() - lasttime))
     return return_code
 
 
+def parse_args():
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="Report the import time of start-up and exit",
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_args()
     _LOGGER.setLevel(INFO)
+    if args.profile_startup:
+        sys.exit(print_startup_profile())
     sys.exit(asyncio.run(main()))
     # main()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# job_control.py is a single module next to this directory, not a package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
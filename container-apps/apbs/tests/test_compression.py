@@ -0,0 +1,75 @@
+import asyncio
+import gzip
+import hashlib
+import tarfile
+
+import job_control as jc
+
+TEXT = b"".join(b"ATOM %6d  CA  ALA A   1\n" % number for number in range(50000))
+
+
+def test_gzip_file_checksums_the_compressed_stream(tmp_path):
+    source = tmp_path / "1fas.pqr"
+    source.write_bytes(TEXT)
+    target = tmp_path / "1fas.pqr.gz"
+    size, md5 = jc.gzip_file(source, target)
+    compressed = target.read_bytes()
+    assert size == len(compressed) < len(TEXT)
+    assert md5 == hashlib.md5(compressed).digest()
+    assert gzip.decompress(compressed) == TEXT
+
+
+def test_only_large_text_outputs_are_compressed(tmp_path):
+    settings = jc.Settings(compress_outputs=True, compress_min_bytes=100)
+
+    def output(name, size):
+        return jc.OutputFile(name=name, path=tmp_path / name, size=size)
+
+    assert jc.should_compress(output("pot.dx", 100), settings)
+    assert jc.should_compress(output("POT.DX", 100), settings)
+    assert not jc.should_compress(output("pot.dx", 99), settings)
+    assert not jc.should_compress(output("pot.png", 1000), settings)
+    assert not jc.should_compress(output("pot.dx", 1000), jc.Settings())
+
+
+def test_compressed_upload_is_recorded_in_the_manifest(tmp_path):
+    async def run():
+        rundir = tmp_path / "job"
+        rundir.mkdir()
+        (rundir / "1fas.pqr").write_bytes(TEXT)
+        (rundir / "io.mc").write_bytes(b"small")
+        storage = jc.LocalStorage("outputs", tmp_path / "storage")
+        settings = jc.Settings(
+            job_path=str(tmp_path), compress_outputs=True, compress_min_bytes=1024
+        )
+        manifest = sorted(jc.scan_outputs(rundir), key=lambda output: output.name)
+        assert await jc.upload_outputs("job", manifest, storage, settings)
+        pqr, mc = manifest
+        assert pqr.content_encoding == "gzip"
+        assert pqr.stored_size < pqr.size
+        stored = await storage.get_contents("job/1fas.pqr")
+        assert gzip.decompress(stored) == TEXT
+        assert pqr.md5 == hashlib.md5(stored).digest()
+        assert mc.content_encoding is None
+        assert await storage.get_contents("job/io.mc") == b"small"
+        assert [path.name for path in tmp_path.glob(".upload-*")] == []
+
+    asyncio.run(run())
+
+
+def test_subdirectories_are_bundled(tmp_path):
+    async def run():
+        (tmp_path / "pdb2pka_output").mkdir()
+        (tmp_path / "pdb2pka_output" / "titration.dat").write_text("pKa")
+        (tmp_path / "abc.pqr").write_text("ATOM")
+        manifest = jc.scan_outputs(tmp_path)
+        bundled = await jc.bundle_subdirectories("job", "abc", tmp_path, manifest)
+        assert sorted(output.name for output in bundled) == [
+            "abc-pdb2pka_output.tar.gz",
+            "abc.pqr",
+        ]
+        with tarfile.open(tmp_path / "abc-pdb2pka_output.tar.gz") as tar:
+            member = tar.extractfile("pdb2pka_output/titration.dat")
+            assert member.read() == b"pKa"
+
+    asyncio.run(run())
@@ -0,0 +1,138 @@
+import asyncio
+import stat
+import time
+
+import pytest
+
+import job_control as jc
+
+# A job that starts a child of its own, which holds its output pipes open
+SCRIPT = """\
+#!/bin/sh
+{trap}
+sleep 30 &
+echo $! > child.pid
+sleep 30
+"""
+
+
+def make_script(tmp_path, trap: str = "") -> str:
+    path = tmp_path / "job.sh"
+    path.write_text(SCRIPT.format(trap=trap))
+    path.chmod(path.stat().st_mode | stat.S_IXUSR)
+    return str(path)
+
+
+def running(pid: int) -> bool:
+    """Whether a process exists and is not a zombie waiting to be reaped."""
+    try:
+        with open(f"/proc/{pid}/stat") as fin:
+            return fin.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def wait_until_gone(pid: int, timeout: float = 2) -> bool:
+    deadline = time.time() + timeout
+    while running(pid):
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+async def execute(tmp_path, stop_event=None, **kwargs) -> int:
+    return await jc.execute_command_async(
+        "job",
+        kwargs.pop("command", None) or make_script(tmp_path),
+        str(tmp_path / "stdout.txt"),
+        str(tmp_path / "stderr.txt"),
+        stop_event or asyncio.Event(),
+        cwd=tmp_path,
+        settings=jc.Settings(log_console=False),
+        **kwargs,
+    )
+
+
+async def child_pid(tmp_path) -> int:
+    path = tmp_path / "child.pid"
+    while not path.exists() or not path.read_text().strip():
+        await asyncio.sleep(0.01)
+    return int(path.read_text())
+
+
+def test_deadline_from_the_job_or_the_settings():
+    settings = jc.Settings(job_timeout=60)
+    assert jc.job_deadline({"max_run_time": "90"}, settings) == 90
+    assert jc.job_deadline({"max_run_time": 0}, settings) is None
+    assert jc.job_deadline({"max_run_time": "soon"}, settings) == 60
+    assert jc.job_deadline({}, settings) == 60
+    assert jc.job_deadline({}, jc.Settings()) is None
+
+
+def test_job_past_its_deadline_is_stopped_with_its_children(tmp_path):
+    async def run():
+        start = time.time()
+        code = await execute(tmp_path, timeout=0.3, kill_after=5)
+        assert code == jc.TIMEOUT_EXIT_CODE
+        assert time.time() - start < 3
+        assert wait_until_gone(await child_pid(tmp_path))
+
+    asyncio.run(run())
+
+
+def test_job_ignoring_sigterm_is_killed(tmp_path):
+    async def run():
+        command = make_script(tmp_path, trap="trap '' TERM")
+        start = time.time()
+        code = await execute(tmp_path, command=command, timeout=0.3, kill_after=0.3)
+        assert code == jc.TIMEOUT_EXIT_CODE
+        assert time.time() - start < 3
+        assert wait_until_gone(await child_pid(tmp_path))
+
+    asyncio.run(run())
+
+
+def test_job_within_its_deadline_keeps_its_exit_code(tmp_path):
+    async def run():
+        assert await execute(tmp_path, command="true", timeout=5) == 0
+        assert await execute(tmp_path, command="false", timeout=5) == 1
+
+    asyncio.run(run())
+
+
+def test_shutdown_stops_the_job_with_its_children(tmp_path):
+    async def run():
+        stop_event = asyncio.Event()
+        job = asyncio.create_task(execute(tmp_path, stop_event))
+        child = await child_pid(tmp_path)
+        stop_event.set()
+        assert await asyncio.wait_for(job, 3) == 143
+        assert wait_until_gone(child)
+
+    asyncio.run(run())
+
+
+def test_lease_is_extended_but_never_shortened():
+    async def run():
+        queue = jc.Queue(
+            jc.LocalQueueClient(":memory:"), 30, 1, jc.Backoff(0.01, 0.02, 2)
+        )
+        await queue.queue.send_message("job")
+        message = await queue.queue.receive_message(visibility_timeout=30)
+        lease = jc.MessageLease(queue, message)
+        await lease.extend(10)
+        assert lease.seconds == 30
+        await lease.extend(99.5)
+        assert lease.seconds == 100
+        assert queue._lease_remaining(message) > 99
+        await lease.extend(10**9)
+        assert lease.seconds == jc.MessageLease.MAX_SECONDS
+
+    asyncio.run(run())
+
+
+def test_runtime_estimate():
+    settings = jc.Settings(runtime_per_grid_point=1e-5, runtime_per_atom=1e-3)
+    size = jc.JobSize(atoms=2000, grid_points=10**6)
+    assert size.runtime(settings) == pytest.approx(12)
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import time
+
+import numpy as np
+import pytest
+
+import job_control as jc
+
+DX = """\
+# Data from APBS
+object 1 class gridpositions counts 2 3 4
+origin -1.5 0.0 2.25
+delta 0.5 0.0 0.0
+delta 0.0 0.75 0.0
+delta 0.0 0.0 1.0
+object 2 class gridconnections counts 2 3 4
+object 3 class array type double rank 0 items 24 data follows
+{values}
+attribute "dep" string "positions"
+object "regular positions regular connections" class field
+component "positions" value 1
+component "connections" value 2
+component "data" value 3
+"""
+
+
+def write_dx(path, values):
+    lines = [
+        " ".join(f"{value:e}" for value in values[start : start + 3])
+        for start in range(0, len(values), 3)
+    ]
+    path.write_text(DX.format(values="\n".join(lines)))
+
+
+def test_read_dx(tmp_path):
+    path = tmp_path / "pot.dx"
+    values = np.arange(24, dtype=np.float32) - 11.5
+    write_dx(path, values)
+    header, grid = jc.read_dx(path)
+    assert header == {
+        "counts": [2, 3, 4],
+        "origin": [-1.5, 0.0, 2.25],
+        "delta": [[0.5, 0.0, 0.0], [0.0, 0.75, 0.0], [0.0, 0.0, 1.0]],
+    }
+    assert grid.dtype == np.float32
+    assert grid.shape == (2, 3, 4)
+    # OpenDX lists the values with the last axis varying fastest
+    assert grid[1, 2, 3] == values[-1]
+    assert grid[0, 1, 0] == values[4]
+    np.testing.assert_array_equal(grid.ravel(), values)
+
+
+def test_read_dx_rejects_truncated_data(tmp_path):
+    path = tmp_path / "pot.dx"
+    write_dx(path, np.zeros(21, dtype=np.float32))
+    with pytest.raises(ValueError):
+        jc.read_dx(path)
+
+
+def test_write_dx_companion(tmp_path):
+    path = tmp_path / "pot.dx"
+    values = np.linspace(-1, 1, 24, dtype=np.float32)
+    write_dx(path, values)
+    data_path, header_path = jc.write_dx_companion(path)
+    assert data_path.name == "pot.dx.npy"
+    np.testing.assert_allclose(np.load(data_path), values.reshape(2, 3, 4), rtol=1e-6)
+    header = json.loads(header_path.read_text())
+    assert header["counts"] == [2, 3, 4]
+    assert header["source"] == "pot.dx"
+    assert header["data"] == "pot.dx.npy"
+    assert header["dtype"] == "float32"
+
+
+@pytest.mark.parametrize("chunk_bytes", [1, 5, 13, 64])
+def test_read_dx_in_small_chunks(tmp_path, monkeypatch, chunk_bytes):
+    monkeypatch.setattr(jc, "DX_CHUNK_BYTES", chunk_bytes)
+    path = tmp_path / "pot.dx"
+    values = np.arange(24, dtype=np.float32) * 0.25 - 3
+    write_dx(path, values)
+    _, grid = jc.read_dx(path)
+    np.testing.assert_array_equal(grid.ravel(), values)
+
+
+def test_read_dx_rejects_extra_data(tmp_path):
+    path = tmp_path / "pot.dx"
+    write_dx(path, np.zeros(27, dtype=np.float32))
+    with pytest.raises(ValueError):
+        jc.read_dx(path)
+
+
+def test_conversions_are_bounded(tmp_path, monkeypatch):
+    running = []
+    peak = []
+
+    def convert(path):
+        running.append(path)
+        peak.append(len(running))
+        time.sleep(0.02)
+        running.remove(path)
+        return []
+
+    monkeypatch.setattr(jc, "write_dx_companion", convert)
+    for index in range(4):
+        write_dx(tmp_path / f"pot{index}.dx", np.zeros(24, dtype=np.float32))
+    manifest = jc.scan_outputs(tmp_path)
+    asyncio.run(jc.convert_dx_outputs("job", tmp_path, manifest, concurrency=2))
+    assert len(peak) == 4
+    assert max(peak) <= 2
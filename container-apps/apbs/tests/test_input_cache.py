@@ -0,0 +1,125 @@
+import asyncio
+import os
+
+import job_control as jc
+
+
+class Source:
+    """Counts downloads of a fixed content."""
+
+    def __init__(self, content: bytes):
+        self.content = content
+        self.downloads = 0
+
+    async def download(self, path):
+        self.downloads += 1
+        await asyncio.sleep(0.01)
+        path.write_bytes(self.content)
+
+
+def test_concurrent_fetches_download_once(tmp_path):
+    async def run():
+        cache = jc.InputCache(tmp_path / "cache", 1024)
+        source = Source(b"ATOM")
+        targets = [tmp_path / f"target{index}" for index in range(4)]
+        hits = await asyncio.gather(
+            *(
+                cache.fetch("in/1fas.pqr", "etag", target, source.download)
+                for target in targets
+            )
+        )
+        assert source.downloads == 1
+        assert sorted(hits) == [False, True, True, True]
+        assert (cache.hits, cache.misses) == (3, 1)
+        for target in targets:
+            assert target.read_bytes() == b"ATOM"
+
+    asyncio.run(run())
+
+
+def test_new_version_is_downloaded_again(tmp_path):
+    async def run():
+        cache = jc.InputCache(tmp_path / "cache", 1024)
+        source = Source(b"ATOM")
+        target = tmp_path / "target"
+        assert not await cache.fetch("in/1fas.pqr", "1", target, source.download)
+        source.content = b"HETATM"
+        assert not await cache.fetch("in/1fas.pqr", "2", target, source.download)
+        assert target.read_bytes() == b"HETATM"
+
+    asyncio.run(run())
+
+
+def test_modified_input_does_not_change_the_cache(tmp_path):
+    async def run():
+        cache = jc.InputCache(tmp_path / "cache", 1024)
+        source = Source(b"ATOM")
+        first = tmp_path / "first"
+        await cache.fetch("in/1fas.pqr", "etag", first, source.download)
+        with open(first, "ab") as fout:
+            fout.write(b" changed")
+        second = tmp_path / "second"
+        assert await cache.fetch("in/1fas.pqr", "etag", second, source.download)
+        assert second.read_bytes() == b"ATOM"
+        assert not os.path.samefile(first, second)
+
+    asyncio.run(run())
+
+
+def test_failed_download_leaves_nothing_behind(tmp_path):
+    async def run():
+        cache = jc.InputCache(tmp_path / "cache", 1024)
+
+        async def fail(path):
+            path.write_bytes(b"AT")
+            raise OSError("connection reset")
+
+        try:
+            await cache.fetch("in/1fas.pqr", "etag", tmp_path / "target", fail)
+        except OSError:
+            pass
+        assert not [path for path in cache.root.rglob("*") if path.is_file()]
+        source = Source(b"ATOM")
+        assert not await cache.fetch(
+            "in/1fas.pqr", "etag", tmp_path / "target", source.download
+        )
+
+    asyncio.run(run())
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    async def run():
+        cache = jc.InputCache(tmp_path / "cache", 10)
+        target = tmp_path / "target"
+        await cache.fetch("a", "1", target, Source(b"aaaa").download)
+        await cache.fetch("b", "1", target, Source(b"bbbb").download)
+        # Touching a makes b the least recently used entry
+        os.utime(cache._entry_path(cache.key("b", "1")), (0, 0))
+        await cache.fetch("a", "1", target, Source(b"aaaa").download)
+        await cache.fetch("c", "1", target, Source(b"cccc").download)
+        assert cache._entry_path(cache.key("a", "1")).exists()
+        assert not cache._entry_path(cache.key("b", "1")).exists()
+        assert cache._entry_path(cache.key("c", "1")).exists()
+        assert cache.key("b", "1") not in cache._locks
+
+    asyncio.run(run())
+
+
+def test_entry_being_fetched_is_not_evicted(tmp_path):
+    async def run():
+        cache = jc.InputCache(tmp_path / "cache", 10)
+        target = tmp_path / "target"
+        await cache.fetch("a", "1", target, Source(b"aaaa").download)
+        key = cache.key("a", "1")
+        os.utime(cache._entry_path(key), (0, 0))
+        async with cache._locks[key]:
+            # A fetch of a holds its lock while it copies the entry
+            await cache.fetch("b", "1", target, Source(b"bbbb").download)
+            os.utime(cache._entry_path(cache.key("b", "1")), (1, 1))
+            await cache.fetch("c", "1", target, Source(b"cccc").download)
+        assert cache._entry_path(key).exists()
+        assert key in cache._locks
+        assert not cache._entry_path(cache.key("b", "1")).exists()
+        assert cache._entry_path(cache.key("c", "1")).exists()
+
+    asyncio.run(run())
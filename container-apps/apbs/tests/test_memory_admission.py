@@ -0,0 +1,70 @@
+import asyncio
+
+import job_control as jc
+
+MiB = 1024**2
+GiB = 1024**3
+
+
+def test_prediction_is_linear_in_atoms_and_grid_points():
+    admission = jc.MemoryAdmission(8 * GiB)
+    size = jc.JobSize(atoms=1000, grid_points=10**6)
+    assert admission.predict(size) == 64 * MiB + 1024 * 1000 + 200 * 10**6
+
+
+def test_job_larger_than_capacity_is_rejected():
+    admission = jc.MemoryAdmission(1 * GiB)
+    assert admission.rejection(jc.JobSize(grid_points=10**6)) is None
+    reason = admission.rejection(jc.JobSize(grid_points=10**7))
+    assert "dime" in reason
+
+
+def test_rejection_ignores_the_learned_cost():
+    admission = jc.MemoryAdmission(1 * GiB)
+    size = jc.JobSize(grid_points=4 * 10**6)
+    for _ in range(jc.MemoryAdmission.SAMPLES):
+        admission.calibrate(size, 64 * MiB + 400 * size.grid_points)
+    assert admission.predict(size) > admission.capacity
+    assert admission.rejection(size) is None
+
+
+def test_calibration_skips_jobs_dominated_by_the_base():
+    admission = jc.MemoryAdmission(8 * GiB)
+    assert admission.calibrate(jc.JobSize(grid_points=1000), 2 * GiB) is None
+    assert admission.learned_per_grid_point == 200
+
+
+def test_calibration_is_bounded_and_follows_the_jobs_down():
+    admission = jc.MemoryAdmission(8 * GiB)
+    size = jc.JobSize(grid_points=10**7)
+    assert admission.calibrate(size, 64 * MiB + 1000 * size.grid_points) == 1000
+    assert admission.learned_per_grid_point == 400
+    for _ in range(jc.MemoryAdmission.SAMPLES):
+        admission.calibrate(size, 64 * MiB + 150 * size.grid_points)
+    assert admission.learned_per_grid_point == 150
+    for _ in range(jc.MemoryAdmission.SAMPLES):
+        admission.calibrate(size, 64 * MiB + 10 * size.grid_points)
+    assert admission.learned_per_grid_point == 100
+
+
+def test_jobs_wait_for_room():
+    async def run():
+        admission = jc.MemoryAdmission(10)
+        await admission.acquire(6)
+        waiting = asyncio.create_task(admission.acquire(6))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        await admission.release(6)
+        await asyncio.wait_for(waiting, 1)
+        assert admission.reserved == 6
+
+    asyncio.run(run())
+
+
+def test_oversized_job_runs_alone():
+    async def run():
+        admission = jc.MemoryAdmission(10)
+        await asyncio.wait_for(admission.acquire(20), 1)
+        assert admission.reserved == 20
+
+    asyncio.run(run())
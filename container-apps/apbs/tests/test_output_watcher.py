@@ -0,0 +1,98 @@
+import asyncio
+import os
+from pathlib import Path
+
+import pytest
+
+import job_control as jc
+
+
+def make_watcher(tmp_path) -> jc.OutputWatcher:
+    rundir = tmp_path / "job"
+    rundir.mkdir()
+    storage = jc.LocalStorage("outputs", tmp_path / "storage")
+    settings = jc.Settings(job_path=str(tmp_path), pipeline_interval=0.05)
+    return jc.OutputWatcher("job", rundir, storage, settings)
+
+
+def test_scan_skips_files_that_vanish(tmp_path, monkeypatch):
+    (tmp_path / "kept.txt").write_text("kept")
+    monkeypatch.setattr(
+        jc.os, "walk", lambda rundir: [(str(rundir), [], ["gone.tmp", "kept.txt"])]
+    )
+    assert [output.name for output in jc.scan_outputs(tmp_path)] == ["kept.txt"]
+
+
+def test_stable_files_are_uploaded_while_the_job_runs(tmp_path):
+    async def run():
+        watcher = make_watcher(tmp_path)
+        (watcher.rundir / "io.mc").write_text("done")
+
+        async def job():
+            await asyncio.sleep(0.3)
+            return 0
+
+        assert await watcher.watch(job()) == 0
+        assert set(watcher.uploaded) == {"io.mc"}
+        stored = tmp_path / "storage" / "outputs" / "job" / "io.mc"
+        assert stored.read_text() == "done"
+        manifest = jc.scan_outputs(watcher.rundir)
+        assert watcher.remaining(manifest) == []
+        assert manifest[0].md5 == watcher.uploaded["io.mc"].md5
+
+    asyncio.run(run())
+
+
+def test_failed_poll_does_not_end_the_watch(tmp_path, monkeypatch):
+    async def run():
+        watcher = make_watcher(tmp_path)
+
+        def fail():
+            raise FileNotFoundError("tmp file vanished")
+
+        monkeypatch.setattr(watcher, "_stable_files", fail)
+
+        async def job():
+            await asyncio.sleep(0.2)
+            return 3
+
+        assert await watcher.watch(job()) == 3
+
+    asyncio.run(run())
+
+
+def test_cancelled_watch_stops_the_job(tmp_path):
+    async def run():
+        watcher = make_watcher(tmp_path)
+        pids = []
+        execution = jc.execute_command_async(
+            "job",
+            "sleep 30",
+            str(watcher.rundir / "stdout.txt"),
+            str(watcher.rundir / "stderr.txt"),
+            asyncio.Event(),
+            cwd=watcher.rundir,
+            on_spawn=pids.append,
+        )
+        watch = asyncio.create_task(watcher.watch(execution))
+        await asyncio.sleep(0.2)
+        watch.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await watch
+        with pytest.raises(ProcessLookupError):
+            os.kill(pids[0], 0)
+
+    asyncio.run(run())
+
+
+def test_removed_output_is_not_uploaded(tmp_path):
+    async def run():
+        watcher = make_watcher(tmp_path)
+        temporary = Path(watcher.rundir / "scratch.tmp")
+        temporary.write_text("scratch")
+        await watcher.poll()
+        temporary.unlink()
+        await watcher.poll()
+        assert watcher.uploaded == {}
+
+    asyncio.run(run())
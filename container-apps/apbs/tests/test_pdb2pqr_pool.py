@@ -0,0 +1,116 @@
+import asyncio
+import concurrent.futures
+import time
+
+import job_control as jc
+
+# Three residues of 1AJJ, enough for a quick pdb2pqr run
+PDB = """\
+ATOM      1  N   PRO A   4      -0.169   7.698  13.415  1.00 22.81           N
+ATOM      2  CA  PRO A   4       0.745   6.948  12.566  1.00 22.22           C
+ATOM      3  C   PRO A   4       2.242   7.069  13.001  1.00 21.42           C
+ATOM      4  O   PRO A   4       2.527   6.607  14.110  1.00 21.79           O
+ATOM      5  CB  PRO A   4       0.532   7.450  11.164  1.00 22.96           C
+ATOM      6  CG  PRO A   4      -0.343   8.686  11.221  1.00 24.22           C
+ATOM      7  CD  PRO A   4      -0.704   8.833  12.692  1.00 23.59           C
+ATOM      8  N   CYS A   5       3.194   7.584  12.163  1.00 20.42           N
+ATOM      9  CA  CYS A   5       4.673   7.669  12.388  1.00 18.85           C
+ATOM     10  C   CYS A   5       5.169   8.640  13.469  1.00 18.26           C
+ATOM     11  O   CYS A   5       4.462   9.578  13.844  1.00 18.46           O
+ATOM     12  CB  CYS A   5       5.409   8.135  11.144  1.00 17.94           C
+ATOM     13  SG  CYS A   5       5.534   6.993   9.751  1.00 15.29           S
+ATOM     14  N   SER A   6       6.397   8.447  13.968  1.00 17.28           N
+ATOM     15  CA  SER A   6       6.992   9.377  14.915  1.00 16.38           C
+ATOM     16  C   SER A   6       7.305  10.650  14.149  1.00 15.46           C
+ATOM     17  O   SER A   6       7.506  10.605  12.932  1.00 15.43           O
+ATOM     18  CB  SER A   6       8.285   8.835  15.471  1.00 17.55           C
+ATOM     19  OG  SER A   6       8.117   7.537  16.030  1.00 20.43           O
+END
+"""
+
+
+async def run_job(pool, tmp_path, name: str, arguments: str):
+    pids = []
+    code = await pool.execute(
+        name,
+        arguments.split(),
+        str(tmp_path / f"{name}.stdout.txt"),
+        str(tmp_path / f"{name}.stderr.txt"),
+        asyncio.Event(),
+        tmp_path,
+        pids.append,
+        jc.Settings(log_console=False),
+    )
+    return code, pids[0] if pids else None
+
+
+def test_jobs_reuse_a_warm_process(tmp_path):
+    (tmp_path / "pep.pdb").write_text(PDB)
+
+    async def run():
+        pool = jc.Pdb2pqrPool(1, 5)
+        try:
+            first = await run_job(pool, tmp_path, "a", "--ff=PARSE pep.pdb a.pqr")
+            second = await run_job(pool, tmp_path, "b", "--ff=AMBER pep.pdb b.pqr")
+        finally:
+            await pool.close()
+        assert first[0] == second[0] == 0
+        assert first[1] == second[1]
+        assert "ATOM" in (tmp_path / "b.pqr").read_text()
+
+    asyncio.run(run())
+
+
+def test_failed_job_keeps_the_process(tmp_path):
+    (tmp_path / "pep.pdb").write_text(PDB)
+
+    async def run():
+        pool = jc.Pdb2pqrPool(1, 5)
+        try:
+            failed = await run_job(pool, tmp_path, "a", "--ff=NOPE pep.pdb a.pqr")
+            passed = await run_job(pool, tmp_path, "b", "--ff=PARSE pep.pdb b.pqr")
+        finally:
+            await pool.close()
+        assert failed[0] != 0
+        assert "invalid choice" in (tmp_path / "a.stderr.txt").read_text()
+        assert passed == (0, failed[1])
+
+    asyncio.run(run())
+
+
+def test_process_is_replaced_after_its_jobs(tmp_path):
+    (tmp_path / "pep.pdb").write_text(PDB)
+
+    async def run():
+        pool = jc.Pdb2pqrPool(1, 1)
+        try:
+            first = await run_job(pool, tmp_path, "a", "--ff=PARSE pep.pdb a.pqr")
+            second = await run_job(pool, tmp_path, "b", "--ff=PARSE pep.pdb b.pqr")
+        finally:
+            await pool.close()
+        assert first[0] == second[0] == 0
+        assert first[1] != second[1]
+
+    asyncio.run(run())
+
+
+def test_jobs_do_not_hold_executor_threads(tmp_path):
+    (tmp_path / "pep.pdb").write_text(PDB)
+
+    async def run():
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        asyncio.get_running_loop().set_default_executor(executor)
+        pool = jc.Pdb2pqrPool(1, 5)
+        try:
+            await run_job(pool, tmp_path, "warm", "--ff=PARSE pep.pdb warm.pqr")
+            blocker = asyncio.ensure_future(asyncio.to_thread(time.sleep, 3))
+            code, _ = await asyncio.wait_for(
+                run_job(pool, tmp_path, "a", "--ff=PARSE pep.pdb a.pqr"), 2
+            )
+            assert code == 0
+            assert not blocker.done()
+            await blocker
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
@@ -0,0 +1,105 @@
+import asyncio
+import base64
+import json
+
+import job_control as jc
+
+
+def encode(job_info) -> str:
+    return base64.b64encode(json.dumps(job_info).encode("utf-8")).decode()
+
+
+async def received(queue: jc.Queue, content: str):
+    await queue.queue.send_message(content)
+    return await queue.queue.receive_message(visibility_timeout=30)
+
+
+def make_queue() -> jc.Queue:
+    return jc.Queue(jc.LocalQueueClient(":memory:"), 30, 1, jc.Backoff(0.01, 0.02, 2))
+
+
+def test_message_is_released_until_the_handout_rate_is_known():
+    async def run():
+        queue = make_queue()
+        message = await received(queue, encode({"job_id": "a"}))
+        assert not await queue._renew_or_release(message, 0)
+        assert queue._lease_remaining(message) <= 0
+        again = await queue.queue.receive_message(visibility_timeout=30)
+        assert again.id == message.id
+        assert queue.extract_jobinfo(again) == {
+            "job_id": "a",
+            jc.Queue.RELEASES_KEY: 1,
+        }
+
+    asyncio.run(run())
+
+
+def test_message_reached_within_a_lease_is_renewed():
+    async def run():
+        queue = make_queue()
+        queue._handout_interval = 1
+        message = await received(queue, encode({"job_id": "a"}))
+        receipt = message.pop_receipt
+        assert await queue._renew_or_release(message, 3)
+        assert message.pop_receipt != receipt
+        assert queue._lease_remaining(message) > 29
+        assert await queue.queue.receive_message() is None
+        assert queue.extract_jobinfo(message) == {"job_id": "a"}
+
+    asyncio.run(run())
+
+
+def test_message_reached_after_its_lease_is_released():
+    async def run():
+        queue = make_queue()
+        queue._handout_interval = 10
+        message = await received(queue, encode({"job_id": "a"}))
+        assert not await queue._renew_or_release(message, 3)
+        again = await queue.queue.receive_message()
+        assert queue.extract_jobinfo(again)[jc.Queue.RELEASES_KEY] == 1
+
+    asyncio.run(run())
+
+
+def test_content_that_is_not_a_job_is_released_unchanged():
+    async def run():
+        queue = make_queue()
+        message = await received(queue, "not base64 json")
+        assert not await queue._renew_or_release(message, 0)
+        again = await queue.queue.receive_message()
+        assert again.content == "not base64 json"
+
+    asyncio.run(run())
+
+
+def test_lost_message_is_dropped():
+    async def run():
+        queue = make_queue()
+        message = await received(queue, encode({"job_id": "a"}))
+        await queue.queue.delete_message(message)
+        assert not await queue._renew_or_release(message, 0)
+
+    asyncio.run(run())
+
+
+def test_releases_are_not_counted_as_attempts():
+    async def run():
+        queue = make_queue()
+        message = await received(queue, encode({"job_id": "a"}))
+        for _ in range(7):
+            await queue.release(message)
+            message = await queue.queue.receive_message(visibility_timeout=30)
+        assert message.dequeue_count == 8
+        assert jc.job_attempts(message, queue.extract_jobinfo(message)) == 1
+
+    asyncio.run(run())
+
+
+def test_prefetch_follows_the_concurrency(monkeypatch):
+    monkeypatch.setenv("APBS_MAX_CONCURRENT_JOBS", "4")
+    monkeypatch.delenv("APBS_QUEUE_PREFETCH", raising=False)
+    assert jc.Queue.prefetch_from_env() == 4
+    monkeypatch.setenv("APBS_QUEUE_PREFETCH", "100")
+    assert jc.Queue.prefetch_from_env() == 8
+    monkeypatch.setenv("APBS_MAX_CONCURRENT_JOBS", "40")
+    assert jc.Queue.prefetch_from_env() == jc.Queue.MAX_BATCH_SIZE
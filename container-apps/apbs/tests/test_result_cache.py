@@ -0,0 +1,76 @@
+import asyncio
+
+import job_control as jc
+
+
+def make_job(tmp_path, job_id: str, content: str):
+    rundir = tmp_path / job_id
+    rundir.mkdir()
+    (rundir / f"{job_id}.in").write_text(content)
+    (rundir / "1fas.pqr").write_text("ATOM")
+    job_info = {
+        "job_id": job_id,
+        "job_type": "apbs",
+        "input_files": [f"{job_id}/{job_id}.in", f"{job_id}/1fas.pqr"],
+        "command_line_args": f"{job_id}.in",
+    }
+    return job_info, rundir
+
+
+def make_cache(tmp_path) -> jc.ResultCache:
+    return jc.ResultCache(
+        jc.LocalStorage("inputs", tmp_path / "storage"),
+        jc.LocalStorage("outputs", tmp_path / "storage"),
+    )
+
+
+def test_identical_jobs_share_a_key(tmp_path, monkeypatch):
+    monkeypatch.setenv("APBS_VERSION", "3.4.1")
+
+    async def run():
+        cache = make_cache(tmp_path)
+        first = await cache.job_key(*make_job(tmp_path, "abc", "elec"))
+        second = await cache.job_key(*make_job(tmp_path, "xyz", "elec"))
+        changed = await cache.job_key(*make_job(tmp_path, "def", "elec other"))
+        assert first == second
+        assert first != changed
+
+    asyncio.run(run())
+
+
+def test_unknown_program_version_is_not_cached(tmp_path, monkeypatch):
+    monkeypatch.delenv("APBS_VERSION", raising=False)
+
+    async def run():
+        cache = make_cache(tmp_path)
+        assert await cache.job_key(*make_job(tmp_path, "abc", "elec")) is None
+
+    asyncio.run(run())
+
+
+def test_outputs_are_copied_to_the_new_job(tmp_path):
+    async def run():
+        cache = make_cache(tmp_path)
+        assert await cache.restore("key", "2024/xyz", "xyz") is None
+        source = tmp_path / "pot.dx"
+        source.write_text("grid")
+        await cache.output_storage.upload_file(
+            filepath=source, prefix="2023/abc", name="abc-pot.dx"
+        )
+        await cache.store("key", "2023/abc", "abc", ["abc-pot.dx"], 4)
+        record = await cache.restore("key", "2024/xyz", "xyz")
+        assert record["outputs"] == ["xyz-pot.dx"]
+        assert await cache.output_storage.get_contents("2024/xyz/xyz-pot.dx") == b"grid"
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    asyncio.run(run())
+
+
+def test_expired_outputs_are_a_miss(tmp_path):
+    async def run():
+        cache = make_cache(tmp_path)
+        await cache.store("key", "2023/abc", "abc", ["abc-pot.dx"], 4)
+        assert await cache.restore("key", "2024/xyz", "xyz") is None
+        assert (cache.hits, cache.misses) == (0, 1)
+
+    asyncio.run(run())
@@ -0,0 +1,90 @@
+import asyncio
+import json
+
+import job_control as jc
+
+
+class SlowStorage(jc.LocalStorage):
+    """LocalStorage that counts writes and takes a while for each."""
+
+    delay = 0.0
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.puts = 0
+
+    async def put_contents(self, *args, **kwargs):
+        self.puts += 1
+        await asyncio.sleep(self.delay)
+        return await super().put_contents(*args, **kwargs)
+
+
+async def make_status(tmp_path, delay: float = 0.0):
+    storage = SlowStorage("outputs", tmp_path)
+    await storage.put_contents(
+        "job/apbs-status.json", json.dumps({"apbs": {"status": "pending"}})
+    )
+    storage.puts = 0
+    storage.delay = delay
+    return jc.StatusManager(storage, "job", "apbs"), storage
+
+
+async def stored(storage) -> dict:
+    return json.loads(await storage.get_contents("job/apbs-status.json"))["apbs"]
+
+
+def test_updates_are_written_together(tmp_path):
+    async def run():
+        status, storage = await make_status(tmp_path)
+        status.update(jc.JOBSTATUS.RUNNING, [])
+        status.update(jc.JOBSTATUS.COMPLETE, ["job/pot.dx"])
+        await status.flush()
+        assert storage.puts == 1
+        job = await stored(storage)
+        assert job["status"] == "complete"
+        assert job["outputFiles"] == ["job/pot.dx"]
+        assert await status.flush() == {}
+
+    asyncio.run(run())
+
+
+def test_update_during_a_delayed_write_is_kept(tmp_path):
+    async def run():
+        status, storage = await make_status(tmp_path, delay=0.2)
+        status.update(jc.JOBSTATUS.RUNNING, [])
+        status.flush_later(0.05)
+        await asyncio.sleep(0.1)
+        # The delayed write of running is in flight
+        status.update(jc.JOBSTATUS.COMPLETE, ["job/pot.dx"])
+        assert await status.flush() != {}
+        assert (await stored(storage))["status"] == "complete"
+        assert storage.puts == 2
+
+    asyncio.run(run())
+
+
+def test_conflicting_write_is_retried_on_the_new_copy(tmp_path):
+    async def run():
+        status, storage = await make_status(tmp_path)
+        await status.load()
+        await storage.put_contents(
+            "job/apbs-status.json",
+            json.dumps({"apbs": {"status": "failed", "owner": "other"}}),
+            overwrite=True,
+        )
+        status.update(jc.JOBSTATUS.RUNNING, [])
+        await status.flush()
+        assert status.retries == 1
+        assert await stored(storage) == {"status": "failed", "owner": "other"}
+
+    asyncio.run(run())
+
+
+def test_missing_status_file_keeps_the_updates(tmp_path):
+    async def run():
+        status = jc.StatusManager(SlowStorage("outputs", tmp_path), "job", "apbs")
+        status.update(jc.JOBSTATUS.RUNNING, [])
+        assert await status.flush() == {}
+        assert len(status._pending) == 1
+
+    asyncio.run(run())
@@ -0,0 +1,69 @@
+import io
+
+import job_control as jc
+
+LINES = b"".join(b"line %05d of the log\n" % number for number in range(5000))
+
+
+def write_log(data: bytes, max_bytes: int, chunk: int = 37) -> bytes:
+    output = io.BytesIO()
+    log = jc.StreamLog(
+        output, None, jc.Settings(log_max_bytes=max_bytes, log_console=False)
+    )
+    for start in range(0, len(data), chunk):
+        log.feed(data[start : start + chunk])
+    log.close()
+    return output.getvalue()
+
+
+def test_log_within_the_cap_is_written_byte_for_byte():
+    for size in (0, 1, 499, 500, 501, 680, 999, 1000):
+        assert write_log(LINES[:size], 1000) == LINES[:size]
+
+
+def test_log_without_a_cap_is_written_byte_for_byte():
+    assert write_log(LINES, 0) == LINES
+
+
+def test_long_log_keeps_its_start_and_end():
+    written = write_log(LINES, 1000)
+    head, marker, tail = written.partition(b"\n[... ")
+    assert marker
+    assert LINES.startswith(head)
+    omitted, _, tail = tail.partition(b" bytes omitted ...]\n")
+    assert LINES.endswith(tail)
+    assert tail.startswith(b"line ")
+    assert len(head) + int(omitted) + len(tail) == len(LINES)
+    assert len(written) < 1000 + 50
+
+
+def test_tail_held_in_memory_is_bounded():
+    output = io.BytesIO()
+    log = jc.StreamLog(output, None, jc.Settings(log_max_bytes=1024**3))
+    for _ in range(64):
+        log.feed(b"x" * 1024 * 1024)
+    assert log.tail_bytes == jc.StreamLog.TAIL_BYTES
+    assert len(log._tail) <= 2 * jc.StreamLog.TAIL_BYTES + 1024 * 1024
+
+
+def test_console_rate_drops_lines_and_reports_them():
+    console = io.BytesIO()
+    log = jc.StreamLog(
+        None, console, jc.Settings(log_console_rate=10, log_flush_bytes=1024)
+    )
+    log.feed(b"short\n")
+    log.feed(b"far too long for the rate\n")
+    log.close()
+    assert console.getvalue() == (b"short\n[26 bytes of output not mirrored]\n")
+
+
+def test_one_byte_cap_keeps_no_tail():
+    output = io.BytesIO()
+    log = jc.StreamLog(output, None, jc.Settings(log_max_bytes=1))
+    assert log.tail_bytes == 0
+    for _ in range(100):
+        log.feed(b"x" * 1000 + b"\n")
+        assert len(log._tail) == 0
+    log.close()
+    assert output.getvalue() == b"x\n[... 100099 bytes omitted ...]\n"
+    assert write_log(b"x", 1) == b"x"
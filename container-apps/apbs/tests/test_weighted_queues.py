@@ -0,0 +1,109 @@
+import asyncio
+import base64
+import collections
+import json
+
+import job_control as jc
+
+APBS_INPUT = """\
+read
+    mol pqr 1fas.pqr
+end
+elec name coarse # dime 999 999 999 is a comment
+    mg-auto
+    dime 97 97 97
+end
+elec name solv
+    mg-para
+    dime 65 65 65
+    pdime 2 2 2
+end
+quit
+"""
+
+
+def encode(job_info) -> str:
+    return base64.b64encode(json.dumps(job_info).encode("utf-8")).decode()
+
+
+def make_queues(weights, large_queue=None) -> jc.WeightedQueues:
+    backoff = jc.Backoff(0.01, 0.02, 2)
+    queues = {
+        name: jc.Queue(jc.LocalQueueClient(":memory:"), 30, 1, backoff, name=name)
+        for name in weights
+    }
+    return jc.WeightedQueues(
+        queues,
+        weights,
+        0.1,
+        backoff,
+        large_queue=large_queue,
+        large_atoms=100,
+        large_grid_points=10**6,
+    )
+
+
+def test_parse_weights():
+    assert jc.WeightedQueues.parse_weights("interactive:8, small:4,large") == {
+        "interactive": 8,
+        "small": 4,
+        "large": 1,
+    }
+
+
+def test_queues_go_first_in_proportion_to_their_weights():
+    queues = make_queues({"interactive": 8, "small": 4, "large": 1})
+    firsts = collections.Counter(queues._poll_order()[0] for _ in range(13 * 5))
+    assert firsts == {"interactive": 40, "small": 20, "large": 5}
+
+
+def test_idle_queue_does_not_hold_up_the_others():
+    async def run():
+        queues = make_queues({"interactive": 8, "large": 1})
+        await queues.queues["large"].queue.send_message(encode({"job_id": "a"}))
+        message = await queues.get_message()
+        assert queues.extract_jobinfo(message) == {"job_id": "a"}
+        assert queues._sources[message.id] == "large"
+        await queues.mark_message_completed(message)
+        assert await queues.get_message() is None
+
+    asyncio.run(run())
+
+
+def test_large_job_is_forwarded_without_its_releases():
+    async def run():
+        queues = make_queues({"interactive": 8, "large": 1}, large_queue="large")
+        interactive = queues.queues["interactive"]
+        await interactive.queue.send_message(encode({"job_id": "a"}))
+        message = await interactive.queue.receive_message(visibility_timeout=30)
+        await interactive.release(message)
+        message = await queues.get_message()
+        assert queues.extract_jobinfo(message)[jc.Queue.RELEASES_KEY] == 1
+
+        assert await queues.route(message, jc.JobSize(atoms=100)) is None
+        assert await queues.route(message, jc.JobSize(atoms=101)) == "large"
+        copy = await queues.queues["large"].queue.receive_message()
+        assert queues.queues["large"].extract_jobinfo(copy) == {"job_id": "a"}
+        assert jc.job_attempts(copy, {"job_id": "a"}) == 1
+
+    asyncio.run(run())
+
+
+def test_job_on_the_large_queue_is_not_forwarded():
+    async def run():
+        queues = make_queues({"interactive": 8, "large": 1}, large_queue="large")
+        await queues.queues["large"].queue.send_message(encode({"job_id": "a"}))
+        message = await queues.get_message()
+        assert await queues.route(message, jc.JobSize(grid_points=10**9)) is None
+
+    asyncio.run(run())
+
+
+def test_job_size_from_inputs(tmp_path):
+    (tmp_path / "1fas.pqr").write_text("REMARK\nATOM 1\nHETATM 2\nATOM 3\nEND\n")
+    (tmp_path / "apbs.in").write_text(APBS_INPUT)
+    (tmp_path / "notes.txt").write_text("dime 1000 1000 1000")
+    size = jc.estimate_job_size(
+        tmp_path, ["1fas.pqr", "apbs.in", "notes.txt", "missing.pdb"]
+    )
+    assert size == jc.JobSize(atoms=3, grid_points=97**3 + 65**3)